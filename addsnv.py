@@ -4,9 +4,17 @@ import sys
 import pysam
 import argparse
 import random
-import subprocess
 import os
+import shutil
+import tempfile
+import itertools
+import multiprocessing
 import bs.replacereads as rr
+import bs.pileup as pu
+import bs.aligner as al
+import bs.truthvcf as tv
+import bs.mates as mt
+import bs.metrics as mx
 from collections import Counter
 
 def majorbase(basepile):
@@ -50,63 +58,31 @@ def mut(base,det=False):
             mut = bases[int(random.uniform(0,4))]
         return mut
 
-def countReadCoverage(bam,chrom,start,end,strand=None):
-    """ calculate coverage of aligned reads over region
+def countReadCoverage(bam,chrom,start,end,strand=None,qnames=None):
+    """ calculate coverage of aligned reads over region (0-based, start and end included),
+        one value per base. If qnames is given, only reads with names in qnames are counted.
+        See pu.coverage() for several regions at once.
     """
+    return pu.coverage(bam, [(chrom,int(start),int(end))], strand=strand, qnames=qnames)[0].tolist()
 
-    coverage = []
-    start = int(start)
-    end = int(end)
-    for i in range(end-start+1):
-        coverage.append(0.0)
 
-    i = 0
-    if chrom in bam.references:
-        for pcol in bam.pileup(chrom,start,end):
-            n = 0
-            if pcol.pos >= start and pcol.pos <= end:
-                for read in pcol.pileups:
-                    if strand == '+':
-                        if not read.alignment.is_reverse and read.alignment.mapq >= 0 and not read.alignment.is_duplicate:
-                            n += 1
-                    elif strand == '-':
-                        if read.alignment.is_reverse and read.alignment.mapq >= 0 and not read.alignment.is_duplicate:
-                            n += 1
-                    else:
-                        if read.alignment.mapq >= 0 and not read.alignment.is_duplicate:
-                            n += 1
-                coverage[i] = n
-                i += 1
-
-    return coverage
-
-
-def countBaseAtPos(bamfile,chrom,pos):
-    """ return list of bases at position chrom,pos
+def countBaseAtPos(bam,chrom,pos):
+    """ return list of bases at position chrom,pos (1-based, as in samtools mpileup -r)
+        bam is an open pysam.Samfile
     """
-    locstr = chrom + ":" + str(pos) + "-" + str(pos)
-    args = ['samtools','mpileup',bamfile,'-r',locstr]
-
-    p = subprocess.Popen(args,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    p.wait()
-    pout = p.stdout.readlines()
-
-    pileup = None 
-
-    for line in pout:
-        try:
-            c = line.strip().split()
-            assert len(c) >= 5
-            pileup = c[4].upper()
-        except AssertionError:
-            print "mpileup failed, no coverage for base:",chrom,pos
-            return []
-    bases = []
-    if pileup:
-        for b in pileup:
-            if b in ['A','T','C','G']:
-                bases.append(b)
-
+    counter = pu.BaseCounter()
+    if chrom in bam.references:
+        for pcol in bam.pileup(chrom,pos-1,pos):
+            if pcol.pos == pos-1:
+                counter.touch(pos)
+                for pread in pcol.pileups:
+                    qpos = pu.pileupbase(pread)
+                    if qpos is not None:
+                        counter.add(pos, pread.alignment.seq[qpos], pread.alignment.qual[qpos])
+
+    bases = counter.bases(pos)
+    if not bases:
+        print "no coverage for base:",chrom,pos
     return bases
 
 def mergebams(bamlist,outbamfn):
@@ -114,243 +90,557 @@ def mergebams(bamlist,outbamfn):
     """
     args = ['samtools','merge','-f',outbamfn] + bamlist
     print "merging, cmd: ",args
-    subprocess.call(args)
+    mx.call(args, stage='merge')
 
     for bamfile in bamlist:
         os.remove(bamfile)
         os.remove(bamfile + '.bai')
 
-def remap(bamfn, threads, bwaref):
-    """ call bwa/samtools to remap .bam
+def remap(bamfn, threads, bwaref, aligner=None):
+    """ remap .bam in place (sorted and indexed), aligner is an optional command template (see bs/aligner.py)
     """
-    sai1fn = bamfn + ".1.sai"
-    sai2fn = bamfn + ".2.sai"
-    samfn  = bamfn + ".sam"
-    refidx = bwaref + ".fai"
-
-    sai1args = ['bwa', 'aln', bwaref, '-q', '5', '-l', '32', '-k', '3', '-t', str(threads), '-o', '1', '-f', sai1fn, '-b1', bamfn]
-    sai2args = ['bwa', 'aln', bwaref, '-q', '5', '-l', '32', '-k', '3', '-t', str(threads), '-o', '1', '-f', sai2fn, '-b2', bamfn]
-    samargs  = ['bwa', 'sampe', '-P', '-f', samfn, bwaref, sai1fn, sai2fn, bamfn, bamfn]
-    bamargs  = ['samtools', 'view', '-bt', refidx, '-o', bamfn, samfn] 
-
-    print "mapping 1st end, cmd: " + " ".join(sai1args)
-    subprocess.call(sai1args)
-    print "mapping 2nd end, cmd: " + " ".join(sai2args)
-    subprocess.call(sai2args)
-    print "pairing ends, building .sam, cmd: " + " ".join(samargs)
-    subprocess.call(samargs)
-    print "sam --> bam, cmd: " + " ".join(bamargs)
-    subprocess.call(bamargs)
-
-    sortbase = bamfn + ".sort"
-    sortfn   = sortbase + ".bam"
-    sortargs = ['samtools','sort','-m','10000000000',bamfn,sortbase]
-    print "sorting, cmd: " + " ".join(sortargs)
-    subprocess.call(sortargs)
-    os.rename(sortfn,bamfn)
-
-    indexargs = ['samtools','index',bamfn]
-    print "indexing, cmd: " + " ".join(indexargs)
-    subprocess.call(indexargs)
-
-    # cleanup
-    os.remove(sai1fn)
-    os.remove(sai2fn)
-    os.remove(samfn)
+    alnopts = ['-q', '5', '-l', '32', '-k', '3', '-o', '1']
+    al.align(bamfn, bamfn, bwaref, bamfn, threads=threads, aligner=aligner, alnopts=alnopts, bam=True,
+             sortmem=10000000000, index=True)
 
-def replace(origbamfile, mutbamfile, outbamfile):
+def replace(origbamfile, mutbamfile, outbamfile, regions=False, procs=1, threads=1, level=None):
     ''' open .bam file and call replacereads
+        if regions is True, only regions of origbamfile (sorted and indexed) near mutated reads are re-encoded,
+        otherwise origbamfile is processed in per-contig shards if procs > 1
     '''
-    origbam = pysam.Samfile(origbamfile, 'rb')
-    mutbam  = pysam.Samfile(mutbamfile, 'rb')
-    outbam  = pysam.Samfile(outbamfile, 'wb', template=origbam)
+    rr.replaceBams(origbamfile, mutbamfile, outbamfile, keepqual=True, regions=regions, procs=procs, threads=threads, level=level)
 
-    rr.replaceReads(origbam, mutbam, outbam, keepqual=True)
+class MutSite:
+    """ one target site from the input BED, carries results between the mutation,
+        remapping and QC steps (plain attributes so it can be returned by worker processes)
+    """
+    def __init__(self, index, bedline):
+        c = bedline.strip().split()
+        self.index   = index # line number in input, used for ordering and seeding
+        self.bedline = bedline
+        self.chrom   = c[0]
+        self.start   = int(c[1])
+        self.end     = int(c[2])
+        if len(c) > 3:
+            self.maf = float(c[3])
+        else:
+            self.maf = None
+
+        self.gmutpos = None # position of mutation in genome
+        self.refbase = None
+        self.mutbase = None
+        self.mutstr  = None
+        self.maxfrac = 0.0
+        self.hasSNP  = False
+        self.wrote   = 0
+        self.nmut    = 0
+        self.tmpbam  = None
+        self.passed  = False # True if mutation passed QC and tmpbam should be merged
+        self.log     = [] # lines for the .log file, written by main() in input order
+        self.rstate  = None # random state after picksite(), restored for mutatesite() in --sweep mode
+
+def picksite(args, site, reffile):
+    """ pick the base to mutate in the site and its new base, returns False if the site
+        is skipped (N in the reference)
+    """
+    gmutpos = int(random.uniform(site.start,site.end+1)) # position of mutation in genome
+    refbase = reffile.fetch(site.chrom,gmutpos-1,gmutpos)
+    try:
+        mutbase = mut(refbase,args.det)
+    except ValueError as e:
+        sys.stderr.write(' '.join(("skipped site:",site.chrom,str(site.start),str(site.end),"due to N base:",str(e),"\n")))
+        return False
+
+    site.gmutpos = gmutpos
+    site.refbase = refbase
+    site.mutbase = mutbase
+    site.mutstr  = refbase + "-->" + mutbase
+    return True
+
+class SitePileup:
+    """ reads covering a site's mutation position and base counts over all columns they cover,
+        from bamfile.pileup() (pileupsite()) or from a sorted scan of the .bam (sweepsite())
+    """
+    def __init__(self, site):
+        self.site = site
+        self.mutcol = site.gmutpos-1 # 0-based column of the mutation (gmutpos is 1-based, as in the VCF)
+        # keep a list of reads to modify - use hash to keep unique since each
+        # read will be visited as many times as it has bases covering the region
+        self.outreads = {}
+        self.mutreads = {} # same keys as outreads
+        self.numunmap = 0
+        # A/C/G/T counts for every column covered by reads overlapping the site
+        self.basecounter = pu.BaseCounter()
+
+    def add(self, pos, read, seq, qual, qpos, is_del):
+        """ one pileup entry: read (with sequence seq, qualities qual) at 0-based column pos,
+            qpos is the read base aligned to pos (reads with a deletion there have no base)
+        """
+        if is_del:
+            return
+        self.basecounter.add(pos, seq[qpos], qual[qpos])
+
+        if pos == self.mutcol:
+            pairname = 'F' # read is first in pair
+            if read.is_read2:
+                pairname = 'S' # read is second in pair
+            if not read.is_paired:
+                pairname = 'U' # read is unpaired
+
+            extqname = ','.join((read.qname,str(read.pos),pairname))
+
+            if not read.mate_is_unmapped:
+                self.outreads[extqname] = read
+                mutbases = list(seq)
+                mutbases[qpos] = self.site.mutbase
+                mutread = ''.join(mutbases)
+                self.mutreads[extqname] = mutread
+                self.site.log.append(" ".join(('read',extqname,mutread,"\n")))
+            else:
+                self.numunmap += 1
+
+def pileupsite(site, bamfile):
+    """ SitePileup for site from a pileup of bamfile at the mutation position """
+    pile = SitePileup(site)
+    for pcol in bamfile.pileup(reference=site.chrom,start=pile.mutcol,end=pile.mutcol+1):
+        # this will include all positions covered by a read that covers the region of interest
+        pile.basecounter.touch(pcol.pos)
+        for pread in pcol.pileups:
+            qpos = pu.pileupbase(pread)
+            pile.add(pcol.pos, pread.alignment, pread.alignment.seq, pread.alignment.qual, qpos, qpos is None)
+    return pile
+
+def sweepsite(site, covering):
+    """ same as pileupsite() from the reads covering the mutation position, as yielded by pu.sweep() """
+    pile = SitePileup(site)
+    for (read, columns) in covering: # reads in file order, as in pileup columns
+        seq  = read.seq
+        qual = read.qual
+        for (pos, qpos, is_del) in columns:
+            pile.basecounter.touch(pos)
+            pile.add(pos, read, seq, qual, qpos, is_del)
+    return pile
+
+def mutatesite(args, site, bamfile, bammate, reffile, cnv, tmpdir, pile=None, mates=None):
+    """ pick a base in the site, mutate reads covering it and write them with their mates
+        to a temporary .bam. Returns None if the site is skipped.
+        In --sweep mode the site is already picked, pile is its SitePileup and mates
+        has the mate of each read in pile (see sweepsites())
+    """
+    snvfrac = float(args.snvfrac)
+    chrom   = site.chrom
+    start   = site.start
+    end     = site.end
+    maf     = site.maf
+
+    if pile is None and not picksite(args, site, reffile):
+        return None
+
+    mutmates = {} # same keys as outreads, keep track of mates
+    hasSNP = False
+    tmpoutbamname = os.path.join(tmpdir, "tmpbam" + str(random.random()) + ".bam")
+    print "creating tmp bam: ",tmpoutbamname #DEBUG
+    outbam_muts = pysam.Samfile(tmpoutbamname, 'wb', template=bamfile)
+    maxfrac = 0.0
+
+    if pile is None:
+        pile = pileupsite(site, bamfile)
+    outreads    = pile.outreads
+    mutreads    = pile.mutreads
+    basecounter = pile.basecounter
+
+    # look up mates of all reads at the site at once
+    if mates is None:
+        resolver = mt.MateResolver(bammate)
+        extqnames = outreads.keys()
+        mates = dict(zip(extqnames, resolver.mates([outreads[name] for name in extqnames])))
+        resolver.report()
+    for extqname in outreads:
+        if mates.get(extqname) is None:
+            print "warning: no mate for",outreads[extqname].qname
+        mutmates[extqname] = mates.get(extqname)
+
+    # make sure region doesn't have any changes that are likely SNPs
+    # (trying to avoid messing with haplotypes)
+    for pos in basecounter.columns():
+        frac = basecounter.minorfrac(pos)
+        if frac is not None:
+            if frac > maxfrac:
+                maxfrac = frac
+            if frac > snvfrac:
+                print "dropped for proximity to SNP, nearby SNP MAF:",frac,"maxfrac:",snvfrac
+                hasSNP = True
+        else:
+            print "could not pileup for region:",chrom,pos
+            hasSNP = True
+
+    # pick reads to change
+    readlist = []
+    for extqname,read in outreads.iteritems():
+        if read.seq != mutreads[extqname]:
+            readlist.append(extqname)
+
+    print "len(readlist):",str(len(readlist))
+    random.shuffle(readlist)
+
+    if maf is None:
+        maf = float(args.mutfrac) # default minor allele freq if not otherwise specifi
+    if cnv: # cnv file is present
+        if chrom in cnv.contigs:
+            for cnregion in cnv.fetch(chrom,start,end):
+                cn = float(cnregion.strip().split()[3]) # expect chrom,start,end,CN
+                sys.stderr.write(' '.join(("copy number in snp region:",chrom,str(start),str(end),"=",str(cn))) + "\n")
+                if float(cn) > 0.0:
+                    maf = 1.0/float(cn)
+                else:
+                    maf = 0.0
+                sys.stderr.write("adjusted MAF: " + str(maf) + "\n")
+    else:
+        sys.stderr.write("selected MAF: " + str(maf) + "\n")
+
+    lastread = int(len(readlist)*maf)
+
+    # pick at least one read if possible
+    if lastread == 0 and len(readlist) > 0:
+        sys.stderr.write("forced 1 read.\n")
+        lastread = 1
+
+    readlist = readlist[0:int(len(readlist)*maf)] 
+    print "picked:",str(len(readlist))
+
+    wrote = 0
+    nmut = 0
+    # change reads from .bam to mutated sequences
+    for extqname,read in outreads.iteritems():
+        origseq = None
+        if read.seq != mutreads[extqname]:
+            if not args.nomut and extqname in readlist:
+                origseq = read.seq
+                qual = read.qual # changing seq resets qual (see pysam API docs)
+                read.seq = mutreads[extqname] # make mutation
+                read.qual = qual
+                nmut += 1
+        if not hasSNP or args.force:
+            wrote += 1
+            outbam_muts.write(read)
+            if mutmates[extqname] is not None:
+                outbam_muts.write(mutmates[extqname])
+        if origseq is not None: # in --sweep mode reads are shared with nearby sites
+            qual = read.qual
+            read.seq = origseq
+            read.qual = qual
+    print "wrote: ",wrote,"mutated:",nmut
 
-    origbam.close()
-    mutbam.close()
-    outbam.close()
+    outbam_muts.close()
 
-def main(args):
-    """ needs refactoring
+    site.maxfrac = maxfrac
+    site.hasSNP  = hasSNP
+    site.wrote   = wrote
+    site.nmut    = nmut
+    site.tmpbam  = tmpoutbamname
+
+    if hasSNP and not args.force:
+        os.remove(tmpoutbamname)
+        site.tmpbam = None
+
+    return site
+
+def coverregion(site, coverwindow=1):
+    """ region around the mutation used for coverage QC """
+    return (site.chrom, site.gmutpos-coverwindow, site.gmutpos+coverwindow)
+
+def checksite(args, site, bamfile, mutbam, qnames=None, incover=None):
+    """ coverage QC of remapped reads in mutbam vs. original bamfile,
+        sets site.passed and adds the 'snv' line to the site's log.
+        qnames restricts mutbam to the site's own reads (see remapbatch()),
+        incover is the coverage of bamfile over coverregion(site) if already known
     """
-    bedfile = open(args.varFileName, 'r')
-    bamfile = pysam.Samfile(args.bamFileName, 'rb')
-    bammate = pysam.Samfile(args.bamFileName, 'rb') # use for mates to avoid iterator problems
-    reffile = pysam.Fastafile(args.refFasta)
+    gmutpos = site.gmutpos
+
+    (chrom, start, end) = coverregion(site)
+    if incover is None:
+        incover = countReadCoverage(bamfile,chrom,start,end)
+    outcover = countReadCoverage(mutbam,chrom,start,end,qnames=qnames)
+
+    avgincover  = float(sum(incover))/float(len(incover)) 
+    avgoutcover = float(sum(outcover))/float(len(outcover))
+    spikein_snvfrac = 0.0
+    if site.wrote > 0:
+        spikein_snvfrac = float(site.nmut)/float(site.wrote)
+
+    # qc cutoff for final snv depth 
+    if (avgoutcover > 0 and avgincover > 0 and avgoutcover/avgincover >= 0.9) or args.force:
+        site.passed = True
+        site.log.append("\t".join(("snv",site.bedline.strip(),str(gmutpos),site.mutstr,str(avgoutcover),str(avgoutcover),str(spikein_snvfrac),str(site.maxfrac)))+"\n")
+
+    return site.passed
+
+# per-process state for runsite(), set up by initsite()
+_handles = {}
+
+def initsite(args, tmpdir):
+    """ open input files and a private temporary directory for the current process,
+        run once per worker (or once in main() if running serially)
+    """
+    _handles['args']    = args
+    _handles['bamfile'] = pysam.Samfile(args.bamFileName, 'rb')
+    _handles['bammate'] = pysam.Samfile(args.bamFileName, 'rb') # use for mates to avoid iterator problems
+    _handles['reffile'] = pysam.Fastafile(args.refFasta)
+    _handles['tmpdir']  = tempfile.mkdtemp(dir=tmpdir)
 
     # optional CNV file
-    cnv = None
+    _handles['cnv'] = None
     if (args.cnvfile):
-        cnv = pysam.Tabixfile(args.cnvfile, 'r')
+        _handles['cnv'] = pysam.Tabixfile(args.cnvfile, 'r')
+
+    # forked workers inherit the parent's random state
+    if args.seed is None:
+        random.seed()
+
+def truthrecord(site):
+    """ truth VCF record for a site that passed QC """
+    vaf = 0.0
+    if site.wrote > 0:
+        vaf = float(site.nmut)/float(site.wrote)
+    return tv.snvRecord(site.chrom, site.gmutpos, site.refbase.upper(), site.mutbase.upper(), vaf)
+
+def closesite():
+    for name in ('bamfile', 'bammate', 'reffile', 'cnv'):
+        if _handles.get(name) is not None:
+            _handles[name].close()
+    _handles.clear()
+
+def runsite(job):
+    """ mutate, remap and QC one site, job is (line number, bed line)
+    """
+    (index, bedline) = job
+    args = _handles['args']
+
+    # seed per site so results don't depend on which process handles the site
+    if args.seed is not None:
+        random.seed(int(args.seed) + index)
+
+    site = MutSite(index, bedline)
+    with mx.stage('mutate', site=index):
+        mutated = mutatesite(args, site, _handles['bamfile'], _handles['bammate'], _handles['reffile'], _handles['cnv'], _handles['tmpdir'])
+    if mutated is None:
+        mx.count('sites_skipped')
+        return None
+    mx.count('reads_mutated', site.nmut)
+
+    return qcsite(site)
+
+def qcsite(site):
+    """ remap and QC a mutated site, unless reads are remapped together (--batchremap)
+    """
+    args = _handles['args']
+    if site.tmpbam is not None and not args.batchremap:
+        with mx.stage('remap', site=site.index):
+            remap(site.tmpbam, 4, args.refFasta, args.aligner)
+        with mx.stage('qc', site=site.index):
+            mutbam = pysam.Samfile(site.tmpbam,'rb')
+            checksite(args, site, _handles['bamfile'], mutbam)
+            mutbam.close()
+
+    return site
+
+def sweepsites(jobs):
+    """ --sweep: pick the mutation position of every site (same seeding as runsite()), then
+        visit the sites in genome order reading the .bam once per chromosome (pu.sweep())
+        instead of one pileup per site. Mates of the reads at all sites on a chromosome are
+        looked up together. jobs are (line number, bed line), uses the files opened by
+        initsite(). Returns the mutated sites in input order, for qcsite().
+    """
+    args    = _handles['args']
+    bamfile = _handles['bamfile']
+
+    bychrom = {}
+    for (index, bedline) in jobs:
+        if args.seed is not None:
+            random.seed(int(args.seed) + index)
+        site = MutSite(index, bedline)
+        if not picksite(args, site, _handles['reffile']):
+            mx.count('sites_skipped')
+            continue
+        if args.seed is not None:
+            site.rstate = random.getstate()
+        bychrom.setdefault(site.chrom, []).append(site)
+
+    order = dict([(name, i) for (i, name) in enumerate(bamfile.references)])
+    mutated = []
+    for chrom in sorted(bychrom, key=lambda chrom: (order.get(chrom, len(order)), chrom)):
+        sites = sorted(bychrom[chrom], key=lambda site: (site.gmutpos, site.index))
+
+        with mx.stage('sweep', chrom=chrom, sites=len(sites)):
+            piles = []
+            positions = [s.gmutpos-1 for s in sites] # 0-based columns, see SitePileup
+            for (site, (pos, covering)) in itertools.izip(sites, pu.sweep(bamfile, chrom, positions)):
+                piles.append(sweepsite(site, covering))
+
+            keys = [(i, extqname) for (i, pile) in enumerate(piles) for extqname in pile.outreads]
+            resolver = mt.MateResolver(_handles['bammate'])
+            found = resolver.mates([piles[i].outreads[extqname] for (i, extqname) in keys])
+            resolver.report()
+            mates = [{} for pile in piles]
+            for ((i, extqname), mate) in zip(keys, found):
+                mates[i][extqname] = mate
+
+        for (site, pile, sitemates) in zip(sites, piles, mates):
+            if site.rstate is not None:
+                random.setstate(site.rstate)
+                site.rstate = None
+            with mx.stage('mutate', site=site.index):
+                mutatesite(args, site, bamfile, _handles['bammate'], _handles['reffile'], _handles['cnv'], _handles['tmpdir'], pile=pile, mates=sitemates)
+            mx.count('reads_mutated', site.nmut)
+            mutated.append(site)
+
+    mutated.sort(key=lambda site: site.index)
+    return mutated
+
+def remapbatch(args, sites, tmpdir, outbamfn):
+    """ remap the mutated reads of all sites with a single aligner run, then apply
+        per-site coverage QC to each site's share of the remapped reads. Reads from
+        sites that pass are written to outbamfn. Returns the sites that were
+        considered, in input order (stops after --numsnvs sites pass).
+    """
+    bamfile = pysam.Samfile(args.bamFileName, 'rb')
+
+    # concatenate per-site .bams, each read pair is remapped (and output) once, for the first
+    # site that claims it, but counts towards coverage QC of every site that mutated it
+    combinedfn = os.path.join(tmpdir, "batch.bam")
+    combined = pysam.Samfile(combinedfn, 'wb', template=bamfile)
+    owner  = {} # read name --> site index
+    qnames = {} # site index --> set of read names
+    for site in sites:
+        qnames[site.index] = set()
+        if site.tmpbam is None: # dropped for proximity to SNP
+            continue
+        shared = 0
+        sitebam = pysam.Samfile(site.tmpbam, 'rb')
+        for read in sitebam.fetch(until_eof=True):
+            qnames[site.index].add(read.qname)
+            if owner.setdefault(read.qname, site.index) != site.index:
+                shared += 1
+                continue
+            combined.write(read)
+        sitebam.close()
+        if shared > 0:
+            print "warning: site",site.index,"shares",shared,"reads with earlier sites, only their version is kept"
+        os.remove(site.tmpbam)
+    combined.close()
+
+    if not owner: # nothing to remap
+        bamfile.close()
+        return sites
+
+    with mx.stage('remapbatch', sites=len(sites)):
+        remap(combinedfn, max(4, int(args.procs)), args.refFasta, args.aligner)
+
+    # coverage of the original .bam at all sites in one pass
+    with mx.stage('qccoverage', sites=len(sites)):
+        qcsites = [site for site in sites if site.tmpbam is not None]
+        incover = dict(zip([site.index for site in qcsites], pu.coverage(bamfile, [coverregion(site) for site in qcsites])))
+
+    maxsnvs = int(args.numsnvs)
+    checked = []
+    passed  = set()
+    mutbam  = pysam.Samfile(combinedfn, 'rb')
+    for site in sites:
+        checked.append(site)
+        if site.tmpbam is None:
+            continue
+        with mx.stage('qc', site=site.index):
+            ok = checksite(args, site, bamfile, mutbam, qnames=qnames[site.index], incover=incover[site.index])
+        if ok:
+            passed.add(site.index)
+            if maxsnvs > 0 and len(passed) >= maxsnvs:
+                break
+
+    # keep reads from sites that passed QC, output stays sorted
+    outbam = pysam.Samfile(outbamfn, 'wb', template=mutbam)
+    for read in mutbam.fetch(until_eof=True):
+        if owner.get(read.qname) in passed:
+            outbam.write(read)
+    outbam.close()
+    mutbam.close()
+    bamfile.close()
+
+    return checked
+
+def main(args):
+    """ mutate sites from the input BED (in parallel if --procs > 1), results are
+        collected in input order
+    """
+    mx.configure(args.metrics) # before starting workers, they append to the same file
+    bamfile = pysam.Samfile(args.bamFileName, 'rb')
 
     # make a temporary file to hold mutated reads
     outbam_mutsfile = "tmp." + str(random.random()) + ".muts.bam"
     outbam_muts = pysam.Samfile(outbam_mutsfile, 'wb', template=bamfile)
     outbam_muts.close()
+    bamfile.close()
     tmpbams = []
 
-    log = open(args.outBamFile + ".log",'w')
-
-    snvfrac = float(args.snvfrac)
-
-    for bedline in bedfile:
-        if len(tmpbams) < int(args.numsnvs) or int(args.numsnvs) == 0:
-            c = bedline.strip().split()
-            chrom   = c[0]
-            start = int(c[1])
-            end   = int(c[2])
-            if len(c) > 3:
-                maf   = float(c[3])
-            else:
-                maf = None
-
-            gmutpos = int(random.uniform(start,end+1)) # position of mutation in genome
-            refbase = reffile.fetch(chrom,gmutpos-1,gmutpos)
-            try:
-                mutbase = mut(refbase,args.det)
-            except ValueError as e:
-                sys.stderr.write(' '.join(("skipped site:",chrom,str(start),str(end),"due to N base:",str(e),"\n")))
-                continue
+    # per-site temporary files go here, one subdirectory per process
+    tmpdir = tempfile.mkdtemp(prefix='addsnv.', dir='.')
 
-            mutstr = refbase + "-->" + mutbase
-
-            # keep a list of reads to modify - use hash to keep unique since each
-            # read will be visited as many times as it has bases covering the region
-            outreads = {}
-            mutreads = {} # same keys as outreads
-            mutmates = {} # same keys as outreads, keep track of mates
-            numunmap = 0
-            hasSNP = False
-            tmpoutbamname = "tmpbam" + str(random.random()) + ".bam"
-            print "creating tmp bam: ",tmpoutbamname #DEBUG
-            outbam_muts = pysam.Samfile(tmpoutbamname, 'wb', template=bamfile)
-            maxfrac = 0.0
-
-            for pcol in bamfile.pileup(reference=chrom,start=gmutpos,end=gmutpos+1):
-                # this will include all positions covered by a read that covers the region of interest
-                if pcol.pos: #> start and pcol.pos <= end:
-                    refbase = reffile.fetch(chrom,pcol.pos-1,pcol.pos)
-                    basepile = ''
-                    for pread in pcol.pileups:
-                        basepile += pread.alignment.seq[pread.qpos-1]
-                        pairname = 'F' # read is first in pair
-                        if pread.alignment.is_read2:
-                            pairname = 'S' # read is second in pair
-                        if not pread.alignment.is_paired:
-                            pairname = 'U' # read is unpaired
-
-                        extqname = ','.join((pread.alignment.qname,str(pread.alignment.pos),pairname))
-
-                        if pcol.pos == gmutpos:
-                            if not pread.alignment.mate_is_unmapped:
-                                outreads[extqname] = pread.alignment
-                                mutbases = list(pread.alignment.seq)
-                                mutbases[pread.qpos-1] = mutbase
-                                mutread = ''.join(mutbases)
-                                mutreads[extqname] = mutread
-                                mate = None
-                                try:
-                                    mate = bammate.mate(pread.alignment)
-                                except:
-                                    print "warning: no mate for",pread.alignment.qname
-                                mutmates[extqname] = mate
-                                log.write(" ".join(('read',extqname,mutread,"\n")))
-                            else:
-                                numunmap += 1
-
-                    # make sure region doesn't have any changes that are likely SNPs
-                    # (trying to avoid messing with haplotypes)
-                
-                    basepile = countBaseAtPos(args.bamFileName,chrom,pcol.pos)
-                    if basepile:
-                        majb = majorbase(basepile)
-                        minb = minorbase(basepile)
-
-                        frac = float(minb[1])/(float(majb[1])+float(minb[1]))
-                        if minb[0] == majb[0]:
-                            frac = 0.0
-                        if frac > maxfrac:
-                            maxfrac = frac
-                        if frac > snvfrac:
-                            print "dropped for proximity to SNP, nearby SNP MAF:",frac,"maxfrac:",snvfrac
-                            hasSNP = True
-                    else:
-                        print "could not pileup for region:",chrom,pcol.pos
-                        hasSNP = True
-
-            # pick reads to change
-            readlist = []
-            for extqname,read in outreads.iteritems():
-                if read.seq != mutreads[extqname]:
-                    readlist.append(extqname)
-
-            print "len(readlist):",str(len(readlist))
-            random.shuffle(readlist)
-
-            if maf is None:
-                maf = float(args.mutfrac) # default minor allele freq if not otherwise specifi
-            if cnv: # cnv file is present
-                if chrom in cnv.contigs:
-                    for cnregion in cnv.fetch(chrom,start,end):
-                        cn = float(cnregion.strip().split()[3]) # expect chrom,start,end,CN
-                        sys.stderr.write(' '.join(("copy number in snp region:",chrom,str(start),str(end),"=",str(cn))) + "\n")
-                        if float(cn) > 0.0:
-                            maf = 1.0/float(cn)
-                        else:
-                            maf = 0.0
-                        sys.stderr.write("adjusted MAF: " + str(maf) + "\n")
-            else:
-                sys.stderr.write("selected MAF: " + str(maf) + "\n")
-
-            lastread = int(len(readlist)*maf)
-
-            # pick at least one read if possible
-            if lastread == 0 and len(readlist) > 0:
-                sys.stderr.write("forced 1 read.\n")
-                lastread = 1
-
-            readlist = readlist[0:int(len(readlist)*maf)] 
-            print "picked:",str(len(readlist))
-
-            wrote = 0
-            nmut = 0
-            # change reads from .bam to mutated sequences
-            for extqname,read in outreads.iteritems():
-                if read.seq != mutreads[extqname]:
-                    if not args.nomut and extqname in readlist:
-                        qual = read.qual # changing seq resets qual (see pysam API docs)
-                        read.seq = mutreads[extqname] # make mutation
-                        read.qual = qual
-                        nmut += 1
-                if not hasSNP or args.force:
-                    wrote += 1
-                    outbam_muts.write(read)
-                    if mutmates[extqname] is not None:
-                        outbam_muts.write(mutmates[extqname])
-            print "wrote: ",wrote,"mutated:",nmut
-
-            if not hasSNP or args.force:
-                outbam_muts.close()
-                remap(tmpoutbamname, 4, args.refFasta)
-
-                outbam_muts = pysam.Samfile(tmpoutbamname,'rb')
-                coverwindow = 1
-                incover  = countReadCoverage(bamfile,chrom,gmutpos-coverwindow,gmutpos+coverwindow)
-                outcover = countReadCoverage(outbam_muts,chrom,gmutpos-coverwindow,gmutpos+coverwindow)
-
-                avgincover  = float(sum(incover))/float(len(incover)) 
-                avgoutcover = float(sum(outcover))/float(len(outcover))
-                spikein_snvfrac = 0.0
-                if wrote > 0:
-                    spikein_snvfrac = float(nmut)/float(wrote)
-
-                # qc cutoff for final snv depth 
-                if (avgoutcover > 0 and avgincover > 0 and avgoutcover/avgincover >= 0.9) or args.force:
-                    tmpbams.append(tmpoutbamname)
-                    log.write("\t".join(("snv",bedline.strip(),str(gmutpos),mutstr,str(avgoutcover),str(avgoutcover),str(spikein_snvfrac),str(maxfrac)))+"\n")
-
-            outbam_muts.close()
+    bedfile = open(args.varFileName, 'r')
+    log = open(args.outBamFile + ".log",'w')
+    truth = tv.TruthVCF(args.refFasta)
+
+    maxsnvs = int(args.numsnvs)
+    procs   = int(args.procs)
+
+    pool = None
+    if args.sweep: # mutate in this process, remap and QC in workers
+        initsite(args, tmpdir)
+        mutated = sweepsites(enumerate(bedfile))
+        if procs > 1:
+            pool = multiprocessing.Pool(processes=procs, initializer=initsite, initargs=(args, tmpdir))
+            sites = pool.imap(qcsite, mutated)
+        else:
+            sites = itertools.imap(qcsite, mutated)
+    elif procs > 1:
+        pool = multiprocessing.Pool(processes=procs, initializer=initsite, initargs=(args, tmpdir))
+        sites = pool.imap(runsite, enumerate(bedfile))
+    else:
+        initsite(args, tmpdir)
+        sites = itertools.imap(runsite, enumerate(bedfile))
+
+    finished = True
+    batch = [] # sites waiting for remapbatch()
+    for site in sites:
+        if site is None:
+            continue
+        if args.batchremap:
+            batch.append(site)
+            continue
+        for line in site.log:
+            log.write(line)
+        if site.passed:
+            tmpbams.append(site.tmpbam)
+            truth.add([truthrecord(site)])
+            mx.count('sites_passed')
+        if maxsnvs > 0 and len(tmpbams) >= maxsnvs:
+            finished = False
+            break
+
+    if pool is not None:
+        if finished:
+            pool.close()
+        else: # have enough mutations, drop sites still in progress
+            pool.terminate()
+        pool.join()
+    if _handles:
+        closesite()
+
+    if batch:
+        for site in remapbatch(args, batch, tmpdir, outbam_mutsfile):
+            for line in site.log:
+                log.write(line)
+            if site.passed:
+                truth.add([truthrecord(site)])
+                mx.count('sites_passed')
 
     # merge tmp bams
     if len(tmpbams) == 1:
@@ -359,21 +649,26 @@ def main(args):
         mergebams(tmpbams,outbam_mutsfile)
 
     bedfile.close()
-    bamfile.close()
-    bammate.close()
     log.close()
+    print "truth VCF:", truth.write(args.outBamFile + ".truth.vcf")
 
     # cleanup
-    for bam in tmpbams:
-        if os.path.exists(bam):
-            os.remove(bam)
+    shutil.rmtree(tmpdir)
 
     print "done making mutations, merging mutations into", args.bamFileName, "-->", args.outBamFile
-    replace(args.bamFileName, outbam_mutsfile, args.outBamFile)
+    mx.filesize('mutated_bam', outbam_mutsfile)
+    with mx.stage('replace'):
+        replaceprocs = 1
+        if args.shardreplace:
+            replaceprocs = int(args.procs)
+        replace(args.bamFileName, outbam_mutsfile, args.outBamFile, regions=args.regionreplace, procs=replaceprocs, threads=int(args.threads), level=args.complevel)
 
     #cleanup
     os.remove(outbam_mutsfile)
 
+    if args.metrics:
+        mx.summary()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='adds SNVs to reads, outputs modified reads as .bam along with mates')
     parser.add_argument('-v', '--varfile', dest='varFileName', required=True,
@@ -394,5 +689,19 @@ if __name__ == '__main__':
     parser.add_argument('--nomut', action='store_true', default=False, help="dry run")
     parser.add_argument('--det', action='store_true', default=False, help="deterministic base changes: make transitions only")
     parser.add_argument('--force', action='store_true', default=False, help="force mutation to happen regardless of nearby SNP or low coverage")
+    parser.add_argument('-p', '--procs', dest='procs', default=1, help="number of processes for spiking sites (and for the final read replacement with --shardreplace) (default = 1)")
+    parser.add_argument('--batchremap', action='store_true', default=False, help="remap reads from all sites in one aligner run instead of once per site")
+    parser.add_argument('--sweep', action='store_true', default=False, help="visit sites in genome order and read the (sorted, indexed) .bam once per chromosome instead of one pileup per site, remapping and QC still use --procs processes")
+    parser.add_argument('--aligner', dest='aligner', default=None, help="aligner command writing SAM to stdout, e.g. 'bwa mem -t {threads} {ref} {fq1} {fq2}' (default: bwa aln/sampe)")
+    parser.add_argument('--shardreplace', action='store_true', default=False, help="replace reads in per-contig shards of the (sorted, indexed) input .bam using --procs processes when writing output")
+    parser.add_argument('--regionreplace', action='store_true', default=False, help="only re-encode regions of the (sorted, indexed) input .bam near mutations when writing output")
+    parser.add_argument('--threads', dest='threads', default=1, help="threads for BGZF compression/decompression of the output .bam (default = 1)")
+    parser.add_argument('--complevel', dest='complevel', default=None, help="compression level for the output .bam (0-9, default = 6)")
+    parser.add_argument('--seed', dest='seed', default=None, help="random seed, results for a given seed do not depend on --procs")
+    parser.add_argument('--metrics', dest='metrics', default=None, help="write per-site stage timings, subprocess exit codes and read counts to this file (JSON lines) and print a summary at the end")
+    parser.add_argument('--profile', dest='profile', default=None, help="run the main process under cProfile and save stats to this file")
     args = parser.parse_args()
-    main(args)
+    if args.profile:
+        mx.profile(main, args, args.profile)
+    else:
+        main(args)
@@ -1,79 +1,74 @@
 #!/usr/bin/env python
 
 import re, os, sys, random
-import subprocess
 import argparse
 import pysam
+import shutil
+import tempfile
+import itertools
+import multiprocessing
 import bs.replacereads as rr
 import bs.asmregion as ar
 import bs.mutableseq as ms
+import bs.aligner as al
+import bs.simreads as sr
+import bs.truthvcf as tv
+import bs.metrics as mx
 from collections import Counter
+from cStringIO import StringIO
 
-def remap(fq1, fq2, threads, bwaref, outbam):
-    """ call bwa/samtools to remap .bam and merge with existing .bam
+def remap(fq1, fq2, threads, bwaref, outbam, tmpdir='.', aligner=None):
+    """ remap .fq files to a sorted .bam (outbam), temporary files go in tmpdir,
+        aligner is an optional command template (see bs/aligner.py)
     """
-    basefn = "bwatmp" + str(random.random())
-    sai1fn = basefn + ".1.sai"
-    sai2fn = basefn + ".2.sai"
-    samfn  = basefn + ".sam"
-    refidx = bwaref + ".fai"
-    tmpbam = basefn + ".bam"
-    tmpsrt = basefn + ".sort"
-
-    sai1args = ['bwa', 'aln', bwaref, '-q', '5', '-l', '32', '-k', '2', '-t', str(threads), '-o', '1', '-f', sai1fn, fq1]
-    sai2args = ['bwa', 'aln', bwaref, '-q', '5', '-l', '32', '-k', '2', '-t', str(threads), '-o', '1', '-f', sai2fn, fq2]
-    samargs  = ['bwa', 'sampe', '-P', '-f', samfn, bwaref, sai1fn, sai2fn, fq1, fq2]
-    bamargs  = ['samtools', 'view', '-bt', refidx, '-o', tmpbam, samfn]
-    sortargs = ['samtools', 'sort', tmpbam, tmpsrt]
-
-    print "mapping 1st end, cmd: " + " ".join(sai1args)
-    subprocess.call(sai1args)
-    print "mapping 2nd end, cmd: " + " ".join(sai2args)
-    subprocess.call(sai2args)
-    print "pairing ends, building .sam, cmd: " + " ".join(samargs)
-    subprocess.call(samargs)
-    print "sam --> bam, cmd: " + " ".join(bamargs)
-    subprocess.call(bamargs)
-    print "sorting, cmd: " + " ".join(sortargs)
-    subprocess.call(sortargs)
-    print "rename " + tmpsrt + ".bam --> " + tmpbam
-    os.remove(tmpbam)
-    os.rename(tmpsrt + ".bam", tmpbam)
-
-    if os.path.isfile(outbam):
-        tmpmerge  = basefn + ".merge.bam"
-        mergeargs = ['samtools','merge',tmpmerge,tmpbam,outbam]
-        print outbam + " exists, merging: " + " ".join(mergeargs)
-        subprocess.call(mergeargs)
-        os.remove(outbam)
-        os.remove(tmpbam)
-        print "rename " + tmpmerge + " --> " + outbam
-        os.rename(tmpmerge, outbam)
-    else:
-        print "rename " + tmpbam + " --> " + outbam
-        os.rename(tmpbam, outbam)
+    alnopts = ['-q', '5', '-l', '32', '-k', '2', '-o', '1']
+    al.align(fq1, fq2, bwaref, outbam, threads=threads, aligner=aligner, alnopts=alnopts, tmpdir=tmpdir)
 
     # cleanup
-    os.remove(sai1fn)
-    os.remove(sai2fn)
-    os.remove(samfn)
     os.remove(fq1)
     os.remove(fq2)
 
-def runwgsim(contig,newseq,svfrac,exclude):
-    ''' wrapper function for wgsim
+def remappairs(pairs, threads, bwaref, outbam, tmpdir='.', aligner=None):
+    """ remap fastq pairs (from simpairs()) to a sorted .bam (outbam). If the aligner template
+        has no {fq1}/{fq2} the pairs are streamed to it as interleaved fastq on stdin
+    """
+    if aligner and '{fq1}' not in aligner:
+        al.align(None, None, bwaref, outbam, threads=threads, aligner=aligner, tmpdir=tmpdir, stdin=sr.interleaved(pairs))
+    else:
+        fq1 = outbam + ".1.fq"
+        fq2 = outbam + ".2.fq"
+        sr.writeFastq(pairs, fq1, fq2)
+        remap(fq1, fq2, threads, bwaref, outbam, tmpdir, aligner)
+
+def mergebams(bamlist, outbamfn, tmpdir='.', maxfiles=500):
+    """ merge sorted .bams in bamlist into outbamfn with a single samtools merge
+        (in groups of maxfiles to stay under open file limits), removes the inputs
+    """
+    if len(bamlist) == 1:
+        print "rename " + bamlist[0] + " --> " + outbamfn
+        os.rename(bamlist[0], outbamfn)
+        return
+
+    if len(bamlist) > maxfiles:
+        groups = []
+        for i in range(0, len(bamlist), maxfiles):
+            groupfn = os.path.join(tmpdir, "mergegroup" + str(len(groups)) + ".bam")
+            mergebams(bamlist[i:i+maxfiles], groupfn, tmpdir, maxfiles)
+            groups.append(groupfn)
+        bamlist = groups
+
+    args = ['samtools','merge','-f',outbamfn] + bamlist
+    print "merging " + str(len(bamlist)) + " .bams, cmd: " + " ".join(args[:4]) + " ..."
+    mx.call(args, stage='merge')
+
+    for bamfile in bamlist:
+        os.remove(bamfile)
+
+def simcounts(contig,newseq,svfrac):
+    ''' returns (names of pairs with both reads in the contig, number of pairs to simulate, read length)
     '''
     namecount = Counter(contig.reads.reads)
 
-    basefn = "wgsimtmp" + str(random.random())
-    fasta = basefn + ".fasta"
-    fq1 = basefn + ".1.fq"
-    fq2 = basefn + ".2.fq"
-
-    fout = open(fasta,'w')
-    fout.write(">target\n" + newseq + "\n")
-    fout.close()
-
     totalreads = len(contig.reads.reads)
     paired = 0
     single = 0
@@ -113,9 +108,28 @@ def runwgsim(contig,newseq,svfrac,exclude):
         if len(qual) > maxqlen:
             maxqlen = len(qual)
 
-    args = ['wgsim','-e','0','-N',str(nsimreads),'-1',str(maxqlen),'-2','100','-r','0','-R','0',fasta,fq1,fq2]
+    return (pairednames, nsimreads, maxqlen)
+
+def runwgsim(contig,newseq,svfrac,exclude,tmpdir='.'):
+    ''' wrapper function for wgsim, temporary files go in tmpdir
+    '''
+    basefn = os.path.join(tmpdir, "wgsimtmp" + str(random.random()))
+    fasta = basefn + ".fasta"
+    fq1 = basefn + ".1.fq"
+    fq2 = basefn + ".2.fq"
+
+    fout = open(fasta,'w')
+    fout.write(">target\n" + newseq + "\n")
+    fout.close()
+
+    (pairednames, nsimreads, maxqlen) = simcounts(contig,newseq,svfrac)
+
+    # wgsim seed comes from our random state so runs with --seed are reproducible
+    wgsimseed = random.randint(1, 2147483647)
+
+    args = ['wgsim','-e','0','-N',str(nsimreads),'-1',str(maxqlen),'-2','100','-r','0','-R','0','-S',str(wgsimseed),fasta,fq1,fq2]
     print args
-    subprocess.call(args)
+    mx.call(args, stage='simulate')
 
     os.remove(fasta)
 
@@ -124,6 +138,43 @@ def runwgsim(contig,newseq,svfrac,exclude):
 
     return (fq1,fq2)
 
+def simpairs(contig,newseq,svfrac,exclude):
+    ''' simulate read pairs from newseq in memory (bs/simreads.py) and name them after read pairs
+        in the contig, like runwgsim() + fqReplaceList(). Returns a generator over fastq entries
+        (read 1, read 2). 'exclude' is a filehandle
+    '''
+    (pairednames, nsimreads, maxqlen) = simcounts(contig,newseq,svfrac)
+
+    (reads1, reads2, starts, ends) = sr.simulate(newseq, nsimreads, maxqlen, maxqlen, seed=random.randint(0,4294967295))
+
+    # original names until the list runs out, then simulated names
+    names = pairednames[:len(reads1)]
+    for i in range(len(names), len(reads1)):
+        names.append("target_%d_%d_%x" % (starts[i]+1, ends[i], i))
+
+    # make sure there's enough (bogus) quality scores
+    rquals = list(contig.rquals)
+    mquals = list(contig.mquals)
+    for quals in (rquals, mquals):
+        while len(reads1) > len(quals):
+            quals.append(quals[random.randint(0,len(quals)-1)])
+        del quals[len(reads1):] # one per simulated pair, null pairs get their own below
+
+    # burn off excess names with null pairs so they still replace reads in the original .bam
+    if len(reads1) > 0:
+        nullseq  = 'N'*maxqlen
+        nullqual = '#'*maxqlen
+        for name in pairednames[len(reads1):]:
+            if random.uniform(0,1) < svfrac:
+                names.append(name)
+                reads1.append(nullseq)
+                reads2.append(nullseq)
+                rquals.append(nullqual)
+                mquals.append(nullqual)
+                exclude.write(name + "\n")
+
+    return sr.fastqPairs(names, reads1, reads2, rquals, mquals)
+
 def fqReplaceList(fqfile,names,quals,svfrac,exclude):
     """
     Replace seq names in paired fastq files from a list until the list runs out
@@ -203,195 +254,316 @@ def singleseqfa(file):
             seq += line.strip().upper()
     return seq
 
-def replace(origbamfile, mutbamfile, outbamfile, excludefile):
+def replace(origbamfile, mutbamfile, outbamfile, excludefile, procs=1, threads=1, level=None):
     ''' open .bam file and call replacereads
+        origbamfile (sorted and indexed) is processed in per-contig shards if procs > 1
     '''
-    origbam = pysam.Samfile(origbamfile, 'rb')
-    mutbam  = pysam.Samfile(mutbamfile, 'rb')
-    outbam  = pysam.Samfile(outbamfile, 'wb', template=origbam)
+    rr.replaceBams(origbamfile, mutbamfile, outbamfile, excludefile=excludefile, allreads=True, procs=procs, threads=threads, level=level)
+
+class SVSite:
+    """ one SV interval from the input, carries results back from worker processes
+        (plain attributes so it can be pickled)
+    """
+    def __init__(self, index, bedline):
+        self.index   = index # line number in input, used for ordering and seeding
+        self.bedline = bedline
+        self.mutated = False
+        self.bam     = None # sorted .bam of remapped reads
+        self.exclude = '' # excluded read names, one per line
+        self.vcf     = [] # truth VCF records
+        self.log     = [] # lines for the .log file, written by main() in input order
+
+def mutatesv(args, sv, reffile, cnv, tmpdir, asmcache=None):
+    """ assemble the interval, make the mutation(s) in the largest contig, simulate and
+        remap reads. Temporary files go in tmpdir, asmcache is an optional ar.AsmCache.
+    """
+    c = sv.bedline.strip().split()
+    chrom    = c[0]
+    start  = int(c[1])
+    end    = int(c[2])
+    araw   = c[3:len(c)] # INV, DEL, INS seqfile.fa TSDlength, DUP
+    actions = map(lambda x: x.strip(),' '.join(araw).split(','))
+
+    svfrac = float(args.svfrac) # default, can be overridden by cnv file
+
+    if cnv: # CNV file is present
+        if chrom in cnv.contigs:
+            for cnregion in cnv.fetch(chrom,start,end):
+                cn = float(cnregion.strip().split()[3]) # expect chrom,start,end,CN
+                sys.stderr.write(' '.join(("copy number in snp region:",chrom,str(start),str(end),"=",str(cn))) + "\n")
+                svfrac = 1.0/float(cn)
+                sys.stderr.write("adjusted MAF: " + str(svfrac) + "\n")
+
+    print "interval:",c
+    # modify start and end if interval is too long
+    maxctglen = int(args.maxctglen)
+    assert maxctglen > 3*int(args.maxlibsize) # maxctglen is too short
+    if end-start > maxctglen:
+        adj   = (end-start) - maxctglen
+        rndpt = random.randint(0,adj)
+        start = start + rndpt
+        end   = end - (adj-rndpt)
+        print "note: interval size too long, adjusted:",chrom,start,end
+
+    with mx.stage('assemble', site=sv.index):
+        contigs = ar.asm(chrom, start, end, args.bamFileName, reffile, int(args.kmersize), args.noref, args.recycle, workdir=tmpdir, cache=asmcache)
+
+    # find the largest contig        
+    maxlen = 0
+    maxcontig = None
+    for contig in contigs:
+        if contig.len > maxlen:
+            maxlen = contig.len
+            maxcontig = contig
+
+    # is there anough room to make mutations?
+    if maxlen > 3*int(args.maxlibsize):
+        # make mutation in the largest contig
+        mutseq = ms.MutableSeq(maxcontig.seq)
+
+        # if we're this far along, we're making a mutation
+        sv.mutated = True
+
+        # support for multiple mutations
+        for actionstr in actions:
+            a = actionstr.split()
+            action = a[0]
+
+            print actionstr,action
+
+            insseqfile = None
+            insseq = ''
+            tsdlen = 0  # target site duplication length
+            ndups = 0   # number of tandem dups
+            dsize = 0.0 # deletion size fraction
+            dlen = 0
+            if action == 'INS':
+                assert len(a) > 1 # insertion syntax: INS <file.fa> [optional TSDlen]
+                insseqfile = a[1]
+                if not os.path.exists(insseqfile): # not a file... is it a sequence? (support indel ins.)
+                    assert re.search('^[ATGCatgc]*$',insseqfile) # make sure it's a sequence
+                    insseq = insseqfile.upper()
+                    insseqfile = None
+                if len(a) > 2:
+                    tsdlen = int(a[2])
+
+            if action == 'DUP':
+                if len(a) > 1:
+                    ndups = int(a[1])
+                else:
+                    ndups = 1
+
+            if action == 'DEL':
+                if len(a) > 1:
+                    dsize = float(a[1])
+                    if dsize >= 1.0: # if DEL size is not a fraction, interpret as bp
+                        # since DEL 1 is default, if DEL 1 is specified, interpret as 1 bp deletion
+                        dlen = int(dsize)
+                        dsize = 1.0
+                else:
+                    dsize = 1.0
+
+            print "BEFORE:",mutseq
+
+            if action == 'INS':
+                if insseqfile: # seq in file
+                    mutseq.insertion(mutseq.length()/2,singleseqfa(insseqfile),tsdlen)
+                else: # seq is input
+                    mutseq.insertion(mutseq.length()/2,insseq,tsdlen)
+                sv.log.append("\t".join(('ins',chrom,str(start),str(end),action,str(mutseq.length()),str(mutseq.length()/2),str(insseqfile),str(tsdlen))) + "\n")
+
+            elif action == 'INV':
+                invstart = int(args.maxlibsize)
+                invend = mutseq.length() - invstart
+                mutseq.inversion(invstart,invend)
+                sv.log.append("\t".join(('inv',chrom,str(start),str(end),action,str(mutseq.length()),str(invstart),str(invend))) + "\n")
+
+            elif action == 'DEL':
+                delstart = int(args.maxlibsize)
+                delend = mutseq.length() - delstart
+                if dlen == 0: # bp size not specified, delete fraction of contig
+                    dlen = int((float(delend-delstart) * dsize)+0.5) 
+
+                dadj = delend-delstart-dlen
+                if dadj < 0:
+                    dadj = 0
+                    print "warning: deletion of length 0"
+
+                delstart += dadj/2
+                delend   -= dadj/2
+
+                mutseq.deletion(delstart,delend)
+                sv.log.append("\t".join(('del',chrom,str(start),str(end),action,str(mutseq.length()),str(delstart),str(delend),str(dlen))) + "\n")
+
+            elif action == 'DUP':
+                dupstart = int(args.maxlibsize)
+                dupend = mutseq.length() - dupstart
+                mutseq.duplication(dupstart,dupend,ndups)
+                sv.log.append("\t".join(('dup',chrom,str(start),str(end),action,str(mutseq.length()),str(dupstart),str(dupend),str(ndups))) + "\n")
 
-    rr.replaceReads(origbam, mutbam, outbam, excludefile=excludefile, allreads=True)
+            else:
+                raise ValueError(sv.bedline.strip() + ": mutation not one of: INS,INV,DEL,DUP")
 
-    origbam.close()
-    mutbam.close()
-    outbam.close()
+            print "AFTER:",mutseq
 
-def main(args):
-    """ needs refactoring
+        # place the edits on the genome for the truth VCF
+        pad = int(args.maxlibsize)
+        location = tv.locateContig(reffile, chrom, max(0,start-pad), end+pad, maxcontig.seq)
+        if location is not None:
+            sv.vcf = tv.svRecords(reffile, chrom, location, len(maxcontig.seq), mutseq, svfrac)
+        else:
+            print "warning: could not place contig on reference, no truth VCF record for:",sv.bedline.strip()
+
+        sv.bam = os.path.join(tmpdir, "sv" + str(sv.index) + ".bam")
+        exclude = StringIO()
+
+        # simulate and remap reads
+        if args.wgsim:
+            with mx.stage('simulate', site=sv.index):
+                (fq1, fq2) = runwgsim(maxcontig, mutseq.seq, svfrac, exclude, tmpdir)
+            with mx.stage('remap', site=sv.index):
+                remap(fq1, fq2, 4, args.refFasta, sv.bam, tmpdir, args.aligner)
+        else:
+            with mx.stage('simulate', site=sv.index):
+                pairs = simpairs(maxcontig, mutseq.seq, svfrac, exclude)
+            with mx.stage('remap', site=sv.index):
+                remappairs(pairs, 4, args.refFasta, sv.bam, tmpdir, args.aligner)
+        mx.filesize('remapped_bam', sv.bam)
+
+        sv.exclude = exclude.getvalue()
+
+    else:
+        print "best contig too short to make mutation: ",sv.bedline.strip()
+
+    return sv
+
+# per-process state for runsv(), set up by initsv()
+_handles = {}
+
+def initsv(args, tmpdir):
+    """ open input files and a private temporary directory for the current process,
+        run once per worker (or once in main() if running serially)
     """
-    varfile = open(args.varFileName, 'r')
-    bamfile = pysam.Samfile(args.bamFileName, 'rb')
-    reffile = pysam.Fastafile(args.refFasta)
-    logfile = open(args.outBamFile + ".log", 'w')
-    exclude = open(args.exclfile, 'w')
+    _handles['args']    = args
+    _handles['reffile'] = pysam.Fastafile(args.refFasta)
+    _handles['tmpdir']  = os.path.abspath(tempfile.mkdtemp(dir=tmpdir))
+
+    # optional assembly cache
+    _handles['asmcache'] = None
+    if args.asmcache:
+        _handles['asmcache'] = ar.AsmCache(args.asmcache, int(args.asmcachesize)*1024*1024)
 
     # optional CNV file
-    cnv = None
+    _handles['cnv'] = None
     if (args.cnvfile):
-        cnv = pysam.Tabixfile(args.cnvfile, 'r')
-
-    # temporary file to hold mutated reads
-    outbam_mutsfile = "tmp." + str(random.random()) + ".muts.bam"
+        _handles['cnv'] = pysam.Tabixfile(args.cnvfile, 'r')
 
-    nmuts = 0
+    # forked workers inherit the parent's random state
+    if args.seed is None:
+        random.seed()
 
-    for bedline in varfile:
-        if re.search('^#',bedline):
-            continue
-   
-        if args.maxmuts and nmuts >= int(args.maxmuts):
-            break
- 
-        c = bedline.strip().split()
-        chrom    = c[0]
-        start  = int(c[1])
-        end    = int(c[2])
-        araw   = c[3:len(c)] # INV, DEL, INS seqfile.fa TSDlength, DUP
-        actions = map(lambda x: x.strip(),' '.join(araw).split(','))
-
-        svfrac = float(args.svfrac) # default, can be overridden by cnv file
-
-        if cnv: # CNV file is present
-            if chrom in cnv.contigs:
-                for cnregion in cnv.fetch(chrom,start,end):
-                    cn = float(cnregion.strip().split()[3]) # expect chrom,start,end,CN
-                    sys.stderr.write(' '.join(("copy number in snp region:",chrom,str(start),str(end),"=",str(cn))) + "\n")
-                    svfrac = 1.0/float(cn)
-                    sys.stderr.write("adjusted MAF: " + str(svfrac) + "\n")
-
-        print "interval:",c
-        # modify start and end if interval is too long
-        maxctglen = int(args.maxctglen)
-        assert maxctglen > 3*int(args.maxlibsize) # maxctglen is too short
-        if end-start > maxctglen:
-            adj   = (end-start) - maxctglen
-            rndpt = random.randint(0,adj)
-            start = start + rndpt
-            end   = end - (adj-rndpt)
-            print "note: interval size too long, adjusted:",chrom,start,end
-
-        contigs = ar.asm(chrom, start, end, args.bamFileName, reffile, int(args.kmersize), args.noref, args.recycle)
-
-        # find the largest contig        
-        maxlen = 0
-        maxcontig = None
-        for contig in contigs:
-            if contig.len > maxlen:
-                maxlen = contig.len
-                maxcontig = contig
-
-        # is there anough room to make mutations?
-        if maxlen > 3*int(args.maxlibsize):
-            # make mutation in the largest contig
-            mutseq = ms.MutableSeq(maxcontig.seq)
-
-            # if we're this far along, we're making a mutation
-            nmuts += 1 
-
-            # support for multiple mutations
-            for actionstr in actions:
-                a = actionstr.split()
-                action = a[0]
-
-                print actionstr,action
-
-                insseqfile = None
-                insseq = ''
-                tsdlen = 0  # target site duplication length
-                ndups = 0   # number of tandem dups
-                dsize = 0.0 # deletion size fraction
-                dlen = 0
-                if action == 'INS':
-                    assert len(a) > 1 # insertion syntax: INS <file.fa> [optional TSDlen]
-                    insseqfile = a[1]
-                    if not os.path.exists(insseqfile): # not a file... is it a sequence? (support indel ins.)
-                        assert re.search('^[ATGCatgc]*$',insseqfile) # make sure it's a sequence
-                        insseq = insseqfile.upper()
-                        insseqfile = None
-                    if len(a) > 2:
-                        tsdlen = int(a[2])
-
-                if action == 'DUP':
-                    if len(a) > 1:
-                        ndups = int(a[1])
-                    else:
-                        ndups = 1
-
-                if action == 'DEL':
-                    if len(a) > 1:
-                        dsize = float(a[1])
-                        if dsize >= 1.0: # if DEL size is not a fraction, interpret as bp
-                            # since DEL 1 is default, if DEL 1 is specified, interpret as 1 bp deletion
-                            dlen = int(dsize)
-                            dsize = 1.0
-                    else:
-                        dsize = 1.0
+def closesv():
+    for name in ('reffile', 'cnv'):
+        if _handles.get(name) is not None:
+            _handles[name].close()
+    _handles.clear()
 
-                print "BEFORE:",mutseq
+def runsv(job):
+    """ build one SV, job is (line number, bed line)
+    """
+    (index, bedline) = job
+    if re.search('^#',bedline):
+        return None
 
-                if action == 'INS':
-                    if insseqfile: # seq in file
-                        mutseq.insertion(mutseq.length()/2,singleseqfa(insseqfile),tsdlen)
-                    else: # seq is input
-                        mutseq.insertion(mutseq.length()/2,insseq,tsdlen)
-                    logfile.write("\t".join(('ins',chrom,str(start),str(end),action,str(mutseq.length()),str(mutseq.length()/2),str(insseqfile),str(tsdlen))) + "\n")
+    args = _handles['args']
 
-                elif action == 'INV':
-                    invstart = int(args.maxlibsize)
-                    invend = mutseq.length() - invstart
-                    mutseq.inversion(invstart,invend)
-                    logfile.write("\t".join(('inv',chrom,str(start),str(end),action,str(mutseq.length()),str(invstart),str(invend))) + "\n")
+    # seed per interval so results don't depend on which process handles it
+    if args.seed is not None:
+        random.seed(int(args.seed) + index)
 
-                elif action == 'DEL':
-                    delstart = int(args.maxlibsize)
-                    delend = mutseq.length() - delstart
-                    if dlen == 0: # bp size not specified, delete fraction of contig
-                        dlen = int((float(delend-delstart) * dsize)+0.5) 
+    return mutatesv(args, SVSite(index, bedline), _handles['reffile'], _handles['cnv'], _handles['tmpdir'], _handles['asmcache'])
 
-                    dadj = delend-delstart-dlen
-                    if dadj < 0:
-                        dadj = 0
-                        print "warning: deletion of length 0"
+def main(args):
+    """ build SVs from the input intervals (in parallel if --procs > 1), results are
+        collected in input order
+    """
+    mx.configure(args.metrics) # before starting workers, they append to the same file
+    varfile = open(args.varFileName, 'r')
+    bamfile = pysam.Samfile(args.bamFileName, 'rb')
+    logfile = open(args.outBamFile + ".log", 'w')
+    exclude = open(args.exclfile, 'w')
+    truth   = tv.TruthVCF(args.refFasta)
 
-                    delstart += dadj/2
-                    delend   -= dadj/2
+    # temporary file to hold mutated reads
+    outbam_mutsfile = "tmp." + str(random.random()) + ".muts.bam"
 
-                    mutseq.deletion(delstart,delend)
-                    logfile.write("\t".join(('del',chrom,str(start),str(end),action,str(mutseq.length()),str(delstart),str(delend),str(dlen))) + "\n")
+    # per-SV temporary files go here, one subdirectory per process
+    tmpdir = tempfile.mkdtemp(prefix='addsv.', dir='.')
 
-                elif action == 'DUP':
-                    dupstart = int(args.maxlibsize)
-                    dupend = mutseq.length() - dupstart
-                    mutseq.duplication(dupstart,dupend,ndups)
-                    logfile.write("\t".join(('dup',chrom,str(start),str(end),action,str(mutseq.length()),str(dupstart),str(dupend),str(ndups))) + "\n")
+    procs = int(args.procs)
 
-                else:
-                    raise ValueError(bedline.strip() + ": mutation not one of: INS,INV,DEL,DUP")
+    pool = None
+    if procs > 1:
+        pool = multiprocessing.Pool(processes=procs, initializer=initsv, initargs=(args, tmpdir))
+        svs = pool.imap(runsv, enumerate(varfile))
+    else:
+        initsv(args, tmpdir)
+        svs = itertools.imap(runsv, enumerate(varfile))
 
-                print "AFTER:",mutseq
+    nmuts = 0
+    svbams = [] # sorted .bam of remapped reads per SV, merged once at the end
+    finished = True
+    for sv in svs:
+        if sv is None or not sv.mutated:
+            continue
 
-            # simulate reads
-            (fq1, fq2) = runwgsim(maxcontig, mutseq.seq, svfrac, exclude)
+        nmuts += 1
+        mx.count('svs_made')
+        for line in sv.log:
+            logfile.write(line)
+        exclude.write(sv.exclude)
+        truth.add(sv.vcf)
+        svbams.append(sv.bam)
 
-            # remap reads
-            remap(fq1, fq2, 4, args.refFasta, outbam_mutsfile)
+        if args.maxmuts and nmuts >= int(args.maxmuts):
+            finished = False
+            break
 
-        else:
-            print "best contig too short to make mutation: ",bedline.strip()
+    if pool is not None:
+        if finished:
+            pool.close()
+        else: # have enough mutations, drop intervals still in progress
+            pool.terminate()
+        pool.join()
+    else:
+        closesv()
 
     print "addsv.py finished, made", nmuts, "mutations."
 
+    if svbams:
+        with mx.stage('merge'):
+            mergebams(svbams, outbam_mutsfile, tmpdir)
+
     exclude.close()
     varfile.close()
     bamfile.close()
     logfile.close()
+    shutil.rmtree(tmpdir)
+    print "truth VCF:", truth.write(args.outBamFile + ".truth.vcf")
 
     print "merging mutations into", args.bamFileName, "-->", args.outBamFile
-    replace(args.bamFileName, outbam_mutsfile, args.outBamFile, args.exclfile)
+    with mx.stage('replace'):
+        replaceprocs = 1
+        if args.shardreplace:
+            replaceprocs = procs
+        replace(args.bamFileName, outbam_mutsfile, args.outBamFile, args.exclfile, procs=replaceprocs, threads=int(args.threads), level=args.complevel)
 
     # cleanup
     os.remove(outbam_mutsfile)
 
+    if args.metrics:
+        mx.summary()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='adds SNVs to reads, outputs modified reads as .bam along with mates')
     parser.add_argument('-v', '--varfile', dest='varFileName', required=True,
@@ -420,6 +592,32 @@ if __name__ == '__main__':
     parser.add_argument('--noref', action='store_true', default=False, 
                         help="do not perform reference based assembly")
     parser.add_argument('--recycle', action='store_true', default=False)
+    parser.add_argument('--asmcache', dest='asmcache', default=None,
+                        help="directory for caching assemblies between runs on the same .bam (e.g. with different --svfrac or actions)")
+    parser.add_argument('--asmcachesize', dest='asmcachesize', default=1024,
+                        help="maximum size of --asmcache in Mb, least recently used assemblies are removed (default = 1024)")
+    parser.add_argument('-p', '--procs', dest='procs', default=1,
+                        help="number of SV intervals to build in parallel (and processes for the final read replacement with --shardreplace) (default = 1)")
+    parser.add_argument('--seed', dest='seed', default=None,
+                        help="random seed, results for a given seed do not depend on --procs")
+    parser.add_argument('--aligner', dest='aligner', default=None,
+                        help="aligner command writing SAM to stdout, e.g. 'bwa mem -t {threads} {ref} {fq1} {fq2}' (default: bwa aln/sampe). "
+                        + "Without {fq1}/{fq2}, simulated pairs are streamed as interleaved fastq on stdin, e.g. 'bwa mem -p {ref} -'")
+    parser.add_argument('--wgsim', action='store_true', default=False,
+                        help="simulate reads with wgsim instead of the built-in simulator")
+    parser.add_argument('--shardreplace', action='store_true', default=False,
+                        help="replace reads in per-contig shards of the (sorted, indexed) input .bam using --procs processes when writing output")
+    parser.add_argument('--threads', dest='threads', default=1,
+                        help="threads for BGZF compression/decompression of the output .bam (default = 1)")
+    parser.add_argument('--complevel', dest='complevel', default=None,
+                        help="compression level for the output .bam (0-9, default = 6)")
+    parser.add_argument('--metrics', dest='metrics', default=None,
+                        help="write per-SV stage timings, subprocess exit codes and read counts to this file (JSON lines) and print a summary at the end")
+    parser.add_argument('--profile', dest='profile', default=None,
+                        help="run the main process under cProfile and save stats to this file")
     args = parser.parse_args()
-    main(args)
+    if args.profile:
+        mx.profile(main, args, args.profile)
+    else:
+        main(args)
 
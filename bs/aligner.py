@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+'''
+Remap paired reads to the reference: aligner output is piped through samtools view
+and samtools sort, so no .sam or unsorted .bam is written to disk. The default
+aligner is bwa aln/sampe, any aligner that writes SAM to stdout can be given as a
+command template, e.g. 'bwa mem -t {threads} {ref} {fq1} {fq2}'
+'''
+
+import os,sys,time,shlex,subprocess,tempfile
+import pysam
+import mutableseq
+import metrics
+
+def fastqRecord(read):
+    ''' fastq entry for read in its original (sequenced) orientation '''
+    seq  = read.seq
+    qual = read.qual
+    if read.is_reverse:
+        seq  = mutableseq.rc(seq)
+        qual = qual[::-1]
+    return "@" + read.qname + "\n" + seq + "\n+\n" + qual + "\n"
+
+def bamToFastq(bamfn, fq1, fq2):
+    ''' write read pairs from bamfn to fq1/fq2, reads without a mate in bamfn are skipped.
+        Returns number of pairs written.
+    '''
+    bam = pysam.Samfile(bamfn, 'rb')
+    out1 = open(fq1, 'w')
+    out2 = open(fq2, 'w')
+    pending = {}
+    npairs = 0
+    for read in bam.fetch(until_eof=True):
+        if read.is_secondary or not read.is_paired:
+            continue
+        mate = pending.pop(read.qname, None)
+        if mate is None:
+            pending[read.qname] = read
+            continue
+        if read.is_read1:
+            (read1, read2) = (read, mate)
+        else:
+            (read1, read2) = (mate, read)
+        out1.write(fastqRecord(read1))
+        out2.write(fastqRecord(read2))
+        npairs += 1
+    out1.close()
+    out2.close()
+    bam.close()
+    if pending:
+        sys.stderr.write("bamToFastq: skipped " + str(len(pending)) + " reads without mates in " + bamfn + "\n")
+    return npairs
+
+def templateArgs(template, bwaref, fq1, fq2, threads):
+    ''' fill in an aligner command template: {ref}, {fq1}, {fq2} and {threads} '''
+    return shlex.split(template.format(ref=bwaref, fq1=fq1, fq2=fq2, threads=threads))
+
+def popen(args, **kwargs):
+    ''' subprocess.Popen(args) with its start time, so wait() can record how long it ran '''
+    proc = subprocess.Popen(args, **kwargs)
+    proc.started = time.time()
+    return proc
+
+def run(args):
+    print "cmd: " + " ".join(args)
+    return popen(args)
+
+def wait(procs):
+    ''' wait for a list of (args, Popen) and raise ValueError if any of them failed '''
+    failed = []
+    for (args, proc) in procs:
+        returncode = proc.wait()
+        metrics.called(args, returncode, time.time()-proc.started, stage='align')
+        if returncode != 0:
+            failed.append(" ".join(args))
+    if failed:
+        raise ValueError("alignment step(s) failed: " + "; ".join(failed))
+
+def align(reads1, reads2, bwaref, outbam, threads=4, aligner=None, alnopts=None, bam=False, sortmem=None, index=False, tmpdir=None, stdin=None):
+    '''
+    align read pairs in reads1/reads2 (fastq) to bwaref and write a sorted .bam to outbam.
+    If bam is True, reads1 and reads2 are the same .bam file. aligner is a command template
+    (see templateArgs()) for an aligner writing SAM to stdout, if None both ends are aligned
+    with bwa aln (at the same time, with options alnopts) and paired by bwa sampe.
+    Temporary files (.sai, or fastq if aligner is given and the input is .bam) go in tmpdir.
+    If stdin is given (an iterable of strings, e.g. interleaved fastq) it is written to the
+    aligner's standard input, reads1/reads2 are not used and aligner must be given.
+    '''
+    if tmpdir is None:
+        tmpdir = os.path.dirname(os.path.abspath(outbam))
+    basefn = tempfile.mktemp(prefix='align.', dir=tmpdir)
+    refidx = bwaref + ".fai"
+    tmpfiles = []
+
+    if stdin is not None:
+        if not aligner:
+            raise ValueError("aligner command template required to align reads from stdin")
+        samargs = templateArgs(aligner, bwaref, '-', '-', threads)
+
+    elif aligner:
+        if bam:
+            (fq1, fq2) = (basefn + ".1.fq", basefn + ".2.fq")
+            tmpfiles += [fq1, fq2]
+            bamToFastq(reads1, fq1, fq2)
+            (reads1, reads2) = (fq1, fq2)
+        samargs = templateArgs(aligner, bwaref, reads1, reads2, threads)
+
+    else:
+        if alnopts is None:
+            alnopts = ['-q', '5', '-l', '32', '-k', '2', '-o', '1']
+        sai1fn = basefn + ".1.sai"
+        sai2fn = basefn + ".2.sai"
+        tmpfiles += [sai1fn, sai2fn]
+        sai1args = ['bwa', 'aln', bwaref] + alnopts + ['-t', str(threads), '-f', sai1fn]
+        sai2args = ['bwa', 'aln', bwaref] + alnopts + ['-t', str(threads), '-f', sai2fn]
+        if bam:
+            sai1args += ['-b1', reads1]
+            sai2args += ['-b2', reads2]
+        else:
+            sai1args.append(reads1)
+            sai2args.append(reads2)
+
+        # sampe needs both .sai files, so the two ends are aligned at the same time
+        print "mapping both ends"
+        wait([(sai1args, run(sai1args)), (sai2args, run(sai2args))])
+        samargs = ['bwa', 'sampe', '-P', bwaref, sai1fn, sai2fn, reads1, reads2]
+
+    # aligner | samtools view (uncompressed .bam) | samtools sort
+    sortbase = basefn + ".sort"
+    viewargs = ['samtools', 'view', '-bSu', '-t', refidx, '-']
+    sortargs = ['samtools', 'sort']
+    if sortmem:
+        sortargs += ['-m', str(sortmem)]
+    sortargs += ['-', sortbase]
+
+    print "aligning, cmd: " + " ".join(samargs) + " | " + " ".join(viewargs) + " | " + " ".join(sortargs)
+    saminput = None
+    if stdin is not None:
+        saminput = subprocess.PIPE
+    sam  = popen(samargs, stdin=saminput, stdout=subprocess.PIPE)
+    view = popen(viewargs, stdin=sam.stdout, stdout=subprocess.PIPE)
+    sam.stdout.close() # so the aligner gets SIGPIPE if samtools exits
+    sort = popen(sortargs, stdin=view.stdout)
+    view.stdout.close()
+
+    if stdin is not None:
+        for data in stdin:
+            sam.stdin.write(data)
+        sam.stdin.close()
+    wait([(samargs, sam), (viewargs, view), (sortargs, sort)])
+
+    print "rename " + sortbase + ".bam --> " + outbam
+    os.rename(sortbase + ".bam", outbam)
+
+    if index:
+        indexargs = ['samtools','index',outbam]
+        print "indexing, cmd: " + " ".join(indexargs)
+        metrics.call(indexargs, stage='align')
+
+    # cleanup
+    for fn in tmpfiles:
+        if os.path.exists(fn):
+            os.remove(fn)
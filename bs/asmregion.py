@@ -4,11 +4,14 @@
 try to do ref-directed assembly for paired reads in a region of a .bam file
 """
 
-import pysam,tempfile,argparse,subprocess,sys,shutil,os,re
+import pysam,tempfile,argparse,sys,shutil,os,re,hashlib,cPickle
 import parseamos
+import mates
+import metrics
 
 def velvetContigs(dir):
     assert os.path.exists(dir)
+    readmap = ContigReadMap(dir) # parse assembly output once, shared by all contigs
     fh = open(dir + "/contigs.fa", 'r')
     contigs = []
     name = None
@@ -16,7 +19,7 @@ def velvetContigs(dir):
     for line in fh:
         if re.search("^>", line):
             if name and seq:
-                contigs.append(Contig(name,seq,dir))
+                contigs.append(Contig(name,seq,readmap))
             name = line.lstrip('>').strip()
             seq = ''
         else:
@@ -25,30 +28,58 @@ def velvetContigs(dir):
             else:
                 raise ValueError("invalid fasta format: " + fastaFile)
     if name and seq:
-        contigs.append(Contig(name,seq,dir))
+        contigs.append(Contig(name,seq,readmap))
     return contigs
 
-class Contig:
-    def __init__(self,name,seq,dir):
+class ContigReadMap:
+    '''
+    contig eid --> parseamos.ContigReads for one velvet run. velvet_asm.afg and Sequences are read
+    once (before the velvet directory is removed), read names are looked up on first use of a contig
+    '''
+    def __init__(self,dir):
+        self.inseq = parseamos.InputSeqs(dir + "/Sequences")
+        self.contigs = parseamos.contigreadmap(dir + "/velvet_asm.afg", self.inseq, resolve=False)
+        self.resolved = {}
+
+    def reads(self,eid):
+        contig = self.contigs[eid]
+        if eid not in self.resolved:
+            contig.getReadNames(self.inseq)
+            self.resolved[eid] = True
+        return contig
+
+class Contig(object):
+    def __init__(self,name,seq,readmap):
         self.name = name
         self.seq = seq
         self.len = len(seq)
-
-        amosfile = dir + "/velvet_asm.afg"
-        seqfile = dir + "/Sequences"
-        inseq = parseamos.InputSeqs(seqfile)  # contains ALL input seqs...
-        contigreadmap = parseamos.contigreadmap(amosfile,inseq)
+        self.readmap = readmap
+        self._reads = None
 
         namefields = name.split('_')
         self.eid = namefields[1]
 
-        self.reads = contigreadmap[self.eid] 
         self.rquals = [] # meaningless, used for filler later rather than have uniform quality
         self.mquals = [] # meaningless, used for filler later rather than have uniform quality
 
         assert self.name
         assert self.seq
         assert self.len
+
+    @property
+    def reads(self):
+        ''' parseamos.ContigReads for this contig '''
+        if self._reads is None:
+            self._reads = self.readmap.reads(self.eid)
+        return self._reads
+
+    def __getstate__(self):
+        ''' pickle with read names resolved and without the (run-wide) read map '''
+        self.reads
+        state = self.__dict__.copy()
+        state['readmap'] = None
+        return state
+
     def __str__(self):
         return ">" + self.name + "\n" + self.seq 
 
@@ -68,13 +99,14 @@ def n50(contigs):
             nlist.append(n)
     return median(nlist)
 
-def runVelvet(reads,refseqname,refseq,kmer,isPaired=True,long=False, inputContigs=False, cov_cutoff=False, noref=False):
+def runVelvet(reads,refseqname,refseq,kmer,isPaired=True,long=False, inputContigs=False, cov_cutoff=False, noref=False, workdir='.'):
     """
     reads is either a dictionary of ReadPair objects, (if inputContigs=False) or a list of 
     Contig objects (if inputContigs=True), refseq is a single sequence, kmer is an odd int
+    temporary files are written to workdir
     """
-    readsFasta  = tempfile.NamedTemporaryFile(delete=False,dir='.')
-    refseqFasta = tempfile.NamedTemporaryFile(delete=False,dir='.')
+    readsFasta  = tempfile.NamedTemporaryFile(delete=False,dir=workdir)
+    refseqFasta = tempfile.NamedTemporaryFile(delete=False,dir=workdir)
 
     if inputContigs:
         for contig in reads:
@@ -92,7 +124,7 @@ def runVelvet(reads,refseqname,refseq,kmer,isPaired=True,long=False, inputContig
     readsFN  = readsFasta.name
     refseqFN = refseqFasta.name
 
-    tmpdir = tempfile.mkdtemp(dir='.')
+    tmpdir = tempfile.mkdtemp(dir=workdir)
 
     print tmpdir
 
@@ -112,8 +144,8 @@ def runVelvet(reads,refseqname,refseq,kmer,isPaired=True,long=False, inputContig
     else:
         argsvelvetg = ['velvetg', tmpdir, '-unused_reads', 'yes', '-read_trkg', 'yes', '-amos_file', 'yes']
         
-    subprocess.call(argsvelveth)
-    subprocess.call(argsvelvetg)
+    metrics.call(argsvelveth, stage='assemble')
+    metrics.call(argsvelvetg, stage='assemble')
 
     vcontigs = velvetContigs(tmpdir)
 
@@ -154,38 +186,134 @@ class ReadPair:
         output = " ".join(("read1:", self.read1.qname, self.read1.seq, r1map, "read2:", self.read2.qname, self.read2.seq, r2map))
         return output
 
-def asm(chr, start, end, bamfilename, reffile, kmersize, noref=False, recycle=False):
+class AsmCache:
+    '''
+    on-disk cache of asm() results (pickled contigs, read names and quality lists), one file
+    per key in cachedir. Entries are touched when used and the least recently used entries
+    are removed when the cache grows over maxsize bytes
+    '''
+    def __init__(self, cachedir, maxsize=1<<30):
+        self.cachedir = cachedir
+        self.maxsize  = maxsize
+        if not os.path.exists(cachedir):
+            try:
+                os.makedirs(cachedir)
+            except OSError: # created by another process
+                pass
+
+    def key(self, chr, start, end, bamfilename, reffile, kmersize, noref, recycle):
+        ''' sha1 of the .bam (path, size and mtime of .bam and index), region and assembly options '''
+        fields = [os.path.abspath(bamfilename), chr, str(start), str(end), str(kmersize), str(noref), str(recycle)]
+        for fn in (bamfilename, bamfilename + '.bai'):
+            if os.path.exists(fn):
+                st = os.stat(fn)
+                fields += [str(st.st_size), str(st.st_mtime)]
+        if reffile is not None:
+            fields.append(str(getattr(reffile, 'filename', '')))
+        return hashlib.sha1('\t'.join(fields)).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cachedir, key + '.asm.pickle')
+
+    def get(self, key):
+        ''' cached contigs for key or None '''
+        fn = self._path(key)
+        try:
+            f = open(fn, 'rb')
+            contigs = cPickle.load(f)
+            f.close()
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+        os.utime(fn, None) # mark as recently used
+        return contigs
+
+    def put(self, key, contigs):
+        fn = self._path(key)
+        tmpfn = fn + '.' + str(os.getpid()) # write then rename so other processes never see partial files
+        f = open(tmpfn, 'wb')
+        cPickle.dump(contigs, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmpfn, fn)
+        self.evict()
+
+    def evict(self):
+        ''' remove least recently used entries until the cache fits in maxsize '''
+        entries = []
+        total = 0
+        for name in os.listdir(self.cachedir):
+            if not name.endswith('.asm.pickle'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cachedir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        entries.sort()
+        for (mtime, size, name) in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(os.path.join(self.cachedir, name))
+            except OSError:
+                pass
+            total -= size
+
+def asm(chr, start, end, bamfilename, reffile, kmersize, noref=False, recycle=False, workdir='.', cache=None):
+    '''
+    assemble reads in region chr:start-end, returns a list of Contig objects.
+    cache is an optional AsmCache, assembly is skipped if the result is cached
+    '''
+    if cache is not None:
+        cachekey = cache.key(chr, start, end, bamfilename, reffile, kmersize, noref, recycle)
+        contigs = cache.get(cachekey)
+        if contigs is not None:
+            sys.stderr.write("using cached assembly for " + chr + ":" + str(start) + "-" + str(end) + "\n")
+            metrics.count('asmcache_hits')
+            return contigs
+
+    contigs = asmreads(chr, start, end, bamfilename, reffile, kmersize, noref, recycle, workdir)
+
+    if cache is not None:
+        cache.put(cachekey, contigs)
+    return contigs
+
+def asmreads(chr, start, end, bamfilename, reffile, kmersize, noref=False, recycle=False, workdir='.'):
     bamfile  = pysam.Samfile(bamfilename,'rb')
     matefile = pysam.Samfile(bamfilename,'rb')
 
+    # mates are looked up in bulk, one fetch per window of mate positions
+    reads = [read for read in bamfile.fetch(chr,start,end) if not read.mate_is_unmapped and read.is_paired]
+    resolver = mates.MateResolver(matefile)
+
     readpairs = {}
     nreads = 0
     rquals = []
     mquals = []
-    for read in bamfile.fetch(chr,start,end):
-        if not read.mate_is_unmapped and read.is_paired:
-            # FIXME add try/except to prevent crash if mate doesn't exist
-            try:
-                mate = matefile.mate(read)
-                readpairs[read.qname] = ReadPair(read,mate)
-                nreads += 1
-                if read.is_read1:
-                    if read.is_reverse:
-                        rquals.append(read.qual[::-1])
-                        mquals.append(mate.qual)
-                    else:
-                        rquals.append(read.qual)
-                        mquals.append(mate.qual[::-1])
-                else:
-                    if read.is_reverse:
-                        rquals.append(mate.qual)
-                        mquals.append(read.qual[::-1])
-                    else:
-                        rquals.append(mate.qual[::-1])
-                        mquals.append(read.qual)
-            except ValueError:
-                sys.stderr.write("warning, cannot find mate for read marked paired: " + read.qname + "\n")
+    for (read, mate) in zip(reads, resolver.mates(reads)):
+        if mate is None:
+            sys.stderr.write("warning, cannot find mate for read marked paired: " + read.qname + "\n")
+            continue
+        readpairs[read.qname] = ReadPair(read,mate)
+        nreads += 1
+        if read.is_read1:
+            if read.is_reverse:
+                rquals.append(read.qual[::-1])
+                mquals.append(mate.qual)
+            else:
+                rquals.append(read.qual)
+                mquals.append(mate.qual[::-1])
+        else:
+            if read.is_reverse:
+                rquals.append(mate.qual)
+                mquals.append(read.qual[::-1])
+            else:
+                rquals.append(mate.qual[::-1])
+                mquals.append(read.qual)
 
+    resolver.report()
+    metrics.count('mate_lookups', resolver.lookups)
+    metrics.count('mate_seeks', resolver.seeks)
     sys.stderr.write("found " + str(nreads) + " reads in region.\n")
 
     if nreads == 0:
@@ -197,12 +325,12 @@ def asm(chr, start, end, bamfilename, reffile, kmersize, noref=False, recycle=Fa
 
     region = chr + ":" + str(start) + "-" + str(end)
 
-    contigs = runVelvet(readpairs, region, refseq, kmersize, cov_cutoff=True, noref=noref)
+    contigs = runVelvet(readpairs, region, refseq, kmersize, cov_cutoff=True, noref=noref, workdir=workdir)
     newcontigs = None
 
     if recycle:
         if len(contigs) > 1:
-            newcontigs = runVelvet(contigs, region, refseq, kmersize, long=True, inputContigs=True, noref=noref)
+            newcontigs = runVelvet(contigs, region, refseq, kmersize, long=True, inputContigs=True, noref=noref, workdir=workdir)
 
         if newcontigs and n50(newcontigs) > n50(contigs):
             contigs = newcontigs
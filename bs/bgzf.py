@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+'''
+Minimal BGZF block and .bai access, used to copy untouched parts of a .bam
+verbatim (as compressed blocks) instead of decoding and re-encoding every read
+'''
+
+import os,struct,zlib,shutil,tempfile,multiprocessing
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+# empty block that terminates a BGZF file
+EOF_BLOCK = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+MAXBLOCK = 0xff00 # max uncompressed bytes per block (same as htslib)
+
+def readBlock(fh, start=''):
+    ''' read one raw (compressed) BGZF block from fh, returns None at end of file.
+        start is the beginning of the block if it has already been read from fh
+    '''
+    header = start + fh.read(12-len(start))
+    if not header:
+        return None
+    if len(header) < 12 or header[:4] != "\x1f\x8b\x08\x04":
+        raise ValueError("not a BGZF block at offset " + str(fh.tell()-len(header)))
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = fh.read(xlen)
+
+    # find BC subfield with total block size
+    bsize = None
+    i = 0
+    while i < xlen:
+        (si1, si2, slen) = struct.unpack('<BBH', extra[i:i+4])
+        if si1 == 66 and si2 == 67:
+            bsize = struct.unpack('<H', extra[i+4:i+6])[0]
+        i += 4 + slen
+    if bsize is None:
+        raise ValueError("BGZF block without BC field at offset " + str(fh.tell()-12-xlen))
+
+    rest = fh.read(bsize + 1 - 12 - xlen)
+    return header + extra + rest
+
+def blockSize(block):
+    ''' uncompressed size of a raw block '''
+    return struct.unpack('<I', block[-4:])[0]
+
+def decompressBlock(block):
+    xlen = struct.unpack('<H', block[10:12])[0]
+    return zlib.decompress(block[12+xlen:-8], -15)
+
+def restoreBlock(block):
+    ''' re-frame a block as stored (level 0) data, which costs almost nothing to decompress '''
+    return compressBlock(decompressBlock(block), 0)
+
+def compressBlock(data, level=6):
+    ''' returns raw BGZF block for data (at most MAXBLOCK bytes) '''
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+class BgzfReader:
+    '''
+    read uncompressed data from a BGZF file with virtual offsets
+    (compressed block offset << 16 | offset within block)
+    '''
+    def __init__(self, fh):
+        self.fh = fh
+        self.coffset = 0
+        self.nextcoffset = 0
+        self.data = ''
+        self.uoffset = 0
+        self.eof = False
+        self.seek(0)
+
+    def _load(self, coffset):
+        self.fh.seek(coffset)
+        block = readBlock(self.fh)
+        self.coffset = coffset
+        self.nextcoffset = self.fh.tell()
+        self.uoffset = 0
+        if block is None:
+            self.data = ''
+            self.eof = True
+        else:
+            self.data = decompressBlock(block)
+            self.eof = False
+
+    def seek(self, voffset):
+        self._load(voffset >> 16)
+        self.uoffset = voffset & 0xffff
+
+    def tell(self):
+        ''' virtual offset of the next byte, the end of a block is reported as the start of the next '''
+        if self.uoffset >= len(self.data) and not self.eof:
+            return self.nextcoffset << 16
+        return (self.coffset << 16) | self.uoffset
+
+    def read(self, n):
+        chunks = []
+        while n > 0:
+            if self.uoffset >= len(self.data):
+                if self.eof:
+                    break
+                self._load(self.nextcoffset)
+                continue
+            chunk = self.data[self.uoffset:self.uoffset+n]
+            self.uoffset += len(chunk)
+            n -= len(chunk)
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+class BgzfWriter:
+    '''
+    write a BGZF file, either from uncompressed data (compressed here) or as
+    raw blocks copied from another BGZF file. With threads > 1, blocks are
+    compressed on a thread pool (zlib releases the GIL) and written in order.
+    '''
+    def __init__(self, fh, level=6, threads=1):
+        self.fh = fh
+        self.level = level
+        self.buf = []
+        self.buflen = 0
+        self.pool = None
+        self.pending = deque() # blocks being compressed, in output order
+        self.maxpending = 4*threads
+        if threads > 1:
+            self.pool = ThreadPool(threads)
+
+    def _emit(self, data):
+        if self.pool is None:
+            self.fh.write(compressBlock(data, self.level))
+        else:
+            self.pending.append(self.pool.apply_async(compressBlock, (data, self.level)))
+            if len(self.pending) > self.maxpending:
+                self.fh.write(self.pending.popleft().get())
+
+    def _drain(self):
+        while self.pending:
+            self.fh.write(self.pending.popleft().get())
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buflen += len(data)
+        if self.buflen >= MAXBLOCK:
+            data = ''.join(self.buf)
+            i = 0
+            while len(data) - i >= MAXBLOCK:
+                self._emit(data[i:i+MAXBLOCK])
+                i += MAXBLOCK
+            self.buf = [data[i:]]
+            self.buflen = len(data) - i
+
+    def flush(self):
+        ''' compress buffered data into a (possibly short) block '''
+        if self.buflen > 0:
+            self._emit(''.join(self.buf))
+        self.buf = []
+        self.buflen = 0
+
+    def writeRaw(self, block):
+        ''' copy a compressed block unchanged, empty blocks (e.g. EOF markers) are dropped '''
+        self.flush()
+        self._drain()
+        if blockSize(block) > 0:
+            self.fh.write(block)
+
+    def close(self):
+        self.flush()
+        self._drain()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        self.fh.write(EOF_BLOCK)
+        self.fh.close()
+
+def copyRange(fh, start, end, writer):
+    '''
+    copy uncompressed data between virtual offsets start and end of BGZF file fh
+    to writer: whole blocks are copied as-is, only the partial blocks at either
+    end are recompressed
+    '''
+    if start >= end:
+        return
+    (cstart, ustart) = (start >> 16, start & 0xffff)
+    (cend, uend)     = (end >> 16, end & 0xffff)
+
+    fh.seek(cstart)
+    block = readBlock(fh)
+    if block is None:
+        return
+    if cstart == cend:
+        writer.write(decompressBlock(block)[ustart:uend])
+        return
+    if ustart == 0:
+        writer.writeRaw(block)
+    else:
+        writer.write(decompressBlock(block)[ustart:])
+
+    while fh.tell() < cend:
+        block = readBlock(fh)
+        if block is None:
+            return
+        writer.writeRaw(block)
+
+    if uend > 0:
+        fh.seek(cend)
+        block = readBlock(fh)
+        if block is not None:
+            writer.write(decompressBlock(block)[:uend])
+
+def fileEnd(fh):
+    ''' virtual offset of the end of file fh '''
+    fh.seek(0, os.SEEK_END)
+    return fh.tell() << 16
+
+def skipBamHeader(reader):
+    ''' read past the header of a .bam opened with BgzfReader, returns virtual offset of first record '''
+    if reader.read(4) != "BAM\1":
+        raise ValueError("not a .bam file")
+    ltext = struct.unpack('<i', reader.read(4))[0]
+    reader.read(ltext)
+    nref = struct.unpack('<i', reader.read(4))[0]
+    for i in range(nref):
+        lname = struct.unpack('<i', reader.read(4))[0]
+        reader.read(lname + 4)
+    return reader.tell()
+
+def copyRecords(bamfile, writer):
+    ''' append all records (not the header) of .bam file bamfile to writer '''
+    fh = open(bamfile, 'rb')
+    reader = BgzfReader(fh)
+    skipBamHeader(reader)
+    data = reader.read(MAXBLOCK)
+    while data:
+        writer.write(data)
+        data = reader.read(MAXBLOCK)
+    fh.close()
+
+def readRecord(reader):
+    ''' returns (refid, pos, raw record) for the next record, or None at end of file '''
+    size = reader.read(4)
+    if len(size) < 4:
+        return None
+    body = reader.read(struct.unpack('<i', size)[0])
+    (refid, pos) = struct.unpack('<ii', body[:8])
+    return (refid, pos, size + body)
+
+def readBaiLinear(baifile):
+    ''' returns a list (one per reference) of linear index offsets (16 kb windows) from a .bai '''
+    f = open(baifile, 'rb')
+    if f.read(4) != "BAI\1":
+        raise ValueError("not a .bai file: " + baifile)
+    (nref,) = struct.unpack('<i', f.read(4))
+    linear = []
+    for i in range(nref):
+        (nbin,) = struct.unpack('<i', f.read(4))
+        for j in range(nbin):
+            (binid, nchunk) = struct.unpack('<Ii', f.read(8))
+            f.seek(16*nchunk, os.SEEK_CUR)
+        (nintv,) = struct.unpack('<i', f.read(4))
+        linear.append(list(struct.unpack('<' + str(nintv) + 'Q', f.read(8*nintv))))
+    f.close()
+    return linear
+
+def compressStream(infh, outfile, level=6, threads=1):
+    ''' compress .bam data from infh into BGZF file outfile. Input can be BGZF at any level
+        (e.g. level 0 from pysam mode 'wbu') or raw uncompressed data
+    '''
+    writer = BgzfWriter(open(outfile, 'wb'), level, threads)
+    start = infh.read(4)
+    if start == "\x1f\x8b\x08\x04":
+        block = readBlock(infh, start)
+        while block is not None:
+            writer.write(decompressBlock(block))
+            block = readBlock(infh)
+    else:
+        data = start
+        while data:
+            writer.write(data)
+            data = infh.read(1 << 20)
+    writer.close()
+
+def decompressStream(infile, outfh, threads=1):
+    ''' decompress BGZF file infile on a thread pool, writing the data to outfh as stored (level 0) blocks '''
+    fh = open(infile, 'rb')
+    pool = ThreadPool(threads)
+    pending = deque()
+    block = readBlock(fh)
+    while block is not None:
+        pending.append(pool.apply_async(restoreBlock, (block,)))
+        if len(pending) > 4*threads:
+            outfh.write(pending.popleft().get())
+        block = readBlock(fh)
+    while pending:
+        outfh.write(pending.popleft().get())
+    outfh.write(EOF_BLOCK)
+    pool.close()
+    pool.join()
+    fh.close()
+
+def _compressFifo(fifo, outfile, level, threads):
+    infh = open(fifo, 'rb')
+    compressStream(infh, outfile, level, threads)
+    infh.close()
+
+def _decompressFifo(infile, fifo, threads):
+    outfh = open(fifo, 'wb')
+    decompressStream(infile, outfh, threads)
+    outfh.close()
+
+class BamPipe:
+    '''
+    runs BGZF compression (mode 'w') or decompression (mode 'r') of .bam file bamfile in a
+    separate process, through a named pipe that pysam opens instead of bamfile (.name).
+    Open the pipe with mode 'wbu' for writing, and read it sequentially (no fetch()).
+    '''
+    def __init__(self, bamfile, mode, level=6, threads=1):
+        self.mode = mode
+        self.tmpdir = tempfile.mkdtemp()
+        self.name = os.path.join(self.tmpdir, os.path.basename(bamfile))
+        os.mkfifo(self.name)
+
+        if mode == 'w':
+            self.proc = multiprocessing.Process(target=_compressFifo, args=(self.name, bamfile, level, threads))
+        elif mode == 'r':
+            self.proc = multiprocessing.Process(target=_decompressFifo, args=(bamfile, self.name, threads))
+        else:
+            raise ValueError("BamPipe mode must be 'r' or 'w': " + str(mode))
+        self.proc.start()
+
+    def close(self):
+        ''' call after the pysam.Samfile using the pipe is closed '''
+        if self.mode == 'r' and self.proc.is_alive(): # reader stopped early
+            self.proc.terminate()
+        self.proc.join()
+        shutil.rmtree(self.tmpdir)
+        if self.mode == 'w' and self.proc.exitcode != 0:
+            raise IOError("compression of " + self.name + " failed")
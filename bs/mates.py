@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+'''
+Bulk mate lookup for reads from a sorted, indexed .bam: instead of one index seek per
+read (pysam Samfile.mate()), requested mate positions are sorted, nearby positions are
+grouped into windows and each window is fetched once, matching mates by name
+'''
+
+import sys
+
+def isMate(read, mate):
+    ''' True if mate is the other end of read's pair '''
+    return (mate.qname == read.qname and mate.is_read1 != read.is_read1 and
+            not mate.is_secondary and mate.tid == read.mrnm and mate.pos == read.mpos)
+
+class MateResolver:
+    def __init__(self, bam, window=1000):
+        self.bam     = bam
+        self.window  = window # mate positions closer than this are fetched together
+        self.seeks   = 0 # number of fetch() calls (index seeks)
+        self.lookups = 0 # number of mates requested
+
+    def windows(self, positions):
+        ''' group sorted (tid, pos) into (tid, start, end) fetch windows '''
+        windows = []
+        for (tid, pos) in positions:
+            if windows and windows[-1][0] == tid and pos - windows[-1][1] < self.window:
+                windows[-1][2] = pos+1
+            else:
+                windows.append([tid, pos, pos+1])
+        return windows
+
+    def mates(self, reads):
+        ''' returns a list with the mate of each read (None if it can't be found) '''
+        self.lookups += len(reads)
+        found  = [None] * len(reads)
+        wanted = {} # (qname, mate tid, mate pos) --> indexes of reads in list
+        for (i, read) in enumerate(reads):
+            if read.is_paired and not read.mate_is_unmapped and read.mrnm >= 0:
+                wanted.setdefault((read.qname, read.mrnm, read.mpos), []).append(i)
+
+        positions = sorted(set([(tid, pos) for (qname, tid, pos) in wanted]))
+        for (tid, start, end) in self.windows(positions):
+            self.seeks += 1
+            for mate in self.bam.fetch(reference=self.bam.getrname(tid), start=start, end=end):
+                if mate.pos < start:
+                    continue
+                for i in wanted.get((mate.qname, tid, mate.pos), []):
+                    if found[i] is None and isMate(reads[i], mate):
+                        found[i] = mate
+
+        return found
+
+    def report(self, out=sys.stderr):
+        out.write("mate lookups: " + str(self.lookups) + ", index seeks: " + str(self.seeks) + "\n")
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+'''
+Run metrics: per-stage wall/CPU time, subprocess durations and exit codes, and counters,
+written as JSON lines (one object per event) and summarized at the end of a run.
+
+Modules use the shared instance through the functions below (stage(), call(), count()...),
+which do nothing beyond in-memory bookkeeping unless configure() was given a file.
+Worker processes append to the same file, so the summary covers the whole run.
+'''
+
+import os,sys,time,json,subprocess,cProfile,pstats
+
+class Metrics:
+    def __init__(self):
+        self.filename = None
+        self.events = [] # events of this process, used for the summary if there is no file
+
+    def configure(self, filename=None):
+        ''' start a new metrics file (call once in the parent process before starting workers) '''
+        self.filename = filename
+        self.events = []
+        if filename:
+            open(filename, 'w').close()
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields['time']  = time.time()
+        fields['pid']   = os.getpid()
+        if self.filename:
+            # one write per line, appends from several processes don't interleave
+            fh = open(self.filename, 'a')
+            fh.write(json.dumps(fields, sort_keys=True) + "\n")
+            fh.close()
+        else:
+            self.events.append(fields)
+
+    def stage(self, name, **fields):
+        return Stage(self, name, fields)
+
+    def call(self, args, stage=None, **kwargs):
+        ''' subprocess.call(args) with its duration and exit code recorded '''
+        start = time.time()
+        returncode = subprocess.call(args, **kwargs)
+        self.subprocess(args, returncode, time.time()-start, stage)
+        return returncode
+
+    def subprocess(self, args, returncode, wall, stage=None):
+        self.emit('subprocess', cmd=os.path.basename(args[0]), args=' '.join(args), returncode=returncode, wall=wall, stage=stage)
+
+    def count(self, name, n=1, **fields):
+        self.emit('count', name=name, n=n, **fields)
+
+    def filesize(self, name, filename, **fields):
+        ''' record size of filename in bytes (e.g. output .bam) '''
+        if os.path.exists(filename):
+            self.emit('bytes', name=name, bytes=os.path.getsize(filename), **fields)
+
+    def load(self):
+        ''' all events of the run '''
+        if not self.filename:
+            return self.events
+        events = []
+        for line in open(self.filename, 'r'):
+            if line.strip():
+                events.append(json.loads(line))
+        return events
+
+    def summary(self, out=sys.stderr):
+        ''' print totals per stage, subprocess and counter '''
+        stages = {} # name --> [n, wall, cpu]
+        procs  = {} # command --> [n, wall, failures]
+        counts = {}
+        nbytes = {}
+        for e in self.load():
+            if e['event'] == 'stage':
+                s = stages.setdefault(e['stage'], [0, 0.0, 0.0])
+                s[0] += 1
+                s[1] += e['wall']
+                s[2] += e['cpu']
+            elif e['event'] == 'subprocess':
+                p = procs.setdefault(e['cmd'], [0, 0.0, 0])
+                p[0] += 1
+                p[1] += e['wall']
+                if e['returncode'] != 0:
+                    p[2] += 1
+            elif e['event'] == 'count':
+                counts[e['name']] = counts.get(e['name'], 0) + e['n']
+            elif e['event'] == 'bytes':
+                nbytes[e['name']] = nbytes.get(e['name'], 0) + e['bytes']
+
+        out.write("%-24s %8s %12s %12s\n" % ('stage', 'n', 'wall (s)', 'cpu (s)'))
+        for name in sorted(stages):
+            (n, wall, cpu) = stages[name]
+            out.write("%-24s %8d %12.2f %12.2f\n" % (name, n, wall, cpu))
+        if procs:
+            out.write("\n%-24s %8s %12s %12s\n" % ('command', 'n', 'wall (s)', 'failed'))
+            for name in sorted(procs):
+                (n, wall, failed) = procs[name]
+                out.write("%-24s %8d %12.2f %12d\n" % (name, n, wall, failed))
+        if counts or nbytes:
+            out.write("\n%-24s %12s\n" % ('counter', 'total'))
+            for name in sorted(counts):
+                out.write("%-24s %12d\n" % (name, counts[name]))
+            for name in sorted(nbytes):
+                out.write("%-24s %12d\n" % (name + " (bytes)", nbytes[name]))
+
+class Stage:
+    ''' context manager recording wall and CPU time (this process and its children) of a stage '''
+    def __init__(self, metrics, name, fields):
+        self.metrics = metrics
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.wall = time.time()
+        t = os.times()
+        self.cpu = t[0] + t[1] + t[2] + t[3]
+        return self
+
+    def __exit__(self, exctype, exc, tb):
+        t = os.times()
+        self.metrics.emit('stage', stage=self.name, wall=time.time()-self.wall, cpu=t[0]+t[1]+t[2]+t[3]-self.cpu,
+                          failed=exctype is not None, **self.fields)
+        return False
+
+_metrics = Metrics()
+
+def configure(filename=None):
+    _metrics.configure(filename)
+
+def stage(name, **fields):
+    return _metrics.stage(name, **fields)
+
+def call(args, stage=None, **kwargs):
+    return _metrics.call(args, stage, **kwargs)
+
+def called(args, returncode, wall, stage=None):
+    ''' record a subprocess started elsewhere (e.g. a Popen pipeline) '''
+    _metrics.subprocess(args, returncode, wall, stage)
+
+def count(name, n=1, **fields):
+    _metrics.count(name, n, **fields)
+
+def filesize(name, filename, **fields):
+    _metrics.filesize(name, filename, **fields)
+
+def summary(out=sys.stderr):
+    _metrics.summary(out)
+
+def profile(func, args, outfile):
+    ''' run func(args) under cProfile, stats are saved to outfile and the top entries printed '''
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(func, args)
+    finally:
+        prof.dump_stats(outfile)
+        pstats.Stats(outfile, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
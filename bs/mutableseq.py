@@ -5,27 +5,130 @@ Methods for making mutations in a sequence
 '''
 
 import string
+from bisect import bisect_right
 
 def rc(seq):
     seq = seq[::-1]
     seq = seq.translate(string.maketrans("ATGC","TACG"))
     return seq
 
-class MutableSeq:
+class MutableSeq(object):
+    '''
+    Sequence stored as a piece table: a list of (source, start, end, reversed) pieces that
+    refer to the original sequence (source 0) or inserted sequences. Edits only split and
+    rearrange pieces, inversions are reverse-complemented views and duplications repeat
+    pieces, the sequence is built when .seq is first used after an edit.
+
+    The pieces are a plain list: finding a position is O(log p) by bisection over cached piece
+    offsets, but each edit splices the list and rebuilds the offsets, so it is O(p) for p pieces
+    (each edit adds at most a few pieces, plus the copies made by duplications). That is cheap
+    for the handful of stacked edits addsv.py makes per contig, it is not O(log n) per edit.
+
+    Each edit is logged in .edits as (type, start, end, data) in original sequence
+    coordinates (see _log()), start/end are None if they fall in inserted sequence.
+    '''
     def __init__(self,seq):
-        self.seq = string.upper(seq.strip())
+        self.seq = seq
+
+    @property
+    def seq(self):
+        if self._seq is None:
+            self._seq = ''.join([self._piecestr(piece) for piece in self.pieces])
+        return self._seq
+
+    @seq.setter
+    def seq(self, seq):
+        seq = string.upper(seq.strip())
+        self.sources = [seq]
+        self.pieces  = [(0, 0, len(seq), False)]
+        self._seq    = seq
+        self._starts = None
+        self.edits   = []
+
+    def _piecestr(self, piece):
+        (src, start, end, rev) = piece
+        if rev:
+            return rc(self.sources[src][start:end])
+        return self.sources[src][start:end]
+
+    def _edited(self):
+        self._seq    = None
+        self._starts = None
+
+    def _offsets(self):
+        ''' start position of each piece in the mutated sequence (plus the total length) '''
+        if self._starts is None:
+            starts = [0]
+            for (src, start, end, rev) in self.pieces:
+                starts.append(starts[-1] + end - start)
+            self._starts = starts
+        return self._starts
+
+    def _find(self, pos):
+        ''' returns (index of piece containing pos, offset of pos within the piece) '''
+        starts = self._offsets()
+        i = bisect_right(starts, pos) - 1
+        return (i, pos - starts[i])
+
+    def _split(self, pos):
+        ''' make pos the start of a piece, returns the index of that piece '''
+        if pos >= self.length():
+            return len(self.pieces)
+        (i, k) = self._find(pos)
+        if k == 0:
+            return i
+        (src, start, end, rev) = self.pieces[i]
+        if rev: # first k bases of a reversed piece come from the end of its source range
+            self.pieces[i:i+1] = [(src, end-k, end, True), (src, start, end-k, True)]
+        else:
+            self.pieces[i:i+1] = [(src, start, start+k, False), (src, start+k, end, False)]
+        self._starts = None
+        return i+1
+
+    def _range(self, start, end):
+        ''' (first, last+1) piece indexes covering start to end '''
+        i = self._split(start)
+        j = self._split(end)
+        return (i, j)
 
     def __str__(self):
         return self.seq
 
     def length(self):
-        return len(self.seq)
+        return self._offsets()[-1]
 
     def subseq(self, start, end):
         start = int(start)
         end   = int(end)
         assert start < end
-        return self.seq[start:end]
+        if self._seq is not None:
+            return self._seq[start:end]
+        (i, j) = self._range(start, end)
+        return ''.join([self._piecestr(piece) for piece in self.pieces[i:j]])
+
+    def origpos(self, pos):
+        ''' position in the original sequence of base pos in the mutated sequence, None if the base was inserted '''
+        if pos < 0 or pos >= self.length():
+            raise ValueError("position out of range: " + str(pos))
+        (i, k) = self._find(pos)
+        (src, start, end, rev) = self.pieces[i]
+        if src != 0:
+            return None
+        if rev:
+            return end-1-k
+        return start+k
+
+    def _log(self, kind, start, end, data=None):
+        ''' add edit of bases start to end (mutated coordinates, before the edit) to self.edits '''
+        ostart = None
+        oend   = None
+        if start < end:
+            first = self.origpos(start)
+            last  = self.origpos(end-1)
+            if first is not None and last is not None:
+                ostart = min(first, last)
+                oend   = max(first, last) + 1
+        self.edits.append((kind, ostart, oend, data))
 
     def deletion(self, start, end):
         """
@@ -34,14 +137,30 @@ class MutableSeq:
         start = int(start)
         end   = int(end)
         assert start < end
-        self.seq = self.seq[:start] + self.seq[end:]
+        self._log('DEL', start, end)
+        (i, j) = self._range(start, end)
+        del self.pieces[i:j]
+        self._edited()
 
     def insertion(self, loc, seq, tsdlen=0):
         """
         inserts seq after position loc, adds taret site duplication (tsd) if tsdlen > 0
         """
-        tsd = self.seq[loc:loc+tsdlen]
-        self.seq = self.seq[:loc] + tsd + seq + self.seq[loc:]
+        tsd = []
+        if tsdlen > 0 and loc < self.length():
+            (i, j) = self._range(loc, min(loc+tsdlen, self.length()))
+            tsd = self.pieces[i:j]
+
+        # logged as the base before the insertion (an insertion at 0 has no anchor)
+        if loc > 0:
+            self._log('INS', loc-1, loc, ''.join([self._piecestr(piece) for piece in tsd]) + seq)
+        else:
+            self.edits.append(('INS', None, None, seq))
+
+        self.sources.append(seq)
+        i = self._split(loc)
+        self.pieces[i:i] = tsd + [(len(self.sources)-1, 0, len(seq), False)]
+        self._edited()
 
     def inversion(self, start, end):
         """
@@ -50,8 +169,10 @@ class MutableSeq:
         start = int(start)
         end   = int(end)
         assert start < end
-        invseq = rc(self.seq[start:end])
-        self.seq = self.seq[:start] + invseq + self.seq[end:]
+        self._log('INV', start, end)
+        (i, j) = self._range(start, end)
+        self.pieces[i:j] = [(src, s, e, not rev) for (src, s, e, rev) in reversed(self.pieces[i:j])]
+        self._edited()
 
     def duplication(self,start,end,fold=1):
         """
@@ -60,9 +181,7 @@ class MutableSeq:
         start = int(start)
         end   = int(end)
         assert start < end
-        dupseq = self.seq[start:end]
-        for i in range(fold):
-            dupseq = dupseq + self.seq[start:end]
-        self.seq = self.seq[:start] + dupseq + self.seq[end:]
-        
-        
+        self._log('DUP', start, end, fold)
+        (i, j) = self._range(start, end)
+        self.pieces[i:j] = self.pieces[i:j] * (fold+1)
+        self._edited()
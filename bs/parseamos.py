@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import sys,re
+import sys
 
 class ContigReads:
     def __init__(self, eid):
@@ -18,85 +18,97 @@ class ContigReads:
             print self.srcs[i],self.reads[i]
 
 class InputSeqs:
-    def __init__(self,seqfile):
+    def __init__(self,seqfile,keepseqs=False):
+        ''' read velvet Sequences file, sequences are only stored if keepseqs is True '''
         self.srcread = {}  # read number --> read name
         self.readnames = []  # read names
         self.readseqs = []
+        self.keepseqs = keepseqs
 
         f = open(seqfile,'r')
         read = None
-        src  = None
-        seq  = ""
+        chunks = []
         for line in f:
-            if re.search('^>',line):
-                if read:
-                    assert seq != ""
-                    self.readseqs.append(seq)
-                    seq = ""
-                (read,src,n) = re.sub('^>','',line).strip().split()
+            if line.startswith('>'):
+                if read and keepseqs:
+                    assert chunks
+                    self.readseqs.append(''.join(chunks))
+                    chunks = []
+                (read,src,n) = line[1:].split()
                 assert read and src
                 self.srcread[src] = read
                 self.readnames.append(read)
-            else:
-                seq += line.strip()
-        self.srcread[src] = read
-        self.readseqs.append(seq)
+            elif keepseqs:
+                chunks.append(line.strip())
+        if read and keepseqs:
+            self.readseqs.append(''.join(chunks))
+        f.close()
 
     def __str__(self):
-        output = ""
+        if not self.keepseqs:
+            raise ValueError("sequences not stored, use InputSeqs(seqfile,keepseqs=True)")
+        output = []
         for i in range(len(self.readnames)):
-            output += ">" + self.readnames[i] + "\n" + self.readseqs[i] + "\n"
-        return output
+            output.append(">" + self.readnames[i] + "\n" + self.readseqs[i] + "\n")
+        return ''.join(output)
 
-def contigreadmap(amosfile,seqs):
+def contigsrcs(amosfile):
     '''
-    seqs is an InputSeqs object
+    generator over the {CTG blocks of velvet_asm.afg, yields (eid, [read numbers])
+    for each contig, read numbers are the src: fields of the {TLE blocks
     '''
     f = open(amosfile, 'r')
     inCTGblock = False
     inTLEblock = False
     CTGeid = None
-    TLEsrc = None
-    contig = None
-    contigs = {} 
+    srcs = []
 
     for line in f:
-        line = line.strip()
         if inCTGblock:
             if not inTLEblock:
-                if re.search('^eid:',line):
-                    CTGeid = re.sub('eid:','',line)
-                    CTGeid = re.sub('-0$', '', CTGeid)
-                    contig = ContigReads(CTGeid)
-                    #print "debug: CTGeid =",CTGeid
-
-                if re.search('}', line):
-                    contig.getReadNames(seqs)
-                    contigs[CTGeid] = contig
-                    inCTGblock = False
-                    CTGeid = None
-                    contig = None
-                    #print "debug: left CTG block"
+                if line.startswith('eid:'):
+                    CTGeid = line[4:].strip()
+                    if CTGeid.endswith('-0'):
+                        CTGeid = CTGeid[:-2]
 
-                if re.search('{TLE',line):
+                elif line.startswith('{TLE'):
                     inTLEblock = True
-                    #print "debug: in TLE block"
+
+                elif line.startswith('}'):
+                    yield (CTGeid, srcs)
+                    inCTGblock = False
+                    CTGeid = None
+                    srcs = []
 
             else: # in TLE block
-                if re.search('^src:',line):
-                    TLEsrc = re.sub('src:','',line)
-                    contig.addsrc(TLEsrc)
-                    #print "debug TLEsrc =",TLEsrc
+                if line.startswith('src:'):
+                    srcs.append(line[4:].strip())
 
-                if re.search('}', line):
+                elif line.startswith('}'):
                     inTLEblock = False
-                    TLEsrc = None
-                    #print "debug: left TLE block"
 
-        else: # not in CTG block
-            if re.search('{CTG',line):
-                #print "debug: in CTG block"
-                inCTGblock = True
+        elif line.startswith('{CTG'):
+            inCTGblock = True
+
+    f.close()
+
+def contigreads(amosfile,seqs):
+    ''' generator, yields (eid, [read names]) for each contig in amosfile, seqs is an InputSeqs object '''
+    for eid,srcs in contigsrcs(amosfile):
+        yield (eid, [seqs.srcread[src] for src in srcs])
+
+def contigreadmap(amosfile,seqs,resolve=True):
+    '''
+    seqs is an InputSeqs object, if resolve is False read names are not
+    looked up (call getReadNames() on the contigs that are needed)
+    '''
+    contigs = {} 
+    for eid,srcs in contigsrcs(amosfile):
+        contig = ContigReads(eid)
+        contig.srcs = srcs
+        if resolve:
+            contig.getReadNames(seqs)
+        contigs[eid] = contig
 
     return contigs
 
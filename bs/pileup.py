@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+'''
+In-process base counting over pileup columns (replaces one samtools mpileup call per column)
+and read depth over intervals from read alignments (coverage())
+'''
+
+from array import array
+import numpy as np
+
+BASES = ('A','C','G','T')
+BASEIDX = {'A':0, 'C':1, 'G':2, 'T':3}
+
+class BaseCounter:
+    '''
+    A/C/G/T counts for a window of pileup columns, kept in one flat array (4 counters
+    per column). The window starts at the first column added and grows as needed, so
+    columns must not be added before the first one.
+    '''
+    def __init__(self, minbq=13):
+        self.start  = None
+        self.minbq  = minbq # same default as samtools mpileup -Q
+        self.counts = array('L')
+        self.seen   = array('B') # 1 if column was visited by a pileup
+
+    def _offset(self, pos):
+        if self.start is None:
+            self.start = pos
+        col = pos - self.start
+        if col < 0:
+            raise ValueError("column " + str(pos) + " is before start of window: " + str(self.start))
+        if col >= len(self.seen):
+            grow = col + 1 - len(self.seen)
+            self.seen.extend([0]*grow)
+            self.counts.extend([0]*(4*grow))
+        return col
+
+    def touch(self, pos):
+        ''' mark column as covered even if no bases pass filters '''
+        self.seen[self._offset(pos)] = 1
+
+    def add(self, pos, base, qual=None):
+        ''' count base at column pos, qual is the phred+33 quality character '''
+        col = self._offset(pos)
+        self.seen[col] = 1
+        if qual is not None and ord(qual)-33 < self.minbq:
+            return
+        i = BASEIDX.get(base.upper())
+        if i is not None:
+            self.counts[4*col+i] += 1
+
+    def columns(self):
+        ''' positions of visited columns, in order '''
+        if self.start is None:
+            return []
+        return [self.start+col for col in range(len(self.seen)) if self.seen[col]]
+
+    def basecounts(self, pos):
+        ''' tuple of (A,C,G,T) counts at pos '''
+        if self.start is None:
+            return (0,0,0,0)
+        col = pos - self.start
+        if col < 0 or col >= len(self.seen):
+            return (0,0,0,0)
+        return tuple(self.counts[4*col:4*col+4])
+
+    def bases(self, pos):
+        ''' list of bases at pos, like the base column of samtools mpileup '''
+        bases = []
+        for base,n in zip(BASES,self.basecounts(pos)):
+            bases.extend([base]*n)
+        return bases
+
+    def minorfrac(self, pos):
+        '''
+        minor/(major+minor) allele fraction at pos, same value as computed from
+        majorbase()/minorbase() in addsnv.py. Returns None if no bases were counted.
+        '''
+        c = sorted(self.basecounts(pos), reverse=True)
+        if c[0] == 0:
+            return None
+        if c[1] == 0:
+            return 0.0
+        return float(c[1])/float(c[0]+c[1])
+
+# CIGAR operations covering reference bases in a pileup (M, D, =, X), N/I/S/H/P do not
+REFOPS = (0, 2, 7, 8)
+SKIPOPS = (3,) # N: consumes reference, not counted
+
+# reads pysam pileup() leaves out by default: unmapped, secondary, QC fail, duplicate
+MASK = 0x4 | 0x100 | 0x200 | 0x400
+
+def refspans(read):
+    ''' list of (start, end) reference intervals covered by read's M/D/=/X operations '''
+    spans = []
+    pos = read.pos
+    for (op, n) in read.cigar:
+        if op in REFOPS:
+            if spans and spans[-1][1] == pos:
+                spans[-1] = (spans[-1][0], pos+n)
+            else:
+                spans.append((pos, pos+n))
+            pos += n
+        elif op in SKIPOPS:
+            pos += n
+    return spans
+
+def fetchwindows(regions, window):
+    '''
+    group regions (list of (chrom, start, end)) into fetch windows of nearby regions on the
+    same chromosome, returns a list of (chrom, start, end, [indexes of regions])
+    '''
+    windows = []
+    for i in sorted(range(len(regions)), key=lambda i: regions[i]):
+        (chrom, start, end) = regions[i]
+        if windows and windows[-1][0] == chrom and start - windows[-1][2] < window:
+            windows[-1][2] = max(windows[-1][2], end)
+            windows[-1][3].append(i)
+        else:
+            windows.append([chrom, start, end, [i]])
+    return windows
+
+def coverage(bam, regions, strand=None, minmapq=0, qnames=None, window=1000):
+    '''
+    read depth at each base of regions, a list of (chrom, start, end) with 0-based start and
+    end both included. Returns a list of numpy float arrays in the order of regions.
+
+    Nearby regions share one fetch. Reads are filtered once (strand '+' or '-', mapping
+    quality, read names in qnames, plus the flags pileup() skips) and their M/D/=/X spans
+    are added to a difference array over the window, depth is its cumulative sum.
+    '''
+    depths = [None] * len(regions)
+    for (chrom, wstart, wend, members) in fetchwindows(regions, window):
+        size = wend - wstart + 1
+        starts = []
+        ends   = []
+        if chrom in bam.references:
+            for read in bam.fetch(chrom, wstart, wend+1):
+                if read.flag & MASK or read.mapq < minmapq:
+                    continue
+                if strand == '+' and read.is_reverse or strand == '-' and not read.is_reverse:
+                    continue
+                if qnames is not None and read.qname not in qnames:
+                    continue
+                for (s, e) in refspans(read):
+                    if e > wstart and s <= wend:
+                        starts.append(max(s, wstart) - wstart)
+                        ends.append(min(e, wend+1) - wstart)
+
+        diff = np.zeros(size+1, dtype=np.int64)
+        if starts:
+            diff += np.bincount(starts, minlength=size+1)
+            diff -= np.bincount(ends, minlength=size+1)
+        depth = np.cumsum(diff[:size]).astype(float)
+
+        for i in members:
+            (chrom, start, end) = regions[i]
+            depths[i] = depth[start-wstart:end-wstart+1]
+    return depths
+
+def pileupbase(pread):
+    '''
+    query position of the base a pysam PileupRead contributes to its column, None for deletions
+    and reference skips (query_position, qpos in older pysam)
+    '''
+    if pread.is_del or getattr(pread, 'is_refskip', False):
+        return None
+    if hasattr(pread, 'query_position'):
+        return pread.query_position
+    return pread.qpos
+
+def readcolumns(read):
+    '''
+    (reference position, query position, is_del) for each reference base covered by read, as
+    in the pileup column entries for the read: deletions and reference skips have is_del True
+    and the query position of the next aligned base
+    '''
+    columns = []
+    pos  = read.pos
+    qpos = 0
+    for (op, n) in read.cigar:
+        if op in (0, 7, 8): # M, =, X
+            columns.extend([(pos+k, qpos+k, False) for k in range(n)])
+            pos  += n
+            qpos += n
+        elif op in (2, 3): # D, N
+            columns.extend([(pos+k, qpos, True) for k in range(n)])
+            pos += n
+        elif op in (1, 4): # I, S
+            qpos += n
+    return columns
+
+def sweep(bam, chrom, positions, mask=MASK):
+    '''
+    generator over sorted positions on chrom, yields (pos, [(read, readcolumns(read))]) with
+    the reads a pileup column at pos would hold, in file order. The .bam is read once from the
+    first to the last position, reads are kept while they can still cover a later position.
+    '''
+    reads = iter([])
+    if positions and chrom in bam.references:
+        reads = bam.fetch(chrom, positions[0], positions[-1]+1)
+
+    active = []
+    nextread = next(reads, None)
+    for pos in positions:
+        # new list for each position, lists already yielded are not changed
+        active = [(read, cols) for (read, cols) in active if cols[-1][0] >= pos]
+        while nextread is not None and nextread.pos <= pos:
+            # reads ending before pos are dropped before their columns are built
+            if not nextread.flag & mask and nextread.aend is not None and nextread.aend > pos:
+                columns = readcolumns(nextread)
+                if columns and columns[-1][0] >= pos:
+                    active.append((nextread, columns))
+            nextread = next(reads, None)
+        yield (pos, active)
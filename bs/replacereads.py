@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
-import sys,pysam,argparse
+import sys,os,re,struct,pysam,argparse,tempfile,shutil,multiprocessing
+from array import array
+from bisect import bisect_left
+import bgzf
+import metrics
 from random import randint
 
 def cleanup(read,RG):
@@ -46,19 +50,82 @@ def getExcludedReads(file):
     f.close()
     return ex
 
-#replaceReads(targetbam, donorbam, outputbam, args.namechange, args.exclfile, args.all, args.keepqual, args.progress)
-def replaceReads(targetbam, donorbam, outputbam, nameprefix=None, excludefile=None, allreads=False, keepqual=False, progress=False):
-    ''' targetbam, donorbam, and outputbam are pysam.Samfile objects
-        outputbam must be writeable and use targetbam as template
-        read names in excludefile will not appear in final output
+def pairName(read):
+    ''' 'F' if read is first in pair, 'S' if second, 'U' if unpaired '''
+    if not read.is_paired:
+        return 'U'
+    if read.is_read2:
+        return 'S'
+    return 'F'
+
+def strnumCmp(a, b):
+    ''' compare read names as samtools sort -n does (port of strnum_cmp() in bam_sort.c):
+        digit runs compare as numbers, anything else by byte value, returns <0, 0 or >0
     '''
-    RG = getRGs(targetbam) # read groups
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i].isdigit() and b[j].isdigit():
+            while i < len(a) and a[i] == '0':
+                i += 1
+            while j < len(b) and b[j] == '0':
+                j += 1
+            while i < len(a) and j < len(b) and a[i].isdigit() and a[i] == b[j]:
+                i += 1
+                j += 1
+            da = i < len(a) and a[i].isdigit()
+            db = j < len(b) and b[j].isdigit()
+            if da and db:
+                k = 0
+                while i+k < len(a) and j+k < len(b) and a[i+k].isdigit() and b[j+k].isdigit():
+                    k += 1
+                if i+k < len(a) and a[i+k].isdigit():
+                    return 1
+                if j+k < len(b) and b[j+k].isdigit():
+                    return -1
+                return ord(a[i]) - ord(b[j])
+            elif da:
+                return 1
+            elif db:
+                return -1
+            elif i != j: # same number with a different count of leading zeros
+                if i < j:
+                    return 1
+                return -1
+        else:
+            if a[i] != b[j]:
+                return ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+    if i < len(a):
+        return 1
+    if j < len(b):
+        return -1
+    return 0
 
-    exclude = {}
-    if excludefile:
-        exclude = getExcludedReads(excludefile)
+def groupByName(bam, progress=False):
+    ''' yield (qname, [reads]) for runs of reads with the same name from a name-sorted .bam '''
+    group = []
+    prog = 0
+    for read in bam: # sequential read, also works on a bgzf.BamPipe
+        prog += 1
+        if progress and prog % 10000000 == 0:
+            sys.stderr.write("processed " + str(prog) + " reads.\n")
+
+        if group and read.qname == group[0].qname:
+            group.append(read)
+            continue
+
+        if group:
+            if strnumCmp(read.qname, group[0].qname) < 0:
+                raise ValueError("input .bam is not sorted by read name (samtools sort -n): " + read.qname + " follows " + group[0].qname)
+            yield (group[0].qname, group)
+        group = [read]
+
+    if group:
+        yield (group[0].qname, group)
 
-    # load reads from donorbam into dict 
+def loadDonorReads(donorbam, exclude, nameprefix=None):
+    ''' load reads from donorbam into dict keyed by read name + pairName() '''
     sys.stderr.write("loading donor reads into dictionary...\n")
     nr = 0
     rdict = {}
@@ -67,11 +134,7 @@ def replaceReads(targetbam, donorbam, outputbam, nameprefix=None, excludefile=No
     for read in donorbam.fetch(until_eof=True):
         if read.seq: # sanity check - don't include null reads
             if read.qname not in exclude:
-                pairname = 'F' # read is first in pair
-                if read.is_read2:
-                    pairname = 'S' # read is second in pair
-                if not read.is_paired:
-                    pairname = 'U' # read is unpaired
+                pairname = pairName(read)
                 if nameprefix:
                     qual = read.qual # temp
                     read.qname = nameprefix + read.qname # must set name _before_ setting quality (see pysam docs)
@@ -85,23 +148,214 @@ def replaceReads(targetbam, donorbam, outputbam, nameprefix=None, excludefile=No
             nullcount += 1
 
     sys.stderr.write("loaded " + str(nr) + " reads, (" + str(excount) + " excluded, " + str(nullcount) + " null-->ignored)\n")
+    metrics.count('donor_reads_loaded', nr)
+    metrics.count('donor_reads_excluded', excount)
+    metrics.count('donor_reads_null', nullcount)
+    return rdict
+
+# BAM record decoding for DonorTable, see the SAM/BAM format specification (section 4.2)
+SEQCODES  = '=ACMGRSVTWYHKDBN'
+SEQPAIRS  = [a + b for a in SEQCODES for b in SEQCODES] # byte of packed sequence --> two bases
+QUALCHARS = ''.join([chr(min(q, 93) + 33) for q in range(256)]) # phred --> phred+33 character
+TAGTYPES  = {'c': 'b', 'C': 'B', 's': 'h', 'S': 'H', 'i': 'i', 'I': 'I', 'f': 'f'} # tag type --> struct format
+
+def recordIdent(data):
+    ''' (read name, pairName()) of a raw BAM record (as from bgzf.readRecord()) '''
+    namelen = ord(data[12])
+    (flag,) = struct.unpack_from('<H', data, 18)
+    if not flag & 0x1:
+        return (data[36:35+namelen], 'U')
+    if flag & 0x80:
+        return (data[36:35+namelen], 'S')
+    return (data[36:35+namelen], 'F')
+
+def unpackTags(data, i):
+    ''' list of (tag, value) from the optional fields of a raw BAM record starting at offset i '''
+    tags = []
+    while i < len(data):
+        tag = data[i:i+2]
+        tagtype = data[i+2]
+        i += 3
+        if tagtype == 'A':
+            value = data[i]
+            i += 1
+        elif tagtype in TAGTYPES:
+            fmt = '<' + TAGTYPES[tagtype]
+            (value,) = struct.unpack_from(fmt, data, i)
+            i += struct.calcsize(fmt)
+        elif tagtype in ('Z', 'H'):
+            end = data.index('\0', i)
+            value = data[i:end]
+            i = end + 1
+        elif tagtype == 'B':
+            (count,) = struct.unpack_from('<i', data, i+1)
+            fmt = '<' + str(count) + TAGTYPES[data[i]]
+            value = list(struct.unpack_from(fmt, data, i+5))
+            i += 5 + struct.calcsize(fmt)
+        else:
+            raise ValueError("unknown tag type in BAM record: " + tagtype)
+        tags.append((tag, value))
+    return tags
+
+def unpackRecord(data, nameprefix=None):
+    ''' new AlignedRead from a raw BAM record (as from bgzf.readRecord()) '''
+    (tid, pos, namelen, mapq, binid, ncigar, flag, seqlen, mrnm, mpos, isize) = struct.unpack_from('<iiBBHHHiiii', data, 4)
+    i = 36
+    qname = data[i:i+namelen-1]
+    i += namelen
+    cigar = [(op & 0xf, op >> 4) for op in struct.unpack_from('<' + str(ncigar) + 'I', data, i)]
+    i += 4*ncigar
+    seq = ''.join([SEQPAIRS[b] for b in bytearray(data[i:i+(seqlen+1)/2])])[:seqlen]
+    i += (seqlen+1)/2
+    qual = None
+    if seqlen > 0 and data[i] != '\xff':
+        qual = data[i:i+seqlen].translate(QUALCHARS)
+    i += seqlen
+
+    read = pysam.AlignedRead()
+    if nameprefix:
+        qname = nameprefix + qname
+    read.qname = qname # must set name and seq _before_ setting quality (see pysam docs)
+    read.seq   = seq
+    read.flag  = flag
+    read.tid   = tid
+    read.pos   = pos
+    read.mapq  = mapq
+    if cigar:
+        read.cigar = cigar
+    read.mrnm  = mrnm
+    read.mpos  = mpos
+    read.isize = isize
+    read.qual  = qual
+    read.tags  = unpackTags(data, i)
+    return read
+
+class HashSet:
+    ''' set of strings stored as a sorted array of their hashes, membership is checked by bisection '''
+    def __init__(self, names=()):
+        self.keys = array('l', sorted(set(hash(name) for name in names)))
+
+    def __contains__(self, name):
+        h = hash(name)
+        i = bisect_left(self.keys, h)
+        return i < len(self.keys) and self.keys[i] == h
+
+    def __len__(self):
+        return len(self.keys)
+
+class DonorTable:
+    '''
+    donor reads kept as raw BAM records in one contiguous buffer, found by the hash of (read name,
+    pairName()) in a sorted key array, used instead of a dict of AlignedRead objects. Records are
+    read from the donor .bam file with bgzf.BgzfReader and only decoded when a read is used.
+    Later reads with the same name and pairname replace earlier ones, as in loadDonorReads().
+    '''
+    def __init__(self, donorbam, exclude, nameprefix=None):
+        sys.stderr.write("loading donor reads into compact table...\n")
+        self.nameprefix = nameprefix
+        buf = bytearray()
+        keys    = array('l')
+        offsets = array('L')
+        excount = 0 # number of excluded reads
+        nullcount = 0 # number of null reads
+
+        fh = open(donorbam.filename, 'rb')
+        reader = bgzf.BgzfReader(fh)
+        bgzf.skipBamHeader(reader)
+        rec = bgzf.readRecord(reader)
+        while rec is not None:
+            data = rec[2]
+            (qname, pairname) = recordIdent(data)
+            if struct.unpack_from('<i', data, 20)[0] > 0: # sanity check - don't include null reads
+                if qname not in exclude:
+                    if nameprefix:
+                        qname = nameprefix + qname
+                    keys.append(hash((qname, pairname)))
+                    offsets.append(len(buf))
+                    buf.extend(data)
+                else: # excluded
+                    excount += 1
+            else: # no seq!
+                nullcount += 1
+            rec = bgzf.readRecord(reader)
+        fh.close()
+        offsets.append(len(buf))
+
+        # sort by key, stable so the last of several reads with the same name and pairname is kept
+        order = sorted(xrange(len(keys)), key=keys.__getitem__)
+        self.buf = buf
+        self.keys    = array('l')
+        self.offsets = array('L')
+        self.lengths = array('L')
+        i = 0
+        while i < len(order):
+            j = i
+            while j < len(order) and keys[order[j]] == keys[order[i]]:
+                j += 1
+            last = {} # (read name, pairname) --> entry, only more than one if hashes collide
+            for k in order[i:j]:
+                last[self._ident(offsets[k], offsets[k+1]-offsets[k])] = k
+            for k in sorted(last.values()):
+                self.keys.append(keys[k])
+                self.offsets.append(offsets[k])
+                self.lengths.append(offsets[k+1]-offsets[k])
+            i = j
+        self.used = bytearray(len(self.keys))
+
+        sys.stderr.write("loaded " + str(len(keys)) + " reads, (" + str(excount) + " excluded, " + str(nullcount) + " null-->ignored)\n")
+        metrics.count('donor_reads_loaded', len(keys))
+        metrics.count('donor_reads_excluded', excount)
+        metrics.count('donor_reads_null', nullcount)
+
+    def _ident(self, offset, length):
+        (qname, pairname) = recordIdent(bytes(self.buf[offset:offset+min(length, 36+256)]))
+        if self.nameprefix:
+            qname = self.nameprefix + qname
+        return (qname, pairname)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, qname, pairname):
+        ''' index of the read with qname and pairname, or -1 '''
+        h = hash((qname, pairname))
+        i = bisect_left(self.keys, h)
+        while i < len(self.keys) and self.keys[i] == h:
+            if self._ident(self.offsets[i], self.lengths[i]) == (qname, pairname): # rule out hash collisions
+                return i
+            i += 1
+        return -1
+
+    def read(self, i):
+        ''' new AlignedRead for entry i '''
+        return unpackRecord(bytes(self.buf[self.offsets[i]:self.offsets[i]+self.lengths[i]]), self.nameprefix)
+
+#replaceReads(targetbam, donorbam, outputbam, args.namechange, args.exclfile, args.all, args.keepqual, args.progress)
+def replaceReads(targetbam, donorbam, outputbam, nameprefix=None, excludefile=None, allreads=False, keepqual=False, progress=False):
+    ''' targetbam, donorbam, and outputbam are pysam.Samfile objects
+        outputbam must be writeable and use targetbam as template
+        read names in excludefile will not appear in final output
+    '''
+    RG = getRGs(targetbam) # read groups
+
+    exclude = {}
+    if excludefile:
+        exclude = getExcludedReads(excludefile)
+
+    rdict = loadDonorReads(donorbam, exclude, nameprefix)
 
     excount = 0
     recount = 0 # number of replaced reads
     used = {}
     prog = 0
-    for read in targetbam.fetch(until_eof=True):
+    for read in targetbam: # sequential read, also works on a bgzf.BamPipe
 
         prog += 1
         if progress and prog % 10000000 == 0:
             sys.stderr.write("processed " + str(prog) + " reads.\n")
 
         if read.qname not in exclude:
-            pairname = 'F' # read is first in pair
-            if read.is_read2:
-                pairname = 'S' # read is second in pair
-            if not read.is_paired:
-                pairname = 'U' # read is unpaired
+            pairname = pairName(read)
             if nameprefix:
                 qual = read.qual # temp
                 read.qname = nameprefix + read.qname
@@ -122,6 +376,8 @@ def replaceReads(targetbam, donorbam, outputbam, nameprefix=None, excludefile=No
             excount += 1
 
     sys.stderr.write("replaced " + str(recount) + " reads (" + str(excount) + " excluded )\n")
+    metrics.count('reads_replaced', recount)
+    metrics.count('reads_excluded', excount)
 
     nadded = 0
     # dump the unused reads from the donor if requested with --all
@@ -132,18 +388,590 @@ def replaceReads(targetbam, donorbam, outputbam, nameprefix=None, excludefile=No
                 outputbam.write(rdict[extqname])
                 nadded += 1
         sys.stderr.write("added " + str(nadded) + " reads due to --all\n")
+        metrics.count('reads_added', nadded)
 
-def main(args):
-    targetbam = pysam.Samfile(args.targetbam, 'rb')
-    donorbam  = pysam.Samfile(args.donorbam, 'rb')
-    outputbam = pysam.Samfile(args.outputbam, 'wb', template=targetbam)
+def replaceReadsCompact(targetbam, donorbam, outputbam, nameprefix=None, excludefile=None, allreads=False, keepqual=False, progress=False):
+    ''' same as replaceReads(), with donor reads held in a DonorTable and excluded read names in a
+        HashSet instead of dicts (lower memory for large donor .bams)
+    '''
+    RG = getRGs(targetbam) # read groups
+
+    exclude = HashSet()
+    if excludefile:
+        exclude = HashSet(getExcludedReads(excludefile))
+
+    donors = DonorTable(donorbam, exclude, nameprefix)
+
+    excount = 0
+    recount = 0 # number of replaced reads
+    prog = 0
+    for read in targetbam: # sequential read, also works on a bgzf.BamPipe
+
+        prog += 1
+        if progress and prog % 10000000 == 0:
+            sys.stderr.write("processed " + str(prog) + " reads.\n")
+
+        if read.qname not in exclude:
+            pairname = pairName(read)
+            if nameprefix:
+                qual = read.qual # temp
+                read.qname = nameprefix + read.qname
+                read.qual = qual
+
+            i = donors.find(read.qname, pairname)
+            if i >= 0: # replace read
+                donor = donors.read(i)
+                if keepqual:
+                    donor.qual = read.qual
+                outputbam.write(cleanup(donor,RG))  # write read from donor .bam
+                donors.used[i] = 1
+                recount += 1
+            else:
+                read = cleanup(read,RG)
+                outputbam.write(read) # write read from target .bam
+        else:
+            excount += 1
+
+    sys.stderr.write("replaced " + str(recount) + " reads (" + str(excount) + " excluded )\n")
+    metrics.count('reads_replaced', recount)
+    metrics.count('reads_excluded', excount)
+
+    nadded = 0
+    # dump the unused reads from the donor if requested with --all
+    if allreads:
+        for i in range(len(donors)):
+            if not donors.used[i]:
+                outputbam.write(cleanup(donors.read(i),RG))
+                nadded += 1
+        sys.stderr.write("added " + str(nadded) + " reads due to --all\n")
+        metrics.count('reads_added', nadded)
+
+def replaceReadsNameSorted(targetbam, donorbam, outputbam, nameprefix=None, excludefile=None, allreads=False, keepqual=False, progress=False):
+    ''' same as replaceReads() for targetbam and donorbam both sorted by read name (samtools sort -n):
+        both files are streamed once as a merge-join, donor reads are never all held in memory.
+        With allreads, unmatched donor reads are written in name order rather than at the end.
+    '''
+    RG = getRGs(targetbam) # read groups
+
+    exclude = {}
+    if excludefile:
+        exclude = getExcludedReads(excludefile)
+
+    def rename(read):
+        if nameprefix:
+            qual = read.qual # temp
+            read.qname = nameprefix + read.qname # must set name _before_ setting quality (see pysam docs)
+            read.qual = qual
+        return read
+
+    n = {'donor': 0, 'donorex': 0, 'null': 0, 'targetex': 0, 'replaced': 0, 'added': 0}
+
+    def donorGroups():
+        ''' yield (qname, {pairname: read}) for donor reads, filtered as in replaceReads() '''
+        for qname, reads in groupByName(donorbam):
+            donor = {}
+            for read in reads:
+                if read.seq: # sanity check - don't include null reads
+                    if read.qname not in exclude:
+                        donor[pairName(read)] = rename(read)
+                        n['donor'] += 1
+                    else: # excluded
+                        n['donorex'] += 1
+                else: # no seq!
+                    n['null'] += 1
+            yield (qname, donor)
+
+    def addUnused(donor, used):
+        if allreads:
+            for pairname, read in donor.iteritems():
+                if pairname not in used:
+                    outputbam.write(cleanup(read,RG))
+                    n['added'] += 1
+
+    donors = donorGroups()
+    nextdonor = next(donors, None)
+
+    for qname, reads in groupByName(targetbam, progress=progress):
+        # donor reads with no match in the target
+        while nextdonor is not None and strnumCmp(nextdonor[0], qname) < 0:
+            addUnused(nextdonor[1], {})
+            nextdonor = next(donors, None)
+
+        donor = {}
+        if nextdonor is not None and nextdonor[0] == qname:
+            donor = nextdonor[1]
+            nextdonor = next(donors, None)
+
+        used = {}
+        for read in reads:
+            if read.qname not in exclude:
+                pairname = pairName(read)
+                read = rename(read)
+                if pairname in donor: # replace read
+                    if keepqual:
+                        donor[pairname].qual = read.qual
+                    donor[pairname] = cleanup(donor[pairname],RG)
+                    outputbam.write(donor[pairname])  # write read from donor .bam
+                    used[pairname] = True
+                    n['replaced'] += 1
+                else:
+                    outputbam.write(cleanup(read,RG)) # write read from target .bam
+            else:
+                n['targetex'] += 1
+
+        addUnused(donor, used)
+
+    while nextdonor is not None:
+        addUnused(nextdonor[1], {})
+        nextdonor = next(donors, None)
+
+    sys.stderr.write("loaded " + str(n['donor']) + " reads, (" + str(n['donorex']) + " excluded, " + str(n['null']) + " null-->ignored)\n")
+    metrics.count('donor_reads_loaded', n['donor'])
+    metrics.count('donor_reads_excluded', n['donorex'])
+    metrics.count('donor_reads_null', n['null'])
+    sys.stderr.write("replaced " + str(n['replaced']) + " reads (" + str(n['targetex']) + " excluded )\n")
+    metrics.count('reads_replaced', n['replaced'])
+    metrics.count('reads_excluded', n['targetex'])
+    if allreads:
+        sys.stderr.write("added " + str(n['added']) + " reads due to --all\n")
+        metrics.count('reads_added', n['added'])
+
+def recordKey(refid, pos):
+    ''' sort key of a record in a coordinate-sorted .bam, unplaced reads (refid -1) sort last '''
+    if refid < 0:
+        return (sys.maxint, 0)
+    return (refid, pos)
+
+class RecordScanner:
+    '''
+    finds virtual offsets of record boundaries in a coordinate-sorted, indexed .bam
+    without pysam, boundaries must be requested in increasing order
+    '''
+    def __init__(self, bamfile, baifile):
+        self.fh = open(bamfile, 'rb')
+        self.reader = bgzf.BgzfReader(self.fh)
+        bgzf.skipBamHeader(self.reader)
+        self.linear = bgzf.readBaiLinear(baifile)
+        self.peek = self._next() # (virtual offset, key) of next unconsumed record
 
-    replaceReads(targetbam, donorbam, outputbam, args.namechange, args.exclfile, args.all, args.keepqual, args.progress)
+    def _next(self):
+        voffset = self.reader.tell()
+        rec = bgzf.readRecord(self.reader)
+        if rec is None:
+            return (voffset, None)
+        return (voffset, recordKey(rec[0], rec[1]))
+
+    def lowerBound(self, key):
+        ''' virtual offset at or before the first record with sort key >= key, from the linear index '''
+        (refid, pos) = key
+        if refid >= len(self.linear): # unplaced reads: after everything in the index
+            offsets = [max(lin) for lin in self.linear if lin]
+            if offsets:
+                return max(offsets)
+            return 0
+
+        for r in range(refid, -1, -1):
+            lin = self.linear[r]
+            if lin:
+                if r == refid:
+                    offset = lin[min(pos >> 14, len(lin)-1)]
+                else:
+                    offset = lin[-1]
+                if offset > 0:
+                    return offset
+        return 0
+
+    def find(self, key, jump=True):
+        ''' returns (voffset, n): virtual offset of first record with sort key >= key and the
+            number of records passed over to get there (only meaningful if jump is False)
+        '''
+        n = 0
+        if jump and self.peek[1] is not None and self.peek[1] < key:
+            lb = self.lowerBound(key)
+            if lb > self.peek[0]:
+                self.reader.seek(lb)
+                self.peek = self._next()
+
+        while self.peek[1] is not None and self.peek[1] < key:
+            self.peek = self._next()
+            n += 1
+        return (self.peek[0], n)
+
+    def close(self):
+        self.fh.close()
+
+def donorIntervals(targetbam, donorbam, rdict, padding):
+    ''' returns (sorted list of (tid, start, end) intervals in targetbam covering donor reads and
+        their mates, True if some donor reads have no position)
+    '''
+    spans = {}
+    unplaced = False
+    for read in rdict.itervalues():
+        placed = False
+        locs = []
+        if read.tid >= 0:
+            locs.append((read.tid, read.pos))
+        if read.is_paired and read.mrnm >= 0:
+            locs.append((read.mrnm, read.mpos))
+        for (tid, pos) in locs:
+            ttid = targetbam.gettid(donorbam.getrname(tid))
+            if ttid >= 0:
+                spans.setdefault(ttid, []).append((max(0, pos-padding), pos+len(read.seq)+padding))
+                placed = True
+        if not placed:
+            unplaced = True
+
+    intervals = []
+    for tid in sorted(spans.keys()):
+        merged = []
+        for (start, end) in sorted(spans[tid]):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        for (start, end) in merged:
+            intervals.append((tid, start, end))
+    return (intervals, unplaced)
+
+def replaceReadsRegions(targetbamfile, donorbam, outputbamfile, excludefile=None, keepqual=False, padding=1000, level=6, threads=1):
+    '''
+    same as replaceReads() for a coordinate-sorted and indexed target .bam (given by file name):
+    only reads starting within 'padding' bp of donor reads or their mates (plus unplaced reads at
+    the end of the file if there are unplaced donor reads) are decoded. All other compressed blocks
+    are copied verbatim, so the untouched reads skip cleanup(). The output is indexed if it is still
+    sorted. Donor reads whose originals lie outside these regions are not replaced. Excluded reads
+    can't be located without decoding the whole target, so a non-empty excludefile raises ValueError,
+    and there is no allreads option: an unmatched donor read may still have its original outside the
+    regions, appending it would duplicate the read (see replaceBams()).
+    '''
+    exclude = {}
+    if excludefile:
+        exclude = getExcludedReads(excludefile)
+    if exclude:
+        raise ValueError("excluded reads (-x) can't be removed when replacing regions")
+
+    targetbam = pysam.Samfile(targetbamfile, 'rb')
+    RG = getRGs(targetbam) # read groups
+
+    rdict = loadDonorReads(donorbam, exclude)
+
+    (intervals, unplaced) = donorIntervals(targetbam, donorbam, rdict, padding)
+    ranges = [((tid, start), (tid, end)) for (tid, start, end) in intervals]
+    if unplaced:
+        ranges.append(((sys.maxint, 0), (sys.maxint, sys.maxint)))
+
+    sys.stderr.write("re-encoding " + str(len(ranges)) + " regions, copying the rest of the .bam\n")
+
+    baifile = targetbamfile + '.bai'
+    if not os.path.exists(baifile):
+        baifile = re.sub('.bam$', '.bai', targetbamfile)
+    scanner = RecordScanner(targetbamfile, baifile)
+    copyfh  = open(targetbamfile, 'rb')
+    outfile = bgzf.BgzfWriter(open(outputbamfile, 'wb'), level, threads)
+    tmpbamfile = outputbamfile + ".region.tmp.bam"
+
+    excount = 0
+    recount = 0 # number of replaced reads
+    decoded = 0 # number of target reads decoded
+    used = {}
+    cur = 0 # virtual offset of first target byte not yet written to output
+    for (startkey, endkey) in ranges:
+        (vstart, skipped) = scanner.find(startkey)
+        (vend, nrecs) = scanner.find(endkey, jump=False)
+        if nrecs == 0:
+            continue
+
+        bgzf.copyRange(copyfh, cur, vstart, outfile)
+
+        # decode, replace and re-encode reads in region
+        tmpbam = pysam.Samfile(tmpbamfile, 'wb', template=targetbam)
+        targetbam.seek(vstart)
+        for i in range(nrecs):
+            read = targetbam.next()
+            decoded += 1
+            if read.qname not in exclude:
+                extqname = ','.join((read.qname,pairName(read)))
+                if extqname in rdict: # replace read
+                    if keepqual:
+                        rdict[extqname].qual = read.qual
+                    rdict[extqname] = cleanup(rdict[extqname],RG)
+                    tmpbam.write(rdict[extqname])  # write read from donor .bam
+                    used[extqname] = True
+                    recount += 1
+                else:
+                    tmpbam.write(cleanup(read,RG)) # write read from target .bam
+            else:
+                excount += 1
+        tmpbam.close()
+        bgzf.copyRecords(tmpbamfile, outfile)
+
+        cur = vend
+
+    bgzf.copyRange(copyfh, cur, bgzf.fileEnd(copyfh), outfile)
+    scanner.close()
+    copyfh.close()
+
+    sys.stderr.write("replaced " + str(recount) + " reads (" + str(excount) + " excluded, " + str(decoded) + " decoded)\n")
+    metrics.count('reads_replaced', recount)
+    metrics.count('reads_excluded', excount)
+
+    missing = len([key for key in rdict if key not in used])
+    if missing > 0:
+        sys.stderr.write("warning: " + str(missing) + " donor reads did not match a read in the re-encoded regions\n")
+
+    if os.path.exists(tmpbamfile):
+        os.remove(tmpbamfile)
+    outfile.close()
+    targetbam.close()
+
+    if os.path.exists(outputbamfile + '.bai'):
+        os.remove(outputbamfile + '.bai')
+    try:
+        pysam.index(outputbamfile)
+    except pysam.SamtoolsError: # older pysam only prints the error
+        pass
+    if not os.path.exists(outputbamfile + '.bai'):
+        sys.stderr.write("warning: could not index " + outputbamfile + " (not sorted?)\n")
+
+# donor reads etc. for replaceShard(), set before forking workers in replaceReadsSharded()
+_shard = {}
+
+def replaceShard(job):
+    ''' worker for replaceReadsSharded(): replace reads starting in one region of the target,
+        job is (shard file, chrom, start, end). Returns (shard file, used donor keys, replaced, excluded)
+    '''
+    (shardfile, chrom, start, end) = job
+    rdict   = _shard['rdict']
+    exclude = _shard['exclude']
+    RG      = _shard['RG']
+
+    targetbam = pysam.Samfile(_shard['target'], 'rb')
+    outputbam = pysam.Samfile(shardfile, 'wb', template=targetbam)
+
+    excount = 0
+    recount = 0
+    used = []
+    for read in targetbam.fetch(chrom, start, end):
+        if read.pos < start: # belongs to previous shard
+            continue
+        if read.qname not in exclude:
+            pairname = pairName(read)
+            if _shard['nameprefix']:
+                qual = read.qual # temp
+                read.qname = _shard['nameprefix'] + read.qname
+                read.qual = qual
+
+            extqname = ','.join((read.qname,pairname))
+            if extqname in rdict: # replace read
+                donor = rdict[extqname]
+                if _shard['keepqual']:
+                    donor.qual = read.qual
+                outputbam.write(cleanup(donor,RG))  # write read from donor .bam
+                used.append(extqname)
+                recount += 1
+            else:
+                outputbam.write(cleanup(read,RG)) # write read from target .bam
+        else:
+            excount += 1
+
+    outputbam.close()
+    targetbam.close()
+    return (shardfile, used, recount, excount)
+
+def replaceReadsSharded(targetbamfile, donorbam, outputbamfile, nameprefix=None, excludefile=None, allreads=False, keepqual=False,
+                        procs=1, shardsize=None, level=6, threads=1):
+    '''
+    same as replaceReads() for a coordinate-sorted and indexed target .bam (given by file name):
+    the target is split into per-contig shards (or shards of shardsize bp) that are processed by
+    'procs' worker processes. Shards are concatenated in reference order, followed by a final shard
+    with unplaced reads and (with allreads) donor reads that did not match a target read.
+    '''
+    targetbam = pysam.Samfile(targetbamfile, 'rb')
+    RG = getRGs(targetbam) # read groups
+
+    exclude = {}
+    if excludefile:
+        exclude = getExcludedReads(excludefile)
+
+    rdict = loadDonorReads(donorbam, exclude, nameprefix)
+
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outputbamfile)))
+    jobs = []
+    for (chrom, length) in zip(targetbam.references, targetbam.lengths):
+        if shardsize is None:
+            step = length
+        else:
+            step = int(shardsize)
+        for start in range(0, length, step):
+            jobs.append((os.path.join(tmpdir, "shard." + str(len(jobs)) + ".bam"), chrom, start, min(start+step, length)))
+
+    sys.stderr.write("replacing reads in " + str(len(jobs)) + " shards using " + str(procs) + " processes\n")
+
+    _shard.update({'target': targetbamfile, 'rdict': rdict, 'exclude': exclude, 'RG': RG,
+                   'nameprefix': nameprefix, 'keepqual': keepqual})
+
+    if procs > 1:
+        pool = multiprocessing.Pool(processes=procs)
+        results = pool.map(replaceShard, jobs, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        results = map(replaceShard, jobs)
+
+    shardfiles = []
+    used = {}
+    excount = 0
+    recount = 0
+    for (shardfile, shardused, shardre, shardex) in results:
+        shardfiles.append(shardfile)
+        for extqname in shardused:
+            used[extqname] = True
+        recount += shardre
+        excount += shardex
+
+    # final shard: unplaced reads at the end of the target, then unused donor reads
+    finalfile = os.path.join(tmpdir, "shard.final.bam")
+    outputbam = pysam.Samfile(finalfile, 'wb', template=targetbam)
+
+    baifile = targetbamfile + '.bai'
+    if not os.path.exists(baifile):
+        baifile = re.sub('.bam$', '.bai', targetbamfile)
+    scanner = RecordScanner(targetbamfile, baifile)
+    (vstart, skipped) = scanner.find((sys.maxint, 0))
+    (vend, nunplaced) = scanner.find((sys.maxint, sys.maxint), jump=False)
+    scanner.close()
+
+    if nunplaced > 0:
+        targetbam.seek(vstart)
+        for i in range(nunplaced):
+            read = targetbam.next()
+            if read.qname not in exclude:
+                pairname = pairName(read)
+                if nameprefix:
+                    qual = read.qual # temp
+                    read.qname = nameprefix + read.qname
+                    read.qual = qual
+
+                extqname = ','.join((read.qname,pairname))
+                if extqname in rdict: # replace read
+                    if keepqual:
+                        rdict[extqname].qual = read.qual
+                    outputbam.write(cleanup(rdict[extqname],RG))  # write read from donor .bam
+                    used[extqname] = True
+                    recount += 1
+                else:
+                    outputbam.write(cleanup(read,RG)) # write read from target .bam
+            else:
+                excount += 1
+
+    sys.stderr.write("replaced " + str(recount) + " reads (" + str(excount) + " excluded )\n")
+    metrics.count('reads_replaced', recount)
+    metrics.count('reads_excluded', excount)
+
+    # dump the unused reads from the donor if requested with --all
+    if allreads:
+        nadded = 0
+        for extqname in rdict.keys():
+            if extqname not in used and extqname not in exclude:
+                outputbam.write(cleanup(rdict[extqname],RG))
+                nadded += 1
+        sys.stderr.write("added " + str(nadded) + " reads due to --all\n")
+        metrics.count('reads_added', nadded)
+
+    outputbam.close()
+    targetbam.close()
+    shardfiles.append(finalfile)
+
+    # concatenate shards: header from the first shard, compressed blocks copied as-is where possible
+    outfile = bgzf.BgzfWriter(open(outputbamfile, 'wb'), level, threads)
+    for i, shardfile in enumerate(shardfiles):
+        fh = open(shardfile, 'rb')
+        start = 0
+        if i > 0:
+            start = bgzf.skipBamHeader(bgzf.BgzfReader(fh))
+        bgzf.copyRange(fh, start, bgzf.fileEnd(fh), outfile)
+        fh.close()
+    outfile.close()
+
+    shutil.rmtree(tmpdir)
+
+def replaceBams(targetfile, donorfile, outputfile, nameprefix=None, excludefile=None, allreads=False, keepqual=False, progress=False,
+                namesorted=False, regions=False, padding=1000, procs=1, shardsize=None, compact=False, threads=1, level=None):
+    ''' open .bam files by name and call replaceReads (or the engine selected by namesorted/regions).
+        If threads > 1 or a compression level is given, BGZF decompression of the target and
+        compression of the output run in separate processes with 'threads' threads each.
+        With procs > 1 or shardsize, the target (sorted and indexed) is processed in shards.
+        With compact, donor reads are held in a DonorTable (see replaceReadsCompact()).
+    '''
+    if level is None:
+        complevel = 6
+    else:
+        complevel = int(level)
+
+    metrics.filesize('bam_read', targetfile)
+    donorbam = pysam.Samfile(donorfile, 'rb')
+
+    if regions and excludefile and getExcludedReads(excludefile):
+        # excluded reads may lie anywhere in the target, only a full pass removes all of them
+        sys.stderr.write("warning: excluded reads given, replacing reads in the whole .bam instead of regions\n")
+        regions = False
+
+    if regions and allreads:
+        raise ValueError("unmatched donor reads (--all) can't be added when replacing regions")
+
+    if regions:
+        if nameprefix:
+            raise ValueError("name prefix (-n) can't be used when replacing regions")
+        replaceReadsRegions(targetfile, donorbam, outputfile, excludefile, keepqual, padding, complevel, threads)
+        donorbam.close()
+        metrics.filesize('bam_written', outputfile)
+        return
+
+    if procs > 1 or shardsize is not None:
+        replaceReadsSharded(targetfile, donorbam, outputfile, nameprefix, excludefile, allreads, keepqual, procs, shardsize, complevel, threads)
+        donorbam.close()
+        metrics.filesize('bam_written', outputfile)
+        return
+
+    targetpipe = None
+    outputpipe = None
+    if threads > 1:
+        targetpipe = bgzf.BamPipe(targetfile, 'r', threads=threads)
+        targetfile = targetpipe.name
+    targetbam = pysam.Samfile(targetfile, 'rb')
+
+    if threads > 1 or level is not None:
+        outputpipe = bgzf.BamPipe(outputfile, 'w', level=complevel, threads=threads)
+        outputbam = pysam.Samfile(outputpipe.name, 'wbu', template=targetbam)
+    else:
+        outputbam = pysam.Samfile(outputfile, 'wb', template=targetbam)
+
+    if namesorted:
+        replaceReadsNameSorted(targetbam, donorbam, outputbam, nameprefix, excludefile, allreads, keepqual, progress)
+    elif compact:
+        replaceReadsCompact(targetbam, donorbam, outputbam, nameprefix, excludefile, allreads, keepqual, progress)
+    else:
+        replaceReads(targetbam, donorbam, outputbam, nameprefix, excludefile, allreads, keepqual, progress)
 
     targetbam.close()
     donorbam.close()
     outputbam.close()
 
+    if targetpipe is not None:
+        targetpipe.close()
+    if outputpipe is not None:
+        outputpipe.close()
+    metrics.filesize('bam_written', outputfile)
+
+def main(args):
+    metrics.configure(args.metrics)
+    with metrics.stage('replace'):
+        replaceBams(args.targetbam, args.donorbam, args.outputbam, args.namechange, args.exclfile, args.all, args.keepqual, args.progress,
+                    namesorted=args.namesorted, regions=args.regions, padding=int(args.padding), procs=int(args.procs), shardsize=args.shardsize,
+                    compact=args.compact, threads=int(args.threads), level=args.level)
+    if args.metrics:
+        metrics.summary()
+
 if __name__=='__main__':
     parser = argparse.ArgumentParser(description='replaces aligned reads in bamfile1 with aligned reads from bamfile2')
     parser.add_argument('-b', '--bam', dest='targetbam', required=True,
@@ -162,5 +990,28 @@ if __name__=='__main__':
                         help="keep original quality scores, replace read and mapping only")
     parser.add_argument('--progress', action='store_true', default=False,
                         help="output progress every 10M reads")
+    parser.add_argument('--regions', action='store_true', default=False,
+                        help="only re-encode regions of an indexed, sorted target .bam near donor reads, copy the rest as-is (not with -n or --all, ignored if -x lists any reads)")
+    parser.add_argument('--padding', dest='padding', default=1000,
+                        help="with --regions: bp around donor reads and mates to re-encode (default = 1000)")
+    parser.add_argument('-p', '--procs', dest='procs', default=1,
+                        help="split an indexed, sorted target .bam into per-contig shards processed by this many processes (default = 1)")
+    parser.add_argument('--shardsize', dest='shardsize', default=None,
+                        help="shard size in bp instead of one shard per contig (implies sharding)")
+    parser.add_argument('--threads', dest='threads', default=1,
+                        help="threads for BGZF compression/decompression (default = 1)")
+    parser.add_argument('--level', dest='level', default=None,
+                        help="output compression level 0-9 (default = 6), 0 or 1 for intermediate files")
+    parser.add_argument('--compact', action='store_true', default=False,
+                        help="keep donor reads in a compact hashed table instead of a dictionary (less memory)")
+    parser.add_argument('--namesorted', action='store_true', default=False,
+                        help="both .bams are sorted by read name (samtools sort -n), stream both instead of loading donor reads into memory")
+    parser.add_argument('--metrics', dest='metrics', default=None,
+                        help="write timings and read counts to this file (JSON lines) and print a summary at the end")
+    parser.add_argument('--profile', dest='profile', default=None,
+                        help="run under cProfile and save stats to this file")
     args = parser.parse_args()
-    main(args)
+    if args.profile:
+        metrics.profile(main, args, args.profile)
+    else:
+        main(args)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+'''
+Paired-end read simulation from a (mutated) contig, in place of wgsim. Fragments are
+drawn with numpy (normal fragment size, uniform start, random strand) and reads are
+cut out of the sequence as arrays, with no sequencing errors or mutations
+(same as wgsim -e 0 -r 0 -R 0)
+'''
+
+import numpy as np
+
+COMPLEMENT = np.zeros(256, dtype=np.uint8)
+for (b, c) in zip("ACGTNacgtn", "TGCANtgcan"):
+    COMPLEMENT[ord(b)] = ord(c)
+
+def simulate(seq, npairs, len1, len2, dist=500, stdev=50, seed=None):
+    '''
+    returns (reads1, reads2, starts, ends): lists of read sequences as they would be
+    sequenced and the 0-based fragment coordinates of each pair. Fragment sizes are
+    normal(dist, stdev), limited to [max(len1,len2), len(seq)]
+    '''
+    rng = np.random.RandomState(seed)
+    arr = np.frombuffer(seq, dtype=np.uint8)
+    seqlen = len(arr)
+    if npairs <= 0 or seqlen < max(len1, len2):
+        return ([], [], [], [])
+
+    fraglen = np.rint(rng.normal(dist, stdev, npairs)).astype(np.int64)
+    fraglen = np.clip(fraglen, max(len1, len2), seqlen)
+    starts  = (rng.random_sample(npairs) * (seqlen - fraglen + 1)).astype(np.int64)
+    ends    = starts + fraglen
+    flip    = rng.random_sample(npairs) < 0.5 # read 1 from the reverse strand
+
+    # forward read from fragment start, reverse complemented read from fragment end
+    fwd1 = arr[starts[:,None] + np.arange(len1)]
+    rev1 = COMPLEMENT[arr[ends[:,None] - 1 - np.arange(len1)]]
+    fwd2 = arr[starts[:,None] + np.arange(len2)]
+    rev2 = COMPLEMENT[arr[ends[:,None] - 1 - np.arange(len2)]]
+
+    reads1 = np.where(flip[:,None], rev1, fwd1)
+    reads2 = np.where(flip[:,None], fwd2, rev2)
+
+    return ([r.tostring() for r in reads1], [r.tostring() for r in reads2], list(starts), list(ends))
+
+def fitqual(qual, length):
+    ''' trim or pad (with the last quality) qual to length '''
+    if len(qual) >= length:
+        return qual[:length]
+    if not qual:
+        return '#'*length
+    return qual + qual[-1]*(length-len(qual))
+
+def fastqPairs(names, reads1, reads2, quals1, quals2):
+    ''' generator over (read 1, read 2) fastq entries '''
+    for i in range(len(names)):
+        yield ("@" + names[i] + "\n" + reads1[i] + "\n+\n" + fitqual(quals1[i], len(reads1[i])) + "\n",
+               "@" + names[i] + "\n" + reads2[i] + "\n+\n" + fitqual(quals2[i], len(reads2[i])) + "\n")
+
+def writeFastq(pairs, fq1, fq2):
+    ''' write fastq pairs from fastqPairs() to two files '''
+    out1 = open(fq1, 'w')
+    out2 = open(fq2, 'w')
+    for (entry1, entry2) in pairs:
+        out1.write(entry1)
+        out2.write(entry2)
+    out1.close()
+    out2.close()
+
+def interleaved(pairs):
+    ''' generator over interleaved fastq text for pairs from fastqPairs() '''
+    for (entry1, entry2) in pairs:
+        yield entry1 + entry2
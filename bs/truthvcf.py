@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+'''
+Truth VCF for the mutations made by addsnv.py and addsv.py: records are collected
+during a run and written at the end, sorted, bgzip-compressed and tabix-indexed so
+evaluation tools can query it by region
+'''
+
+import os
+import pysam
+import mutableseq
+
+MAXALLELE = 100 # longer REF/ALT sequences are written as symbolic alleles
+
+HEADER = ['##fileformat=VCFv4.1',
+          '##source=bamsurgeon',
+          '##ALT=<ID=DEL,Description="Deletion">',
+          '##ALT=<ID=INS,Description="Insertion">',
+          '##ALT=<ID=INV,Description="Inversion">',
+          '##ALT=<ID=DUP:TANDEM,Description="Tandem duplication">',
+          '##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of structural variant">',
+          '##INFO=<ID=END,Number=1,Type=Integer,Description="End position of the variant">',
+          '##INFO=<ID=SVLEN,Number=1,Type=Integer,Description="Length difference between REF and ALT alleles">',
+          '##INFO=<ID=NDUPS,Number=1,Type=Integer,Description="Number of added copies for tandem duplications">',
+          '##INFO=<ID=VAF,Number=1,Type=Float,Description="Fraction of reads carrying the variant">']
+
+def snvRecord(chrom, pos, ref, alt, vaf=None):
+    ''' record for an SNV at 1-based position pos '''
+    info = {}
+    if vaf is not None:
+        info['VAF'] = "%.4f" % vaf
+    return (chrom, pos, ref, alt, info)
+
+def locateContig(reffile, chrom, start, end, contigseq, anchorlen=50):
+    '''
+    find contigseq in reference region chrom:start-end by matching its first anchorlen bases
+    (either strand), returns (0-based genome position of the contig start, reversed) or None
+    '''
+    refseq = reffile.fetch(chrom, start, end).upper()
+    anchor = contigseq[:anchorlen].upper()
+    i = refseq.find(anchor)
+    if i >= 0:
+        return (start + i, False)
+    anchor = mutableseq.rc(contigseq[-anchorlen:].upper())
+    i = refseq.find(anchor)
+    if i >= 0:
+        return (start + i, True)
+    return None
+
+def svRecords(reffile, chrom, location, contiglen, mutseq, svfrac=None):
+    '''
+    records for the edits in mutseq (a MutableSeq made from a contig of length contiglen),
+    location is from locateContig(). Edits in inserted sequence are skipped.
+    '''
+    (ctgstart, reverse) = location
+
+    def gpos(p): # contig position --> 0-based genome position
+        if reverse:
+            return ctgstart + contiglen - 1 - p
+        return ctgstart + p
+
+    def gspan(s, e): # contig interval --> genome interval
+        if reverse:
+            return (gpos(e-1), gpos(s)+1)
+        return (gpos(s), gpos(e-1)+1)
+
+    records = []
+    for (kind, s, e, data) in mutseq.edits:
+        if s is None:
+            continue
+        info = {'SVTYPE': kind}
+        if svfrac is not None:
+            info['VAF'] = "%.4f" % svfrac
+
+        if kind == 'INS':
+            insseq = data
+            if reverse: # insertion goes before the anchor base on the genome strand
+                anchor = gpos(s) - 1
+                insseq = mutableseq.rc(insseq)
+            else:
+                anchor = gpos(s)
+            refbase = reffile.fetch(chrom, anchor, anchor+1).upper()
+            info['SVLEN'] = len(insseq)
+            if len(insseq) <= MAXALLELE:
+                records.append((chrom, anchor+1, refbase, refbase + insseq, info))
+            else:
+                info['END'] = anchor+1
+                records.append((chrom, anchor+1, refbase, '<INS>', info))
+            continue
+
+        # DEL, INV and DUP cover genome bases gs..ge-1 (0-based), the base before is the anchor
+        (gs, ge) = gspan(s, e)
+        refseq = reffile.fetch(chrom, gs-1, ge).upper()
+        info['END'] = ge
+        if kind == 'DEL':
+            info['SVLEN'] = gs-ge
+            if len(refseq) <= MAXALLELE:
+                records.append((chrom, gs, refseq, refseq[0], info))
+            else:
+                records.append((chrom, gs, refseq[0], '<DEL>', info))
+        elif kind == 'INV':
+            records.append((chrom, gs, refseq[0], '<INV>', info))
+        elif kind == 'DUP':
+            info['SVTYPE'] = 'DUP'
+            info['NDUPS']  = data
+            info['SVLEN']  = (ge-gs)*data
+            records.append((chrom, gs, refseq[0], '<DUP:TANDEM>', info))
+
+    return records
+
+def infoString(info):
+    if not info:
+        return '.'
+    fields = []
+    for key in ('SVTYPE', 'END', 'SVLEN', 'NDUPS', 'VAF'):
+        if key in info:
+            fields.append(key + "=" + str(info[key]))
+    return ';'.join(fields)
+
+class TruthVCF:
+    '''
+    collects (chrom, pos, ref, alt, info) records and writes them as a sorted, tabix-indexed
+    .vcf.gz, with contigs in the order of the reference .fai
+    '''
+    def __init__(self, reffasta):
+        self.contigs = []
+        for line in open(reffasta + ".fai", 'r'):
+            c = line.strip().split()
+            self.contigs.append((c[0], int(c[1])))
+        self.records = []
+
+    def add(self, records):
+        self.records.extend(records)
+
+    def write(self, vcffile):
+        ''' writes vcffile.gz (+ .tbi), vcffile is removed. Returns name of the .vcf.gz '''
+        order = dict([(name, i) for (i, (name, length)) in enumerate(self.contigs)])
+        self.records.sort(key=lambda r: (order.get(r[0], len(order)), r[0], r[1]))
+
+        out = open(vcffile, 'w')
+        for line in HEADER:
+            out.write(line + "\n")
+        for (name, length) in self.contigs:
+            out.write("##contig=<ID=%s,length=%d>\n" % (name, length))
+        out.write("\t".join(('#CHROM','POS','ID','REF','ALT','QUAL','FILTER','INFO')) + "\n")
+        for (chrom, pos, ref, alt, info) in self.records:
+            out.write("\t".join((chrom, str(pos), '.', ref, alt, '.', 'PASS', infoString(info))) + "\n")
+        out.close()
+
+        pysam.tabix_index(vcffile, preset='vcf', force=True)
+        if os.path.exists(vcffile):
+            os.remove(vcffile)
+        return vcffile + ".gz"
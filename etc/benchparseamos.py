@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+'''
+micro-benchmark for bs/parseamos.py: writes a synthetic velvet Sequences/velvet_asm.afg pair
+and times the streaming parser against the previous (per-line regex) parser
+'''
+
+import sys,os,re,time,random,argparse,tempfile,shutil
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bs'))
+import parseamos
+
+def oldInputSeqs(seqfile):
+    ''' previous parseamos.InputSeqs parser, returns read number --> read name '''
+    srcread = {}
+    readnames = []
+    readseqs = []
+    f = open(seqfile,'r')
+    read = None
+    src  = None
+    seq  = ""
+    for line in f:
+        if re.search('^>',line):
+            if read:
+                assert seq != ""
+                readseqs.append(seq)
+                seq = ""
+            (read,src,n) = re.sub('^>','',line).strip().split()
+            srcread[src] = read
+            readnames.append(read)
+        else:
+            seq += line.strip()
+    srcread[src] = read
+    readseqs.append(seq)
+    return srcread
+
+def oldContigReadMap(amosfile,srcread):
+    ''' previous parseamos.contigreadmap parser, returns eid --> read names '''
+    f = open(amosfile, 'r')
+    inCTGblock = False
+    inTLEblock = False
+    CTGeid = None
+    contigs = {}
+    names = []
+    for line in f:
+        line = line.strip()
+        if inCTGblock:
+            if not inTLEblock:
+                if re.search('^eid:',line):
+                    CTGeid = re.sub('eid:','',line)
+                    CTGeid = re.sub('-0$', '', CTGeid)
+                if re.search('}', line):
+                    contigs[CTGeid] = names
+                    inCTGblock = False
+                    names = []
+                if re.search('{TLE',line):
+                    inTLEblock = True
+            else:
+                if re.search('^src:',line):
+                    names.append(srcread[re.sub('src:','',line)])
+                if re.search('}', line):
+                    inTLEblock = False
+        else:
+            if re.search('{CTG',line):
+                inCTGblock = True
+    return contigs
+
+def randseq(n):
+    return ''.join([random.choice('ACGT') for i in range(n)])
+
+def writeInput(dir, ncontigs, readspercontig, readlen):
+    ''' write dir/Sequences and dir/velvet_asm.afg '''
+    seqs = open(dir + "/Sequences", 'w')
+    amos = open(dir + "/velvet_asm.afg", 'w')
+    src = 0
+    readseq = randseq(readlen)
+    for ctg in range(ncontigs):
+        ctgseq = randseq(readlen*4)
+        amos.write("{CTG\niid:%d\neid:%d-0\ncom:\nAfg_File\n.\nseq:\n%s\n.\nqlt:\n%s\n.\n" % (ctg+1, ctg+1, ctgseq, 'I'*len(ctgseq)))
+        for i in range(readspercontig):
+            src += 1
+            seqs.write(">read%d/%d\t%d\t0\n%s\n" % (src, src % 2 + 1, src, readseq))
+            amos.write("{TLE\nsrc:%d\noff:%d\nclr:0,%d\n}\n" % (src, random.randint(0,readlen*3), readlen))
+        amos.write("}\n")
+    seqs.close()
+    amos.close()
+
+def timeit(func, reps):
+    best = None
+    for i in range(reps):
+        t = time.time()
+        result = func()
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return (best, result)
+
+def main(args):
+    random.seed(int(args.seed))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        writeInput(tmpdir, int(args.ncontigs), int(args.reads), int(args.readlen))
+        amosfile = tmpdir + "/velvet_asm.afg"
+        seqfile  = tmpdir + "/Sequences"
+        size = os.path.getsize(amosfile) + os.path.getsize(seqfile)
+        print "input: %.1f Mb (%s contigs, %s reads/contig)" % (float(size)/1e6, args.ncontigs, args.reads)
+
+        def old():
+            return oldContigReadMap(amosfile, oldInputSeqs(seqfile))
+
+        def new():
+            return dict(parseamos.contigreads(amosfile, parseamos.InputSeqs(seqfile)))
+
+        (told, oldmap) = timeit(old, int(args.reps))
+        (tnew, newmap) = timeit(new, int(args.reps))
+        assert oldmap == newmap
+
+        print "regex parser:     %.3f s" % told
+        print "streaming parser: %.3f s" % tnew
+        print "speedup:          %.1fx" % (told/tnew)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark velvet AMOS parsing in bs/parseamos.py')
+    parser.add_argument('-c', '--ncontigs', dest='ncontigs', default=200, help='number of contigs (default=200)')
+    parser.add_argument('-n', '--reads', dest='reads', default=500, help='reads per contig (default=500)')
+    parser.add_argument('-l', '--readlen', dest='readlen', default=100, help='read length (default=100)')
+    parser.add_argument('-r', '--reps', dest='reps', default=3, help='repetitions, best time is reported (default=3)')
+    parser.add_argument('-s', '--seed', dest='seed', default=1, help='random seed (default=1)')
+    args = parser.parse_args()
+    main(args)
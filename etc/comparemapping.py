@@ -1,24 +1,13 @@
 #!/bin/env python
 
-import subprocess,pysam, sys, re
+import pysam, sys, os, zlib, argparse, tempfile, shutil, multiprocessing
 
-def namesortbam(inbam,outbam):
-    print "sorting by name:",inbam,"-->",outbam
-    outbam = re.sub('.bam$','',outbam)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bs'))
+import mates
 
-    sortargs = ['samtools','sort','-n','-m','20000000000',inbam,outbam]
-    subprocess.call(sortargs)
-
-def compare(bamfile1,bamfile2):
-    bam1sort = re.sub('.bam$','',bamfile1) + ".namesort.bam"
-    bam2sort = re.sub('.bam$','',bamfile2) + ".namesort.bam"
-
-    namesortbam(sys.argv[1],bam1sort)
-    namesortbam(sys.argv[2],bam2sort)
-
-    bam1 = pysam.Samfile(bam1sort,'rb')
-    bam2 = pysam.Samfile(bam2sort,'rb')
+STATS = ('total','diff','unmap','map','clip','rep','seq','missing')
 
+def newcounts():
     n = {}
     n['total'] = 0 # read count
     n['diff']  = 0 # number of reads where mapping coords change
@@ -26,37 +15,178 @@ def compare(bamfile1,bamfile2):
     n['map']   = 0 # number of reads where unmappable-->mappable
     n['clip']  = 0 # number of reads where clipping changes
     n['rep']   = 0 # number of read pairs with a repeat (mapping qual 0) read
-    n['seq']   = 0 # number of reads with a sequence change 
-
-    for read1 in bam1.fetch(until_eof=True):
-        read2 = bam2.next()
-        assert read1.qname == read2.qname # require identical sets of read names
-
-        if read1.seq != read2.seq:
-            n['seq'] += 1
-
-        if read1.mapq > 1 and read2.mapq > 1:
-            n['total'] += 1
-            if not read1.is_unmapped and read2.is_unmapped:
-                n['unmap'] += 1
-            elif read1.is_unmapped and not read2.is_unmapped:
-                n['map'] += 1
-            elif not read1.is_unmapped and not read2.is_unmapped:
-                if read1.alen != read2.alen:
-                    n['clip'] += 1
-                if read1.pos != read2.pos:
-                    n['diff'] += 1
+    n['seq']   = 0 # number of reads with a sequence change
+    n['missing'] = 0 # number of reads found in only one of the .bams
+    return n
+
+def addcounts(n, other):
+    for stat in STATS:
+        n[stat] += other[stat]
+
+def readkey(read):
+    ''' reads are matched by name and which end of the pair they are '''
+    return (read.qname, read.is_read1, read.is_read2)
+
+def comparereads(read1, read2, n):
+    ''' add differences between read1 (from first .bam) and read2 (second .bam) to counts n '''
+    if read1.seq != read2.seq:
+        n['seq'] += 1
+
+    if read1.mapq > 1 and read2.mapq > 1:
+        n['total'] += 1
+        if not read1.is_unmapped and read2.is_unmapped:
+            n['unmap'] += 1
+        elif read1.is_unmapped and not read2.is_unmapped:
+            n['map'] += 1
+        elif not read1.is_unmapped and not read2.is_unmapped:
+            if read1.alen != read2.alen:
+                n['clip'] += 1
+            if read1.pos != read2.pos:
+                n['diff'] += 1
+    else:
+        n['rep'] += 1
+
+def comparedicts(reads1, reads2, n):
+    ''' compare reads with the same key in two dicts of key --> read '''
+    for key,read1 in reads1.iteritems():
+        read2 = reads2.get(key)
+        if read2 is None:
+            n['missing'] += 1
         else:
-            n['rep'] += 1
+            comparereads(read1, read2, n)
+    for key in reads2:
+        if key not in reads1:
+            n['missing'] += 1
+
+## targeted mode: only reads named in a donor .bam / excluded read list, found by indexed fetches
+
+def targetwindows(donorbam, padding):
+    ''' read names and sorted (chrom, start, end) windows around donor reads and their mates '''
+    names = set()
+    positions = []
+    for read in donorbam.fetch(until_eof=True):
+        names.add(read.qname)
+        if not read.is_unmapped:
+            positions.append((read.tid, read.pos))
+        if read.is_paired and not read.mate_is_unmapped and read.mrnm >= 0:
+            positions.append((read.mrnm, read.mpos))
+
+    resolver = mates.MateResolver(donorbam, window=2*padding)
+    windows = []
+    for (tid, start, end) in resolver.windows(sorted(set(positions))):
+        windows.append((donorbam.getrname(tid), max(0, start-padding), end+padding))
+    return (names, windows)
+
+def fetchnamed(bam, windows, names):
+    ''' dict of key --> read for reads in names within windows '''
+    reads = {}
+    for (chrom, start, end) in windows:
+        if chrom not in bam.references:
+            continue
+        for read in bam.fetch(chrom, start, end):
+            if read.qname in names:
+                reads[readkey(read)] = read
+    return reads
+
+def comparetargeted(bamfile1, bamfile2, donorbamfile, excludedfile=None, padding=1000):
+    donorbam = pysam.Samfile(donorbamfile, 'rb')
+    (names, windows) = targetwindows(donorbam, padding)
+    donorbam.close()
 
+    if excludedfile:
+        for line in open(excludedfile, 'r'):
+            if line.strip():
+                names.add(line.strip())
+
+    sys.stderr.write("comparing " + str(len(names)) + " read names in " + str(len(windows)) + " regions\n")
+
+    bam1 = pysam.Samfile(bamfile1, 'rb')
+    bam2 = pysam.Samfile(bamfile2, 'rb')
+    n = newcounts()
+    comparedicts(fetchnamed(bam1, windows, names), fetchnamed(bam2, windows, names), n)
     bam1.close()
     bam2.close()
+    return n
+
+## general mode: reads are split into partitions by a hash of their name, partitions are compared in parallel
+
+def partition(bamfile, tmpdir, nparts, prefix):
+    ''' split bamfile into nparts .bams by hash of read name, returns their file names '''
+    bam = pysam.Samfile(bamfile, 'rb')
+    partfns = [os.path.join(tmpdir, prefix + "." + str(i) + ".bam") for i in range(nparts)]
+    parts = [pysam.Samfile(fn, 'wb', template=bam) for fn in partfns]
+    for read in bam.fetch(until_eof=True):
+        parts[(zlib.crc32(read.qname) & 0xffffffff) % nparts].write(read)
+    for part in parts:
+        part.close()
+    bam.close()
+    return partfns
+
+def comparepartition(job):
+    ''' compare one pair of partitions, only the first is held in memory '''
+    (partfn1, partfn2) = job
+    n = newcounts()
+    reads1 = {}
+    bam1 = pysam.Samfile(partfn1, 'rb')
+    for read in bam1.fetch(until_eof=True):
+        reads1[readkey(read)] = read
+    bam1.close()
+
+    bam2 = pysam.Samfile(partfn2, 'rb')
+    for read2 in bam2.fetch(until_eof=True):
+        read1 = reads1.pop(readkey(read2), None)
+        if read1 is None:
+            n['missing'] += 1
+        else:
+            comparereads(read1, read2, n)
+    bam2.close()
+    n['missing'] += len(reads1)
+
+    os.remove(partfn1)
+    os.remove(partfn2)
+    return n
+
+def compare(bamfile1, bamfile2, procs=1, nparts=64, tmpdir=None):
+    tmpdir = tempfile.mkdtemp(prefix='comparemapping.', dir=tmpdir)
+    n = newcounts()
+    try:
+        if procs > 1:
+            pool = multiprocessing.Pool(processes=procs)
+            splits = [pool.apply_async(partition, (fn, tmpdir, nparts, 'bam' + str(i))) for (i, fn) in enumerate((bamfile1, bamfile2))]
+            (parts1, parts2) = [split.get() for split in splits]
+            for counts in pool.imap_unordered(comparepartition, zip(parts1, parts2)):
+                addcounts(n, counts)
+            pool.close()
+            pool.join()
+        else:
+            parts1 = partition(bamfile1, tmpdir, nparts, 'bam0')
+            parts2 = partition(bamfile2, tmpdir, nparts, 'bam1')
+            for job in zip(parts1, parts2):
+                addcounts(n, comparepartition(job))
+    finally:
+        shutil.rmtree(tmpdir)
+    return n
+
+def main(args):
+    if args.donorbam:
+        n = comparetargeted(args.bam1, args.bam2, args.donorbam, args.excluded, int(args.padding))
+    else:
+        n = compare(args.bam1, args.bam2, int(args.procs), int(args.parts), args.tmpdir)
 
-    for stat,val in n.iteritems():
-        print stat,val
+    for stat in STATS:
+        print stat,n[stat]
 
-if len(sys.argv) != 3:
-    print "this script compares two .bams with identical sets of read names (required) and reports mapping differences"
-    print "usage:",sys.argv[0],"<bamfile1.bam> <bamfile2.bam>"
-else:
-    compare(sys.argv[1],sys.argv[2])
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="compares reads with the same names in two .bams and reports mapping differences")
+    parser.add_argument('bam1', help="first .bam")
+    parser.add_argument('bam2', help="second .bam")
+    parser.add_argument('-d', '--donorbam', dest='donorbam', default=None,
+                        help="only compare reads named in this .bam (e.g. mutated reads from addsnv.py/addsv.py) and their mates, both .bams must be sorted and indexed")
+    parser.add_argument('-x', '--excluded', dest='excluded', default=None,
+                        help="excluded read names from addsv.py, also compared in targeted (--donorbam) mode")
+    parser.add_argument('--padding', dest='padding', default=1000, help="padding around donor reads and mates for targeted mode (default=1000)")
+    parser.add_argument('-p', '--procs', dest='procs', default=1, help="processes for comparing partitions (default=1)")
+    parser.add_argument('--parts', dest='parts', default=64, help="number of read name partitions, memory use is about 1/parts of the first .bam (default=64)")
+    parser.add_argument('--tmpdir', dest='tmpdir', default=None, help="directory for partition files")
+    args = parser.parse_args()
+    main(args)
@@ -1,6 +1,190 @@
 #!/bin/env python
 
-import argparse, random, pysam, re
+import argparse, pysam, re, os
+import numpy as np
+
+CHROMSTRIDE = 2**40 # chromosome index * CHROMSTRIDE + position orders positions across chromosomes
+
+def readfai(indexFile):
+    ''' returns list of (chromosome, length) from a .fai, in sorted order '''
+    chrlen = {}
+    for line in open(indexFile, 'r'):
+        c = line.strip().split()
+        chr = c[0]
+        size = int(c[1])
+        chrlen[chr] = size
+    return sorted(chrlen.iteritems())
+
+def iscontig(chrom):
+    ''' True for unplaced/decoy contigs (names longer than chrNN or NN) '''
+    return (chrom.startswith('chr') and len(chrom) > 5) or (not chrom.startswith('chr') and len(chrom) > 2)
+
+def mergeintervals(starts, ends):
+    ''' union of intervals as sorted, non-overlapping (starts, ends) arrays '''
+    if len(starts) == 0:
+        return (starts, ends)
+    order  = np.argsort(starts, kind='mergesort')
+    starts = starts[order]
+    ends   = np.maximum.accumulate(ends[order])
+    first  = np.concatenate(([True], starts[1:] > ends[:-1])) # interval starts a new group
+    idx    = np.nonzero(first)[0]
+    return (starts[idx], ends[np.concatenate((idx[1:]-1, [len(starts)-1]))])
+
+def lowmapintervals(maptabix, chrom, minmap):
+    ''' (starts, ends) of mappability track intervals on chrom scoring below minmap '''
+    if chrom not in maptabix.contigs and 'chr' + chrom in maptabix.contigs:
+        chrom = 'chr' + chrom
+    starts = []
+    ends   = []
+    if chrom in maptabix.contigs:
+        for mapline in maptabix.fetch(chrom):
+            m = mapline.strip().split()
+            if float(m[3]) < minmap:
+                starts.append(int(m[1]))
+                ends.append(int(m[2]))
+    return (np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64))
+
+def nintervals(genome, chrom, length, chunksize=10000000):
+    ''' (starts, ends) of runs of unsequenced (non-ACGT) bases on chrom, read in chunks '''
+    starts = []
+    ends   = []
+    for offset in range(0, length, chunksize):
+        seq = genome.fetch(chrom, offset, min(offset+chunksize, length))
+        for run in re.finditer('[^ATGCatgc]+', seq):
+            if run.start() == 0 and ends and ends[-1] == offset: # run continues from the previous chunk
+                ends[-1] = offset + run.end()
+            else:
+                starts.append(offset + run.start())
+                ends.append(offset + run.end())
+    return (np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64))
+
+def eligibleintervals(chromlens, maptabix=None, minmap=None):
+    '''
+    complement of low-mappability intervals (if maptabix is given) on each chromosome.
+    Returns (chromosome names, chromosome index, starts, ends)
+    '''
+    chroms = [chrom for (chrom, length) in chromlens]
+    chromidx = []
+    allstarts = []
+    allends   = []
+    for (i, (chrom, length)) in enumerate(chromlens):
+        xstarts = [np.zeros(0, dtype=np.int64)]
+        xends   = [np.zeros(0, dtype=np.int64)]
+        if maptabix:
+            (s, e) = lowmapintervals(maptabix, chrom, minmap)
+            xstarts.append(s)
+            xends.append(e)
+        (xs, xe) = mergeintervals(np.concatenate(xstarts), np.concatenate(xends))
+
+        # gaps between excluded intervals
+        starts = np.clip(np.concatenate(([0], xe)), 0, length)
+        ends   = np.clip(np.concatenate((xs, [length])), 0, length)
+        keep   = ends > starts
+        allstarts.append(starts[keep])
+        allends.append(ends[keep])
+        chromidx.append(np.repeat(i, np.count_nonzero(keep)))
+
+    return (chroms, np.concatenate(chromidx).astype(np.int64), np.concatenate(allstarts), np.concatenate(allends))
+
+def ngaps(genome, chromlens):
+    ''' (chromosome index, starts, ends) of N runs on each chromosome, see SiteSampler '''
+    chromidx = [np.zeros(0, dtype=np.int64)]
+    allstarts = [np.zeros(0, dtype=np.int64)]
+    allends   = [np.zeros(0, dtype=np.int64)]
+    for (i, (chrom, length)) in enumerate(chromlens):
+        (s, e) = nintervals(genome, chrom, length)
+        chromidx.append(np.repeat(i, len(s)).astype(np.int64))
+        allstarts.append(s)
+        allends.append(e)
+    return (np.concatenate(chromidx), np.concatenate(allstarts), np.concatenate(allends))
+
+def cachekey(args, chromlens):
+    ''' identifies the inputs and options the eligible intervals were built from '''
+    inputs = []
+    for fn in (args.maptabix, args.fastaFile):
+        if fn:
+            inputs.append(os.path.abspath(fn) + '@' + str(os.path.getmtime(fn)))
+        else:
+            inputs.append(str(fn))
+    chroms = ','.join([chrom + ':' + str(length) for (chrom, length) in chromlens])
+    return ' '.join(inputs + [str(args.minmap), str(args.requireseq), chroms])
+
+def loadeligible(cachefile, key):
+    ''' (eligible intervals, N gaps) from cachefile (see saveeligible()) if it was built with the same key, else None '''
+    try:
+        cache = np.load(cachefile)
+    except IOError:
+        return None
+    if str(cache['key']) != key:
+        return None
+    intervals = ([str(chrom) for chrom in cache['chroms']], cache['chromidx'], cache['starts'], cache['ends'])
+    gaps = None
+    if 'gapchromidx' in cache.files:
+        gaps = (cache['gapchromidx'], cache['gapstarts'], cache['gapends'])
+    return (intervals, gaps)
+
+def saveeligible(cachefile, key, intervals, gaps=None):
+    (chroms, chromidx, starts, ends) = intervals
+    arrays = dict(key=np.array(key), chroms=np.array(chroms), chromidx=chromidx, starts=starts, ends=ends)
+    if gaps is not None:
+        (arrays['gapchromidx'], arrays['gapstarts'], arrays['gapends']) = gaps
+    fh = open(cachefile, 'wb')
+    np.savez_compressed(fh, **arrays)
+    fh.close()
+
+class SiteSampler:
+    '''
+    draws fragments uniformly from a set of intervals (whole chromosomes or eligible regions):
+    intervals are laid end to end in one cumulative length array, positions are drawn in
+    batches and assigned to intervals by binary search (np.searchsorted). Fragments must
+    lie within one interval. If gaps (chromosome index, starts, ends of sorted, non-overlapping
+    runs) are given, fragments lying entirely within a gap are dropped as well.
+    '''
+    def __init__(self, chroms, chromidx, starts, ends, minlen, maxlen, seed=None, batch=10000, gaps=None):
+        self.chroms   = chroms
+        self.chromidx = chromidx
+        self.starts   = starts
+        self.lengths  = ends - starts
+        self.ends     = np.cumsum(self.lengths) # offset of the end of each interval
+        self.minlen   = minlen
+        self.maxlen   = maxlen
+        self.batch    = batch
+        self.rng      = np.random.RandomState(seed)
+
+        self.gapstarts = None
+        if gaps is not None and len(gaps[0]) > 0:
+            (gapchromidx, gapstarts, gapends) = gaps
+            self.gapstarts = gapchromidx * CHROMSTRIDE + gapstarts
+            self.gapends   = gapchromidx * CHROMSTRIDE + gapends
+
+        if len(self.ends) == 0 or self.ends[-1] == 0:
+            raise ValueError("no sequence to pick sites from")
+
+    def draw(self):
+        ''' returns a list of (chrom, start, end) for one batch, fragments running off the end of an interval
+            (or within a gap) are dropped
+        '''
+        locs = self.rng.randint(0, self.ends[-1], size=self.batch)
+        idx  = np.searchsorted(self.ends, locs, side='right')
+        offsets  = locs - (self.ends[idx] - self.lengths[idx])
+        fraglens = self.rng.uniform(self.minlen, self.maxlen, size=self.batch).astype(np.int64)
+        keep = offsets + fraglens <= self.lengths[idx]
+        idx = idx[keep]
+        starts = self.starts[idx] + offsets[keep]
+        fragends = starts + fraglens[keep]
+
+        if self.gapstarts is not None:
+            chromkeys = self.chromidx[idx] * CHROMSTRIDE
+            gap = np.searchsorted(self.gapstarts, chromkeys + starts, side='right') - 1
+            ingap = (gap >= 0) & (self.gapends[np.maximum(gap, 0)] >= chromkeys + fragends)
+            (idx, starts, fragends) = (idx[~ingap], starts[~ingap], fragends[~ingap])
+
+        return [(self.chroms[c], int(s), int(e)) for (c, s, e) in zip(self.chromidx[idx], starts, fragends)]
+
+    def __iter__(self):
+        while True:
+            for site in self.draw():
+                yield site
 
 def main(args):
 
@@ -20,84 +204,54 @@ def main(args):
 
     assert minlen <= maxlen
 
-    chrlen = {}
-    for line in open(args.indexFile, 'r'):
-        c = line.strip().split()
-        chr = c[0]
-        size = int(c[1])
-        chrlen[chr] = size
+    # candidate chromosomes: --chr and --nocontigs are applied before sampling
+    chromlens = readfai(args.indexFile)
+    if args.chrom:
+        chromlens = [(chrom, length) for (chrom, length) in chromlens if chrom == args.chrom]
+    if args.nocontigs:
+        chromlens = [(chrom, length) for (chrom, length) in chromlens if not iscontig(chrom)]
 
-    # calculate offsets
-    offset = 0
-    chroffset = {}
-    for chrom in sorted(chrlen.iterkeys()):
-        offset += int(chrlen[chrom])
-        chroffset[chrom] = offset
+    seed = None
+    if args.seed is not None:
+        seed = int(args.seed)
 
-    genomelen = offset
+    # eligible intervals and N runs: sites are drawn from these so --minmap and --requireseq need no lookups
+    gaps = None
+    if maptabix or args.requireseq:
+        key = cachekey(args, chromlens)
+        cached = None
+        if args.cache:
+            cached = loadeligible(args.cache, key)
+        if cached is None:
+            intervals = eligibleintervals(chromlens, maptabix=maptabix, minmap=float(args.minmap))
+            if args.requireseq:
+                gaps = ngaps(genome, chromlens)
+            if args.cache:
+                saveeligible(args.cache, key, intervals, gaps)
+        else:
+            (intervals, gaps) = cached
+        (chroms, chromidx, starts, ends) = intervals
+    else:
+        chroms   = [chrom for (chrom, length) in chromlens]
+        chromidx = np.arange(len(chroms), dtype=np.int64)
+        starts   = np.zeros(len(chroms), dtype=np.int64)
+        ends     = np.array([length for (chrom, length) in chromlens], dtype=np.int64)
+
+    sampler = SiteSampler(chroms, chromidx, starts, ends, minlen, maxlen, seed=seed, gaps=gaps)
 
     # random picks
     n = 0
-    while n < int(args.numpicks):
-        rndloc = random.randint(0,genomelen)
-        lastoffset = 0
-        rndchr = None
-        for chrom in sorted(chrlen.iterkeys()):
-            offset = int(chroffset[chrom])
-            assert lastoffset < offset
-            if rndloc >= lastoffset and rndloc < offset:
-                rndchr = chrom
-                rndloc -= lastoffset
-            lastoffset = offset
-
-        # handle single chromosome option
-        if args.chrom and args.chrom != rndchr:
-            continue
-
-        fraglen = int(random.uniform(minlen,maxlen))
-
-        fragstart = rndloc
-        fragend   = rndloc + int(fraglen)
-
-        # handle mappability option
-        if maptabix:
-            reject = False 
+    for (rndchr, fragstart, fragend) in sampler:
+        if n >= int(args.numpicks):
+            break
 
-            if rndchr not in maptabix.contigs and 'chr' + rndchr in maptabix.contigs:
-                mchrom = 'chr' + rndchr
-            else:
-                mchrom = rndchr 
-
-            if mchrom in maptabix.contigs:
-                for mapline in maptabix.fetch(mchrom, fragstart, fragend):
-                    m = mapline.strip().split()
-                    mscore = float(m[3])
-
-                    if mscore < float(args.minmap):
-                        reject = True
-            if reject:
-                continue
-
-        # don't pick sites on contigs if --nocontigs is set
-        if (rndchr.startswith('chr') and len(rndchr) > 5) or (not rndchr.startswith('chr') and len(rndchr) > 2):
-            if args.nocontigs:
-                continue
-
-        if fragend < offset:
-            if genome:
-                seq = genome.fetch(rndchr,fragstart,fragend)
-                assert seq
-
-                if args.requireseq:
-                    if re.search('[ATGCatgc]',seq):
-                        print "\t".join((rndchr,str(fragstart),str(fragend),seq))
-                        n += 1
-                else:
-                    print "\t".join((rndchr,str(fragstart),str(fragend),seq))
-                    n += 1
-            else:
-                print "\t".join((rndchr,str(fragstart),str(fragend)))
-                n += 1
+        if genome:
+            seq = genome.fetch(rndchr,fragstart,fragend)
+            assert seq
+            print "\t".join((rndchr,str(fragstart),str(fragend),seq))
+        else:
+            print "\t".join((rndchr,str(fragstart),str(fragend)))
+        n += 1
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="pick random sites from a samtools-indexed genome")
@@ -109,7 +263,9 @@ if __name__ == '__main__':
     parser.add_argument('--minmap', dest='minmap', default=0.8, help='only select regions above mappability threshold (default 0.8)')
     parser.add_argument('--lmin', dest='minlen', default=1, help='minimum fragment length (default=1)')
     parser.add_argument('--lmax', dest='maxlen', default=1, help='maximum fragment length (default=1)')
-    parser.add_argument('--requireseq', action="store_true", help="do not select hits in unsequenced regions, requires fasta file")
+    parser.add_argument('--requireseq', action="store_true", help="do not select hits in unsequenced regions (all N), requires fasta file")
     parser.add_argument('--nocontigs', action="store_true", help="exclude contigs")
+    parser.add_argument('--seed', dest='seed', default=None, help="random seed")
+    parser.add_argument('--cache', dest='cache', default=None, help="cache file for eligible regions (--minmap/--requireseq), rebuilt if the options or input files change")
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+
+'''
+benchmarks for the spike-in pipeline on synthetic data: writes a random reference (with N runs)
+and a coordinate-sorted .bam of simulated read pairs, then times the stages separately
+(best of --reps). Results are written as JSON so runs on different commits can be compared.
+External tools are optional: stages that need them are not stubbed, they are recorded as skipped
+(with the reason) in the results and listed under 'skipped', --strict makes that an error. A stage
+that raises is recorded with its error under 'failed', the other stages still run and the exit
+status is non-zero.
+'''
+
+import sys,os,time,json,random,argparse,tempfile,shutil,subprocess,platform,traceback
+from distutils.spawn import find_executable
+import pysam
+
+basedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, basedir)
+sys.path.append(os.path.join(basedir, 'etc'))
+
+import addsnv
+import bs.replacereads as rr
+import bs.parseamos as parseamos
+import bs.mutableseq as ms
+import bs.aligner as al
+import bs.pileup as pu
+import randomsites
+import benchparseamos
+
+def randseq(n):
+    return ''.join([random.choice('ACGT') for i in range(n)])
+
+def mutate(seq, rate):
+    ''' seq with a fraction 'rate' of bases changed (sequencing errors) '''
+    bases = list(seq)
+    for i in range(len(bases)):
+        if bases[i] != 'N' and random.random() < rate:
+            bases[i] = addsnv.mut(bases[i])
+    return ''.join(bases)
+
+def writeReference(fasta, nchroms, chromlen, nruns=5, runlen=1000):
+    ''' random chromosomes with nruns runs of N each, returns dict of name --> sequence '''
+    chroms = {}
+    out = open(fasta, 'w')
+    for c in range(nchroms):
+        name = "chr" + str(c+1)
+        seq = list(randseq(chromlen))
+        for i in range(nruns):
+            s = random.randint(0, max(0, chromlen-runlen))
+            seq[s:s+runlen] = 'N'*min(runlen, chromlen-s)
+        seq = ''.join(seq)
+        chroms[name] = seq
+        out.write(">" + name + "\n")
+        for i in range(0, len(seq), 60):
+            out.write(seq[i:i+60] + "\n")
+    out.close()
+    pysam.faidx(fasta)
+    return chroms
+
+def simulatePairs(chroms, coverage, readlen, isize=300, stdev=30):
+    ''' returns a list of (chrom, pos1, pos2, name) for read pairs covering the chromosomes at 'coverage' '''
+    pairs = []
+    for name in sorted(chroms):
+        length = len(chroms[name])
+        for i in range(int(coverage * length / (2*readlen))):
+            frag = max(readlen, int(random.gauss(isize, stdev)))
+            pos1 = random.randint(0, length-frag)
+            pos2 = pos1 + frag - readlen
+            pairs.append((name, pos1, pos2, "%s_%d_%d" % (name, pos1, i)))
+    return pairs
+
+def makeRead(tid, pos, mtid, mpos, isize, qname, seq, read1, reverse):
+    read = pysam.AlignedRead()
+    read.qname = qname
+    read.seq   = seq
+    read.flag  = 1 + 2 + [128, 64][read1] + [0, 16][reverse] + [0, 32][not reverse]
+    read.tid   = tid
+    read.pos   = pos
+    read.mapq  = 60
+    read.cigar = [(0, len(seq))]
+    read.mrnm  = mtid
+    read.mpos  = mpos
+    read.isize = isize
+    read.qual  = 'I'*len(seq)
+    read.tags  = [('RG', 'bench')]
+    return read
+
+def writeBam(bamfn, chroms, pairs, readlen, errorrate=0.001, mutfrac=1.0):
+    ''' write pairs (see simulatePairs()) to a sorted, indexed .bam. With mutfrac < 1 only that
+        fraction of pairs is written, with one changed base per read (donor .bam for replaceReads)
+    '''
+    names = sorted(chroms)
+    tids = dict([(name, i) for (i, name) in enumerate(names)])
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': name, 'LN': len(chroms[name])} for name in names],
+              'RG': [{'ID': 'bench', 'SM': 'bench'}]}
+
+    reads = []
+    for (chrom, pos1, pos2, qname) in pairs:
+        if mutfrac < 1.0 and random.random() >= mutfrac:
+            continue
+        seq1 = mutate(chroms[chrom][pos1:pos1+readlen], errorrate)
+        seq2 = mutate(chroms[chrom][pos2:pos2+readlen], errorrate)
+        if mutfrac < 1.0:
+            (seq1, seq2) = (mutate(seq1, 1.0/readlen), mutate(seq2, 1.0/readlen))
+        isize = pos2 + readlen - pos1
+        reads.append((tids[chrom], pos1, pos2, isize, qname, seq1, True, False))
+        reads.append((tids[chrom], pos2, pos1, -isize, qname, seq2, False, True))
+    reads.sort()
+
+    bam = pysam.Samfile(bamfn, 'wb', header=header)
+    for (tid, pos, mpos, isize, qname, seq, read1, reverse) in reads:
+        bam.write(makeRead(tid, pos, tid, mpos, isize, qname, seq, read1, reverse))
+    bam.close()
+    pysam.index(bamfn)
+    return len(reads)
+
+def timeit(func, reps):
+    ''' best wall time of reps calls to func, returns (seconds, result of last call) '''
+    best = None
+    result = None
+    for i in range(reps):
+        t = time.time()
+        result = func()
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return (best, result)
+
+def quiet(func):
+    ''' func with stdout/stderr (e.g. progress messages) discarded '''
+    def run():
+        devnull = open(os.devnull, 'w')
+        (stdout, stderr) = (sys.stdout, sys.stderr)
+        sys.stdout = sys.stderr = devnull
+        try:
+            return func()
+        finally:
+            (sys.stdout, sys.stderr) = (stdout, stderr)
+            devnull.close()
+    return run
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=basedir, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+## benchmarks: each returns the number of items processed (sites, reads, edits...)
+
+def benchCoverage(bamfn, sites):
+    bam = pysam.Samfile(bamfn, 'rb')
+    for (chrom, pos) in sites:
+        addsnv.countReadCoverage(bam, chrom, pos-1, pos+1)
+    bam.close()
+    return len(sites)
+
+def benchCoverageBatch(bamfn, sites):
+    bam = pysam.Samfile(bamfn, 'rb')
+    pu.coverage(bam, [(chrom, pos-1, pos+1) for (chrom, pos) in sites])
+    bam.close()
+    return len(sites)
+
+def benchBaseAtPos(bamfn, sites):
+    bam = pysam.Samfile(bamfn, 'rb')
+    for (chrom, pos) in sites:
+        addsnv.countBaseAtPos(bam, chrom, pos)
+    bam.close()
+    return len(sites)
+
+def benchReplace(bamfn, donorfn, outfn):
+    targetbam = pysam.Samfile(bamfn, 'rb')
+    donorbam  = pysam.Samfile(donorfn, 'rb')
+    outputbam = pysam.Samfile(outfn, 'wb', template=targetbam)
+    rr.replaceReads(targetbam, donorbam, outputbam)
+    n = targetbam.mapped
+    outputbam.close()
+    donorbam.close()
+    targetbam.close()
+    return n
+
+def benchContigReadMap(dir):
+    seqs = parseamos.InputSeqs(dir + "/Sequences")
+    return len(parseamos.contigreadmap(dir + "/velvet_asm.afg", seqs))
+
+def benchMutableSeq(seq, edits):
+    mutseq = ms.MutableSeq(seq)
+    for (kind, frac, size) in edits:
+        length = mutseq.length()
+        start = int(frac*(length-size))
+        if kind == 'INS':
+            mutseq.insertion(start, 'ACGT'*(size/4))
+        elif kind == 'DEL':
+            mutseq.deletion(start, start+size)
+        elif kind == 'INV':
+            mutseq.inversion(start, start+size)
+        else:
+            mutseq.duplication(start, start+size, 1)
+    assert mutseq.seq
+    return len(edits)
+
+def benchRandomSites(fai, fasta, nsites):
+    chromlens = randomsites.readfai(fai)
+    genome = pysam.Fastafile(fasta)
+    (chroms, chromidx, starts, ends) = randomsites.eligibleintervals(chromlens)
+    gaps = randomsites.ngaps(genome, chromlens)
+    genome.close()
+    sampler = randomsites.SiteSampler(chroms, chromidx, starts, ends, 100, 1000, seed=1, gaps=gaps)
+    n = 0
+    for site in sampler:
+        n += 1
+        if n >= nsites:
+            break
+    return n
+
+def benchAlign(fasta, bamfn, outfn, threads):
+    al.align(bamfn, bamfn, fasta, outfn, threads=threads, bam=True, index=True)
+    bam = pysam.Samfile(outfn, 'rb')
+    n = bam.mapped
+    bam.close()
+    return n
+
+def main(args):
+    random.seed(int(args.seed))
+    reps = int(args.reps)
+    tmpdir = tempfile.mkdtemp(prefix='benchmark.', dir=args.tmpdir)
+    results = {}
+
+    def wanted(name):
+        return not args.only or name in args.only.split(',')
+
+    def record(name, func):
+        if not wanted(name):
+            return
+        sys.stderr.write("benchmark: " + name + "\n")
+        try:
+            (seconds, n) = timeit(quiet(func), reps)
+        except Exception as e:
+            results[name] = {'failed': True, 'error': "%s: %s" % (type(e).__name__, str(e))}
+            sys.stderr.write(name + ": failed\n" + traceback.format_exc())
+            return
+        results[name] = {'seconds': seconds, 'items': n}
+        if n:
+            results[name]['items_per_second'] = n/seconds
+        sys.stderr.write("%s: %.3f s (%s items)\n" % (name, seconds, str(n)))
+
+    def skip(name, reason):
+        if not wanted(name):
+            return
+        results[name] = {'skipped': True, 'reason': reason}
+        sys.stderr.write(name + ": skipped (" + reason + ")\n")
+
+    try:
+        # fixtures
+        t = time.time()
+        fasta = os.path.join(tmpdir, "ref.fa")
+        chroms = writeReference(fasta, int(args.nchroms), int(args.chromlen))
+        pairs  = simulatePairs(chroms, float(args.coverage), int(args.readlen))
+        bamfn  = os.path.join(tmpdir, "reads.bam")
+        donorfn = os.path.join(tmpdir, "donor.bam")
+        nreads = writeBam(bamfn, chroms, pairs, int(args.readlen))
+        ndonor = writeBam(donorfn, chroms, pairs, int(args.readlen), mutfrac=float(args.donorfrac))
+        amosdir = os.path.join(tmpdir, "velvet")
+        os.mkdir(amosdir)
+        benchparseamos.writeInput(amosdir, int(args.ncontigs), 200, int(args.readlen))
+        sys.stderr.write("fixtures: %d reads, %d donor reads (%.1f s)\n" % (nreads, ndonor, time.time()-t))
+
+        names = sorted(chroms)
+        sites = []
+        for i in range(int(args.nsites)):
+            chrom = random.choice(names)
+            sites.append((chrom, random.randint(int(args.readlen), len(chroms[chrom])-int(args.readlen))))
+
+        edits = [(random.choice(('INS','DEL','INV','DUP')), random.random(), random.randint(10, 500)) for i in range(int(args.nedits))]
+        ctgseq = randseq(int(args.contiglen))
+
+        record('countReadCoverage', lambda: benchCoverage(bamfn, sites))
+        record('coverage', lambda: benchCoverageBatch(bamfn, sites))
+        record('countBaseAtPos', lambda: benchBaseAtPos(bamfn, sites))
+        record('replaceReads', lambda: benchReplace(bamfn, donorfn, os.path.join(tmpdir, "replaced.bam")))
+        record('contigreadmap', lambda: benchContigReadMap(amosdir))
+        record('MutableSeq', lambda: benchMutableSeq(ctgseq, edits))
+        record('randomsites', lambda: benchRandomSites(fasta + ".fai", fasta, int(args.nsites)))
+
+        # needs bwa and samtools
+        missing = [tool for tool in ('bwa', 'samtools') if find_executable(tool) is None]
+        if missing:
+            skip('align', "not found: " + ", ".join(missing))
+        elif wanted('align'):
+            quiet(lambda: subprocess.call(['bwa', 'index', fasta]))()
+            record('align', lambda: benchAlign(fasta, donorfn, os.path.join(tmpdir, "aligned.bam"), 4))
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+    skipped = sorted([name for name in results if results[name].get('skipped')])
+    failed  = sorted([name for name in results if results[name].get('failed')])
+    params = dict([(key, str(value)) for (key, value) in vars(args).iteritems() if key not in ('outfile', 'tmpdir')])
+    report = {'commit': gitCommit(), 'time': time.time(), 'python': platform.python_version(),
+              'pysam': getattr(pysam, '__version__', None), 'params': params, 'results': results, 'skipped': skipped, 'failed': failed}
+
+    out = open(args.outfile, 'w')
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write("\n")
+    out.close()
+    sys.stderr.write("results written to " + args.outfile + "\n")
+
+    if skipped:
+        sys.stderr.write("skipped: " + ", ".join(skipped) + "\n")
+    if failed:
+        sys.stderr.write("failed: " + ", ".join(failed) + "\n")
+        sys.exit(1)
+    if skipped and args.strict:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark pipeline stages on a synthetic reference and .bam')
+    parser.add_argument('-o', '--outfile', dest='outfile', default='benchmark.json', help='JSON results file (default=benchmark.json)')
+    parser.add_argument('--nchroms', dest='nchroms', default=2, help='number of reference chromosomes (default=2)')
+    parser.add_argument('--chromlen', dest='chromlen', default=1000000, help='chromosome length (default=1000000)')
+    parser.add_argument('--coverage', dest='coverage', default=10, help='read depth of the simulated .bam (default=10)')
+    parser.add_argument('--readlen', dest='readlen', default=100, help='read length (default=100)')
+    parser.add_argument('--donorfrac', dest='donorfrac', default=0.01, help='fraction of read pairs in the donor .bam for replaceReads (default=0.01)')
+    parser.add_argument('--nsites', dest='nsites', default=1000, help='sites for coverage/base counting and randomsites (default=1000)')
+    parser.add_argument('--ncontigs', dest='ncontigs', default=200, help='contigs in the synthetic velvet output (default=200)')
+    parser.add_argument('--contiglen', dest='contiglen', default=32000, help='sequence length for MutableSeq edits (default=32000)')
+    parser.add_argument('--nedits', dest='nedits', default=1000, help='number of MutableSeq edits (default=1000)')
+    parser.add_argument('--only', dest='only', default=None, help='comma-separated list of benchmarks to run (default: all)')
+    parser.add_argument('-r', '--reps', dest='reps', default=3, help='repetitions, best time is reported (default=3)')
+    parser.add_argument('-s', '--seed', dest='seed', default=1, help='random seed for the fixtures (default=1)')
+    parser.add_argument('--strict', action='store_true', default=False, help='exit with an error if a benchmark was skipped (e.g. bwa or samtools missing)')
+    parser.add_argument('--tmpdir', dest='tmpdir', default=None, help='directory for fixture files')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+'''
+tests for base counting and site pileups on a small synthetic .bam (needs pysam only),
+run with: python test_pileup.py
+'''
+
+import sys,os,random,tempfile,shutil,unittest
+import pysam
+
+basedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, basedir)
+
+import addsnv
+import bs.pileup as pu
+
+CHROMLEN = 2000
+
+def makeread(ref, name, pos, cigar, flag=0):
+    ''' read named name aligned at pos with cigar, aligned bases copied from ref, others random '''
+    seq = ''
+    rpos = pos
+    for (op, n) in cigar:
+        if op == 0:
+            seq += ref[rpos:rpos+n]
+            rpos += n
+        elif op in (1, 4):
+            seq += ''.join([random.choice('ACGT') for i in range(n)])
+        elif op in (2, 3):
+            rpos += n
+    read = pysam.AlignedRead()
+    read.qname = name
+    read.seq   = seq
+    read.flag  = flag
+    read.tid   = 0
+    read.pos   = pos
+    read.mapq  = 60
+    read.cigar = cigar
+    read.qual  = 'I'*len(seq)
+    read.mrnm  = -1
+    read.mpos  = -1
+    return read
+
+class PileupTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(1)
+        self.tmpdir = tempfile.mkdtemp(prefix='test_pileup.')
+        self.ref = ''.join([random.choice('ACGT') for i in range(CHROMLEN)])
+
+        cigars = [[(0, 60)], [(4, 5), (0, 55)], [(0, 30), (2, 3), (0, 30)], [(0, 25), (1, 2), (0, 35)],
+                  [(0, 20), (3, 40), (0, 20)], [(0, 50), (4, 10)]]
+        reads = []
+        for i in range(400):
+            reads.append(makeread(self.ref, 'r' + str(i), random.randint(0, CHROMLEN-200), random.choice(cigars)))
+        reads.sort(key=lambda read: read.pos)
+
+        self.bamfn = os.path.join(self.tmpdir, 'test.bam')
+        header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': CHROMLEN}]}
+        bam = pysam.Samfile(self.bamfn, 'wb', header=header)
+        for read in reads:
+            bam.write(read)
+        bam.close()
+        pysam.index(self.bamfn)
+        self.bam = pysam.Samfile(self.bamfn, 'rb')
+
+    def tearDown(self):
+        self.bam.close()
+        shutil.rmtree(self.tmpdir)
+
+    def expectedbases(self, col):
+        ''' read bases aligned to 0-based column col, from the CIGARs '''
+        bases = []
+        for read in self.bam.fetch('chr1', col, col+1):
+            for (pos, qpos, is_del) in pu.readcolumns(read):
+                if pos == col and not is_del:
+                    bases.append(read.seq[qpos])
+        return sorted(bases)
+
+    def test_countBaseAtPos(self):
+        for col in range(100, CHROMLEN-100, 37):
+            bases = addsnv.countBaseAtPos(self.bam, 'chr1', col+1) # 1-based
+            self.assertEqual(sorted(bases), self.expectedbases(col))
+            # all aligned bases were copied from the reference
+            self.assertTrue(all([base == self.ref[col] for base in bases]))
+
+    def test_pileupsite(self):
+        positions = range(150, CHROMLEN-150, 53)
+        sites = []
+        for (i, pos) in enumerate(positions):
+            site = addsnv.MutSite(i, "chr1\t%d\t%d\n" % (pos, pos+1))
+            site.gmutpos = pos+1 # 1-based
+            site.mutbase = 'N'
+            sites.append(site)
+
+        for (site, (pos, covering)) in zip(sites, list(pu.sweep(self.bam, 'chr1', positions))):
+            pile  = addsnv.pileupsite(site, self.bam)
+            swept = addsnv.sweepsite(site, covering)
+            self.assertEqual(sorted(pile.mutreads.items()), sorted(swept.mutreads.items()))
+            self.assertEqual(pile.basecounter.columns(), swept.basecounter.columns())
+            for col in pile.basecounter.columns():
+                self.assertEqual(pile.basecounter.basecounts(col), swept.basecounter.basecounts(col))
+
+            # each mutated read has the new base where it is aligned to the site
+            self.assertEqual(len(pile.mutreads), len(self.expectedbases(pos)))
+            for (extqname, mutseq) in pile.mutreads.items():
+                read = pile.outreads[extqname]
+                qpos = [q for (p, q, is_del) in pu.readcolumns(read) if p == pos and not is_del][0]
+                self.assertEqual(mutseq, read.seq[:qpos] + 'N' + read.seq[qpos+1:])
+
+if __name__ == '__main__':
+    unittest.main()